@@ -4,12 +4,16 @@ ZODB Browser has the following submodules:
   diff         -- compute differences between two dictionaries
   testing      -- doodads to make writing tests easier
   cache        -- caching logic
+  pathindex    -- persistent index of object paths
+  backrefs     -- persistent index of references between objects
+  scanner      -- whole-database analyses in parallel processes
+  stats        -- class census and storage size statistics
 
   history      -- extracts historical state information from the ZODB
   state        -- IStateInterpreter adapters for making sense of unpickled data
   value        -- IValueRenderer adapters for pretty-printing objects to HTML
 
-  btreesupport -- special handling of OOBTree objects
+  btreesupport -- special handling of BTrees of all kinds
 
   interfaces   -- interface definitions
   browser      -- browser views
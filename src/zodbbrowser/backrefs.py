@@ -0,0 +1,172 @@
+"""
+An index of backreferences, so we can tell which objects refer to a given
+object without unpickling the whole database every time.
+
+The index is built by a single pass over the current records of the
+storage, extracting persistent references from every pickle with
+ZODB.serialize.referencesf, and is saved in a sidecar file next to the
+Data.fs.  It's a snapshot of the database at the time it was built; run
+``zodbbrowser --build-backref-index`` again to refresh it.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import weakref
+
+from ZODB.serialize import referencesf
+from ZODB.utils import u64
+
+from zodbbrowser import cache, scanner
+
+
+log = logging.getLogger(__name__)
+
+
+BACKREF_INDEXES = weakref.WeakKeyDictionary()
+
+# The backreference index file starts with a header (magic, tid of the last
+# transaction when the index was built, number of records), followed by
+# (oid, referrer oid) records sorted by oid and then referrer oid.
+BACKREF_INDEX_SUFFIX = '.zodbbrowser-backrefs'
+BACKREF_INDEX_MAGIC = b'ZBREFS01'
+BACKREF_INDEX_HEADER = struct.Struct('>8s8sQ')
+BACKREF_INDEX_RECORD = struct.Struct('>QQ')
+
+
+class BackrefAnalysis(scanner.Analysis):
+    """Find all persistent references in a storage.
+
+    The result is a list of (oid, referrer oid) tuples.
+    """
+
+    def initial(self):
+        return []
+
+    def map(self, result, referrer, data):
+        try:
+            refs = set(referencesf(data))
+        except Exception as e:
+            log.warning('Could not find references in 0x%x: %s: %s',
+                        u64(referrer), e.__class__.__name__, e)
+            return result
+        refs.discard(referrer)
+        result.extend((u64(oid), u64(referrer)) for oid in refs)
+        return result
+
+
+def scanReferences(storage, processes=1):
+    """Find all persistent references in a storage.
+
+    Returns a list of (oid, referrer oid) tuples.
+    """
+    return scanner.scan(storage, BackrefAnalysis(), processes)
+
+
+class BackrefIndex(object):
+    """A read-only mapping of oids to the oids of objects that refer to them.
+
+    ``data`` is the contents of a backreference index file, usually an mmap.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        (magic, self.tid,
+         self._count) = BACKREF_INDEX_HEADER.unpack_from(data)
+        if magic != BACKREF_INDEX_MAGIC:
+            raise ValueError('bad magic')
+        if (BACKREF_INDEX_HEADER.size
+                + self._count * BACKREF_INDEX_RECORD.size > len(data)):
+            raise ValueError('truncated file')
+
+    @classmethod
+    def load(cls, filename):
+        """Load a backreference index file.
+
+        Returns None if the file doesn't exist or is damaged.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(data)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            log.debug('Could not load backreference index %s: %s',
+                      filename, e)
+            return None
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, n):
+        return BACKREF_INDEX_RECORD.unpack_from(
+            self._data,
+            BACKREF_INDEX_HEADER.size + n * BACKREF_INDEX_RECORD.size)
+
+    def _bisect(self, oid):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def getReferrers(self, oid):
+        """Return a sorted list of oids of objects that refer to oid."""
+        referrers = []
+        for n in range(self._bisect(oid), self._count):
+            target, referrer = self._record(n)
+            if target != oid:
+                break
+            referrers.append(referrer)
+        return referrers
+
+
+def saveBackrefIndex(filename, records, tid):
+    """Write a backreference index file.
+
+    ``records`` is a list of (oid, referrer oid) tuples.
+    """
+    records = sorted(records)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(BACKREF_INDEX_HEADER.pack(BACKREF_INDEX_MAGIC, tid,
+                                          len(records)))
+        for oid, referrer in records:
+            f.write(BACKREF_INDEX_RECORD.pack(oid, referrer))
+    # os.rename() refuses to overwrite an existing file on Windows
+    os.replace(tmp_filename, filename)
+
+
+def buildBackrefIndex(storage, filename=None, processes=1):
+    """Scan the storage and save a backreference index.
+
+    Saves it next to the Data.fs, unless a filename is given.  The scan
+    can be spread over several ``processes``.
+
+    Returns the number of references in the index.
+    """
+    if filename is None:
+        filename = cache.getStorageFilename(storage)
+        if filename is None:
+            raise ValueError(
+                'Backreference indexes are supported only for FileStorage')
+        filename += BACKREF_INDEX_SUFFIX
+    tid = storage.lastTransaction()
+    records = scanReferences(storage, processes)
+    saveBackrefIndex(filename, records, tid)
+    return len(records)
+
+
+def getBackrefIndex(connection, cache_for=60):
+    """Return the BackrefIndex of the database, or None if there isn't one.
+
+    Checks for a new version of the index file at most once a minute.
+    """
+    if connection is None:
+        return None
+    return cache.getSidecarIndex(connection.db().storage, BACKREF_INDEXES,
+                                 BACKREF_INDEX_SUFFIX, BackrefIndex.load,
+                                 cache_for)
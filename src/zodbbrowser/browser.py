@@ -1,9 +1,13 @@
+import ast
+import itertools
 import json
 import logging
 import pickletools
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 import transaction
 from persistent import Persistent
@@ -17,12 +21,21 @@ from zope.app.publication.zopepublication import Cleanup, ZopePublication
 from zope.cachedescriptors.property import Lazy
 from zope.component import adapter, queryUtility
 from zope.exceptions.interfaces import UserError
-from zope.interface import Interface
+from zope.interface import Interface, implementer
 from zope.publisher.browser import BrowserView
 from zope.publisher.interfaces.browser import IBrowserRequest
+from zope.publisher.interfaces.http import IResult
 from zope.security.proxy import removeSecurityProxy
 
-from zodbbrowser import __homepage__, __version__
+from zodbbrowser import (
+    __homepage__,
+    __version__,
+    backrefs,
+    cache,
+    pathindex,
+    stats,
+)
+from zodbbrowser.btreesupport import getNumericTypes, summarizeItems
 from zodbbrowser.compat import BytesIO, StringIO, escape
 from zodbbrowser.diff import compareDictsHTML
 from zodbbrowser.history import getObjectHistory
@@ -33,6 +46,18 @@ from zodbbrowser.value import TRUNCATIONS, pruneTruncations
 
 log = logging.getLogger("zodbbrowser")
 
+# Object records of transactions are described in parallel by this many
+# threads, each with its own connection; they spend most of their time
+# waiting for the storage (especially over ZEO).  See getRenderPool() and
+# ZodbHistoryView.canRenderInThreads().
+RENDER_THREADS = 4
+
+_render_lock = threading.Lock()
+_render_pool = None
+_render_local = threading.local()
+_render_jars = []
+_render_generations = itertools.count()
+
 
 class ZodbHelpView(BrowserView):
     """Zodb help view"""
@@ -71,13 +96,43 @@ class ZodbObjectAttribute(object):
 class VeryCarefulView(BrowserView):
 
     made_changes = False
+    streaming = False
+
+    def __init__(self, context, request):
+        BrowserView.__init__(self, context, request)
+        self._cleanups = []
+
+    def _addCleanup(self, func):
+        """Call func when we're done with the request.
+
+        If the response is streamed, that's after the request is closed.
+        """
+        if self.streaming:
+            self._cleanups.append(func)
+        else:
+            self.request.hold(Cleanup(func))
+
+    def _runCleanups(self):
+        for func in self._cleanups:
+            try:
+                func()
+            except Exception:
+                log.exception('Cleanup failed')
+        self._cleanups = []
 
     @Lazy
     def jar(self):
         db = queryUtility(IDatabase, name='<target>')
         if db is not None:
-            conn = db.open()
-            self.request.hold(Cleanup(conn.close))
+            if self.streaming:
+                # the page will be rendered after the request is closed
+                # and its transaction is finished, so we need a connection
+                # (and a transaction) of our own
+                conn = db.open(transaction_manager=transaction.TransactionManager())
+                self._addCleanup(conn.transaction_manager.abort)
+            else:
+                conn = db.open()
+            self._addCleanup(conn.close)
             return conn
         try:
             return self.request.annotations['ZODB.interfaces.IConnection']
@@ -101,8 +156,10 @@ class VeryCarefulView(BrowserView):
         return self.jar.isReadOnly()
 
     def __call__(self):
+        result = None
         try:
-            return self.render()
+            result = self.render()
+            return result
         finally:
             if self.readonly or not self.made_changes:
                 resources = transaction.get()._resources
@@ -116,6 +173,86 @@ class VeryCarefulView(BrowserView):
                             msg.append("  %s" % repr(r))
                     log.debug("\n".join(msg))
                 transaction.abort()
+            if not isinstance(result, StreamingResult):
+                self._runCleanups()
+
+
+@implementer(IResult)
+class StreamingResult(object):
+    """A response body that is rendered while it's being sent.
+
+    The WSGI server calls close() when it's done sending it, and that's
+    when we run the cleanups.
+    """
+
+    def __init__(self, chunks, cleanups=()):
+        self.chunks = chunks
+        self.cleanups = cleanups
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('UTF-8')
+            if chunk:
+                yield chunk
+
+    def close(self):
+        for func in self.cleanups:
+            try:
+                func()
+            except Exception:
+                log.exception('Cleanup failed')
+
+
+class StreamingMixin:
+    """Send a page to the browser section by section, as it gets rendered.
+
+    The template must define a macro for every name in streamed_sections.
+    When called with streaming=<placeholder>, it must render everything
+    else, putting the placeholder where the sections go.  Items of
+    streamed_sections that start with '<' are sent as is.
+
+    Needs a connection of its own, so it only works with the standalone
+    app (or anywhere else a '<target>' IDatabase utility is registered).
+    """
+
+    section_template = ViewPageTemplateFile('templates/section.pt')
+    streamed_sections = ()
+    placeholder = '<!-- zodbbrowser sections -->'
+
+    def canStream(self):
+        return (self.request.method == 'GET'
+                and 'nostream' not in self.request
+                and queryUtility(IDatabase, name='<target>') is not None)
+
+    def renderTemplate(self):
+        if not self.streaming:
+            try:
+                return self.template()
+            finally:
+                self.debug_mark('- done (%s)' % formatTime(self.time_elapsed()))
+        page = self.template(streaming=self.placeholder)
+        head, tail = page.split(self.placeholder)
+        self.request.response.setHeader('Content-Type',
+                                        'text/html;charset=utf-8')
+        return StreamingResult(self._renderSections(head, tail),
+                               self._cleanups)
+
+    def _renderSections(self, head, tail):
+        yield head
+        for name in self.streamed_sections:
+            if name.startswith('<'):
+                yield name + '\n'
+                continue
+            self.debug_mark('- rendering %s' % name)
+            try:
+                yield self.section_template(macro=self.template.macros[name])
+            except Exception as e:
+                log.exception('Failed to render %s' % name)
+                yield '<div class="error">%s</div>' % escape(
+                    '%s: %s' % (e.__class__.__name__, e), False)
+        yield tail
+        self.debug_mark('- done (%s)' % formatTime(self.time_elapsed()))
 
 
 class TimedMixin:
@@ -146,18 +283,39 @@ class TimedMixin:
 
 
 @adapter(Interface, IBrowserRequest)
-class ZodbInfoView(TimedMixin, VeryCarefulView):
+class ZodbInfoView(StreamingMixin, TimedMixin, VeryCarefulView):
     """Zodb browser view"""
 
     template = ViewPageTemplateFile('templates/zodbinfo.pt')
     confirmation_template = ViewPageTemplateFile('templates/confirm_rollback.pt')
+    streamed_sections = ('<div class="object">', 'heading', 'attributes',
+                         'summary', 'items', 'referrers', 'pickle', 'history',
+                         '</div>', 'footer')
 
     version = __version__
     homepage = __homepage__
 
+    history_size = 50
+    history_start = 0
+    history_newer = history_older = None
+
+    items_limit = 200
+    items_offset = 0
+    items_prev_url = items_next_url = None
+    items_total = None
+    items_total_exact = True
+
+    referrers_limit = 100
+
+    def canStream(self):
+        return ('ROLLBACK' not in self.request
+                and 'CANCEL' not in self.request
+                and StreamingMixin.canStream(self))
+
     def render(self):
         self.reset_mark(getFullRequestUrl(self.request))
         pruneTruncations()
+        self.streaming = self.canStream()
         self.obj = self.selectObjectToView()
         self.debug_mark('- loading object history')
         # Not using IObjectHistory(self.obj) because LP: #1185175
@@ -190,10 +348,7 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
             return self.confirmation_template()
 
         self.debug_mark('- rendering')
-        try:
-            return self.template()
-        finally:
-            self.debug_mark('- done (%s)' % formatTime(self.time_elapsed()))
+        return self.renderTemplate()
 
     def _redirectToSelf(self):
         self.request.response.redirect(self.getUrl())
@@ -353,32 +508,15 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
 
     def getBreadcrumbs(self):
         self.debug_mark('- rendering breadcrumbs')
-        breadcrumbs = []
-        state = self.state
-        seen_root = False
-        while True:
-            url = self.getUrl(state.getObjectId())
-            if state.isRoot():
-                breadcrumbs.append(('/', url))
-                seen_root = True
-            else:
-                if breadcrumbs:
-                    breadcrumbs.append(('/', None))
-                if not state.getName() and state.getParentState() is None:
-                    # not using hex() because we don't want L suffixes for
-                    # 64-bit values
-                    breadcrumbs.append(('0x%x' % state.getObjectId(), url))
-                    break
-                breadcrumbs.append((state.getName() or '???', url))
-            state = state.getParentState()
-            if state is None:
-                if not seen_root:
-                    url = self.getUrl(self.getRootOid())
-                    breadcrumbs.append(('/', None))
-                    breadcrumbs.append(('...', None))
-                    breadcrumbs.append(('/', url))
-                break
-        return breadcrumbs[::-1]
+        memo = cache.getTransactionCache(self.obj._p_jar, 'paths')
+        index = pathindex.getPathIndex(self.obj._p_jar)
+        path = resolvePath(self.state, self.state.requestedTid, memo, index)
+        breadcrumbs = [(name, None if oid is None else self.getUrl(oid))
+                       for name, oid in path]
+        if path[0] == ('/', None):
+            # we couldn't get to the root, but we can link to it anyway
+            breadcrumbs[0] = ('/', self.getUrl(self.getRootOid()))
+        return breadcrumbs
 
     def getPath(self):
         return ''.join(name for name, url in self.getBreadcrumbs())
@@ -416,20 +554,212 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
         attrs = self.state.listAttributes()
         if attrs is None:
             return None
+        prefetchValues([value for name, value in attrs],
+                       self.state.requestedTid)
         return [ZodbObjectAttribute(name, value, self.state.requestedTid)
                 for name, value in sorted(attrs)]
 
     def listItems(self):
+        """List one page of the object's items.
+
+        Only lists items_limit items, because large containers can have
+        hundreds of thousands of them.  Lists are paged by offset; BTrees
+        are paged by key, so that every page takes a single descent from
+        the root of the tree (see _listTreeItems).
+        """
         self.debug_mark('- rendering items')
         items = self.state.listItems()
         if items is None:
             return None
+        if hasattr(items, 'fromKey'):
+            page = self._listTreeItems(items)
+        else:
+            page = self._listItemsPage(list(items))
+        # keys can be persistent objects too
+        prefetchValues([x for item in page for x in item],
+                       self.state.requestedTid)
         return [ZodbObjectAttribute(name, value, self.state.requestedTid)
-                for name, value in items]
+                for name, value in page]
+
+    def _getItemsWindow(self):
+        form = self.request if self.request is not None else {}
+        limit = max(1, int(form.get('items_limit', self.items_limit)))
+        offset = max(0, int(form.get('items_offset', 0)))
+        return offset, limit
+
+    def _listItemsPage(self, items):
+        offset, limit = self._getItemsWindow()
+        page = items[offset:offset + limit]
+        self.items_total = len(items)
+        self.items_offset = offset
+        if offset > 0:
+            self.items_prev_url = self.getItemsUrl(
+                items_offset=max(0, offset - limit))
+        if offset + limit < len(items):
+            self.items_next_url = self.getItemsUrl(items_offset=offset + limit)
+        return page
+
+    def _listTreeItems(self, items):
+        """List one page of the items of a BTree.
+
+        The page starts at from_key, or ends before before_key, or starts
+        at approximately items_offset (see BTreeItems.fromOffset), so it
+        takes a single descent from the root instead of a walk along the
+        bucket chain.  The Previous and Next links point to the keys at
+        the edges of the page.  BTrees with keys that can't be put in a URL
+        (see formatKey) fall back to exact offsets.
+        """
+        form = self.request if self.request is not None else {}
+        offset, limit = self._getItemsWindow()
+        page = None
+        has_prev = has_next = None
+        next_key = None
+        if form.get('before_key') is not None:
+            key = parseKey(form['before_key'])
+            try:
+                page = items.beforeKey(key, limit + 1)
+                following = items.fromKey(key)[:1]
+            except TypeError:
+                # key not comparable with the keys of this BTree
+                log.debug('Ignoring before_key=%r', key)
+                page = None
+            else:
+                has_prev = len(page) > limit
+                page = page[max(0, len(page) - limit):]
+                has_next = bool(following)
+                if following:
+                    next_key = following[0][0]
+                offset = None
+        if page is None and form.get('from_key') is not None:
+            key = parseKey(form['from_key'])
+            try:
+                page = items.fromKey(key)[:limit + 1]
+            except TypeError:
+                log.debug('Ignoring from_key=%r', key)
+            else:
+                offset = None
+        if page is None:
+            if offset > 0 and self._canPageByKey(items):
+                page = items.fromOffset(offset)[:limit + 1]
+                offset = None
+            else:
+                # exact offsets have to walk the bucket chain
+                page = items[offset:offset + limit + 1]
+        if has_next is None:
+            # we loaded one extra item, to see if there's a next page
+            has_next = len(page) > limit
+            if has_next:
+                next_key = page[limit][0]
+            page = page[:limit]
+        if has_prev is None:
+            if offset is not None:
+                has_prev = offset > 0
+            else:
+                has_prev = bool(page) and bool(items.beforeKey(page[0][0], 1))
+        if offset == 0 and not has_next:
+            self.items_total = len(page)
+        else:
+            self.items_total = max(items.estimateLength(), len(page))
+            self.items_total_exact = False
+        self.items_offset = offset
+        if has_prev:
+            text = formatKey(page[0][0]) if page else None
+            if text is not None:
+                self.items_prev_url = self.getItemsUrl(before_key=text)
+            elif offset is not None:
+                self.items_prev_url = self.getItemsUrl(
+                    items_offset=max(0, offset - limit))
+        if has_next:
+            text = formatKey(next_key)
+            if text is not None:
+                self.items_next_url = self.getItemsUrl(from_key=text)
+            elif offset is not None:
+                self.items_next_url = self.getItemsUrl(
+                    items_offset=offset + limit)
+        return page
+
+    def _canPageByKey(self, items):
+        first = items[:1]
+        return bool(first) and formatKey(first[0][0]) is not None
+
+    def getItemsTotal(self):
+        if self.items_total_exact:
+            return str(self.items_total)
+        return 'about %d' % self.items_total
+
+    def getItemsUrl(self, **params):
+        url = self.getUrl()
+        if 'items_limit' in self.request:
+            params['items_limit'] = self.request['items_limit']
+        for name, value in sorted(params.items()):
+            url += '&%s=%s' % (name, quote(str(value)))
+        return url
+
+    def canSummarizeItems(self):
+        return getNumericTypes(self.obj)[0] is not None
+
+    def getSummaryUrl(self):
+        return self.getUrl() + '&summary=1'
+
+    def getItemsSummary(self):
+        """Summary statistics of the items of a numeric BTree.
 
-    def _loadHistoricalState(self):
+        Computing them means loading every bucket, so we do it only when
+        asked to.
+        """
+        if not self.request.get('summary'):
+            return None
+        self.debug_mark('- computing summary statistics')
+        summary = summarizeItems(self.obj, self.state.listItems())
+        if summary is not None:
+            for name in 'key_histogram', 'value_histogram':
+                summary[name] = self._histogramRows(summary[name])
+        return summary
+
+    def _histogramRows(self, histogram):
+        if not histogram:
+            return []
+        top = max(count for low, high, count in histogram) or 1
+        return [dict(low=low, high=high, count=count,
+                     width='%d%%' % (100 * count // top))
+                for low, high, count in histogram]
+
+    def listReferrers(self):
+        """Objects that refer to this one, according to the backreference index.
+
+        Returns None if there's no backreference index, otherwise a dict
+        with the total number of referrers and a list of the first
+        ``referrers_limit`` ones.
+        """
+        index = backrefs.getBackrefIndex(self.jar)
+        if index is None:
+            return None
+        self.debug_mark('- rendering referrers')
+        paths = pathindex.getPathIndex(self.jar)
+        oids = index.getReferrers(self.getObjectId())
+        referrers = []
+        for oid in oids[:self.referrers_limit]:
+            try:
+                obj = self.jar.get(p64(oid))
+            except POSKeyError:
+                # deleted since the index was built
+                continue
+            path = paths.getPath(oid) if paths is not None else None
+            referrers.append(dict(
+                oid='0x%x' % oid,
+                url='@@zodbbrowser?oid=0x%x' % oid,
+                type=getObjectTypeShort(obj),
+                path=''.join(name for name, oid in path) if path else None))
+        return dict(total=len(oids), referrers=referrers,
+                    tid=self._tidToTimestamp(index.tid))
+
+    def _loadHistoricalState(self, records):
+        jar = getattr(self.obj, '_p_jar', None)
+        if jar is not None:
+            cache.prefetch(jar, [(self.obj._p_oid, d['tid'])
+                                 for d in records])
         results = []
-        for d in self.history:
+        for d in records:
             try:
                 interp = ZodbObjectState(self.obj, d['tid'],
                                          _history=self.history)
@@ -442,16 +772,58 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
         results.append(dict(state={}, error=None))
         return results
 
+    def _findHistoryStart(self, size):
+        # show the page with the currently viewed revision
+        if self.state.requestedTid is None or self.state.tid is None:
+            return 0
+        for n, d in enumerate(self.history):
+            if d['tid'] == self.state.tid:
+                return n - n % size
+        return 0
+
+    def _historyLength(self):
+        # avoid loading the entire history just to number the records
+        knownLength = getattr(self.history, 'knownLength', None)
+        if knownLength is None:
+            return len(self.history)
+        return knownLength()
+
+    def _getHistoryWindow(self):
+        size = max(1, int(self.request.get('history_size', self.history_size)))
+        if 'history_start' in self.request:
+            start = max(0, int(self.request['history_start']))
+        else:
+            start = self._findHistoryStart(size)
+        return start, size
+
+    def getHistoryUrl(self, start):
+        url = self.getUrl() + '&history_start=%d' % start
+        if 'history_size' in self.request:
+            url += '&history_size=%s' % self.request['history_size']
+        return url
+
     def listHistory(self):
-        """List transactions that modified a persistent object."""
+        """List transactions that modified a persistent object.
+
+        Only lists one page of history_size records, starting at
+        history_start (counting from the latest), because unpickling and
+        comparing all the revisions of an object can take forever.
+        """
         if 'nohist' in self.request:
             return []
 
         self.debug_mark('- rendering history')
-        state = self._loadHistoricalState()
+        start, size = self._getHistoryWindow()
+        # load one extra record, to compare the oldest shown record with
+        records = self.history[start:start + size + 1]
+        self.history_start = start
+        self.history_newer = max(0, start - size) if start > 0 else None
+        self.history_older = start + size if len(records) > size else None
+        state = self._loadHistoricalState(records)
+        total = self._historyLength()
         results = []
-        for n, d in enumerate(self.history):
-            self.debug_mark('- rendering history #%s' % n)
+        for n, d in enumerate(records[:size]):
+            self.debug_mark('- rendering history #%s' % (start + n))
             utc_timestamp = str(time.strftime('%Y-%m-%d %H:%M:%S',
                                               time.gmtime(d['time'])))
             local_timestamp = str(time.strftime('%Y-%m-%d %H:%M:%S',
@@ -468,18 +840,18 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
             oldState = state[n + 1]['state']
             diff = compareDictsHTML(curState, oldState, d['tid'])
 
+            # number in reverse order, if we know how many there are
+            index = total - start - n if total is not None else None
+
             results.append(dict(utid=u64(d['tid']),
                                 href=url, current=current,
+                                latest=(start + n == 0), index=index,
                                 error=state[n]['error'],
                                 diff=diff, user_id=user_id,
                                 user_location=user_location,
                                 utc_timestamp=utc_timestamp,
                                 local_timestamp=local_timestamp, **d))
 
-        # number in reverse order
-        for i in range(len(results)):
-            results[i]['index'] = len(results) - i
-
         return results
 
     def _tidToTimestamp(self, tid):
@@ -489,10 +861,12 @@ class ZodbInfoView(TimedMixin, VeryCarefulView):
 
 
 @adapter(Interface, IBrowserRequest)
-class ZodbHistoryView(TimedMixin, VeryCarefulView):
+class ZodbHistoryView(StreamingMixin, TimedMixin, VeryCarefulView):
     """Zodb history view"""
 
     template = ViewPageTemplateFile('templates/zodbhistory.pt')
+    streamed_sections = ('<div class="object">', 'heading', 'history',
+                         '</div>', 'footer')
 
     version = __version__
     homepage = __homepage__
@@ -505,7 +879,7 @@ class ZodbHistoryView(TimedMixin, VeryCarefulView):
             self.page_size = max(1, int(self.request['page_size']))
         self.debug_mark('Loading history')
         self.history = IDatabaseHistory(self.jar)
-        self.request.hold(Cleanup(self.history.cleanup))
+        self._addCleanup(self.history.cleanup)
         if 'page' in self.request:
             self.page = int(self.request['page'])
         elif 'tid' in self.request:
@@ -522,11 +896,9 @@ class ZodbHistoryView(TimedMixin, VeryCarefulView):
 
     def render(self):
         self.reset_mark(getFullRequestUrl(self.request))
+        self.streaming = self.canStream()
         self.update()
-        try:
-            return self.template()
-        finally:
-            self.debug_mark('- done (%s)' % formatTime(self.time_elapsed()))
+        return self.renderTemplate()
 
     def getUrl(self, tid=None):
         url = "@@zodbbrowser_history"
@@ -538,7 +910,7 @@ class ZodbHistoryView(TimedMixin, VeryCarefulView):
 
     def findPage(self, tid):
         try:
-            pos = list(self.history.tids).index(tid)
+            pos = self.history.findTransaction(tid)
         except ValueError:
             return 0
         else:
@@ -575,32 +947,7 @@ class ZodbHistoryView(TimedMixin, VeryCarefulView):
                 size = None
             self.debug_mark('- listing 0x%x (%s)' % (utid, formatSize(size)))
             ext = d.extension if isinstance(d.extension, dict) else {}
-            objects = []
-            for idx, record in enumerate(d):
-                url = "@@zodbbrowser?oid=0x%x&tid=0x%x" % (u64(record.oid),
-                                                           utid)
-                if 'fast' in self.request or (
-                        self.time_elapsed() > 10
-                        and idx > 10
-                        and 'full' not in self.request):
-                    objects.append(dict(
-                        oid=u64(record.oid),
-                        path='0x%x' % u64(record.oid),
-                        oid_repr=oid_repr(record.oid),
-                        class_repr='',
-                        url=url,
-                        repr='(view object)',
-                    ))
-                else:
-                    obj = self.jar.get(record.oid)
-                    objects.append(dict(
-                        oid=u64(record.oid),
-                        path=getObjectPath(obj, d.tid),
-                        oid_repr=oid_repr(record.oid),
-                        class_repr=getObjectType(obj),
-                        url=url,
-                        repr=IValueRenderer(obj).render(d.tid),
-                    ))
+            objects = self._describeRecords(list(d), d.tid)
             if len(objects) == 1:
                 summary = '1 object record'
             else:
@@ -628,6 +975,128 @@ class ZodbHistoryView(TimedMixin, VeryCarefulView):
         self.debug_mark('- back to rendering')
         return results[::-1]
 
+    def _describeRecord(self, jar, idx, record, tid, memo=None, lock=None):
+        url = "@@zodbbrowser?oid=0x%x&tid=0x%x" % (u64(record.oid), u64(tid))
+        if 'fast' in self.request or (
+                self.time_elapsed() > 10
+                and idx > 10
+                and 'full' not in self.request):
+            # Don't load the object: the class is in the record
+            # and the path may be in the path index
+            return dict(
+                oid=u64(record.oid),
+                path=getRecordPath(jar, record.oid),
+                oid_repr=oid_repr(record.oid),
+                class_repr=getRecordType(record.data),
+                url=url,
+                repr='(view object)',
+            )
+        obj = jar.get(record.oid)
+        return dict(
+            oid=u64(record.oid),
+            path=getObjectPath(obj, tid, memo, lock),
+            oid_repr=oid_repr(record.oid),
+            class_repr=getObjectType(obj),
+            url=url,
+            repr=IValueRenderer(obj).render(tid),
+        )
+
+    def _describeRecords(self, records, tid):
+        """Describe the object records of a transaction, in order."""
+        for record in records:
+            cache.rememberPickle(self.jar, record.oid, tid, record.data)
+        if not self.canRenderInThreads(records):
+            return [self._describeRecord(self.jar, idx, record, tid)
+                    for idx, record in enumerate(records)]
+        db = self.jar.db()
+        # every thread starts a new transaction once per batch, so the
+        # records of one listing are described against the same state
+        generation = next(_render_generations)
+        # the paths of the common ancestors are shared by all the threads
+        memo = cache.getTransactionCache(self.jar, 'paths')
+        lock = threading.Lock()
+
+        def describe(args):
+            idx, record = args
+            return self._describeRecord(getRenderConnection(db, generation),
+                                        idx, record, tid, memo, lock)
+
+        return list(getRenderPool().map(describe, enumerate(records)))
+
+    def canRenderInThreads(self, records):
+        """Can the records be described by the rendering thread pool?
+
+        Only for the standalone zodbbrowser, which registers the '<target>'
+        database: inside an application the threads would keep connections
+        to its database open forever, and they'd see only the global
+        component registry, not the local site.
+        """
+        return (RENDER_THREADS > 1 and len(records) > 1
+                and queryUtility(IDatabase, name='<target>') is not None)
+
+
+@adapter(Interface, IBrowserRequest)
+class ZodbStatsView(TimedMixin, VeryCarefulView):
+    """Zodb statistics view"""
+
+    template = ViewPageTemplateFile('templates/zodbstats.pt')
+
+    version = __version__
+    homepage = __homepage__
+
+    census = None
+
+    def render(self):
+        self.reset_mark(getFullRequestUrl(self.request))
+        # Taking the census means reading the whole database, so we do it
+        # only when asked to; once it's taken, keeping it up to date is cheap
+        if self.request.get('compute') or stats.hasCensus(self.jar):
+            self.debug_mark('- taking the class census')
+            self.census = stats.getCensus(self.jar)
+        self.debug_mark('- rendering')
+        return self.template()
+
+    def getCensusTidNice(self):
+        return self._tidToTimestamp(self.census['tid'])
+
+    def getTotals(self):
+        census = self.census['census'].values()
+        return dict(count=sum(stats['count'] for stats in census),
+                    size=formatSize(sum(stats['size'] for stats in census)),
+                    classes=len(self.census['census']))
+
+    def listClasses(self):
+        rows = stats.summarizeCensus(self.census['census'])
+        for row in rows:
+            row['size'] = formatSize(row['size'])
+            row['average'] = formatSize(row['average'])
+            row['largest'] = [dict(oid='0x%x' % oid,
+                                   url='@@zodbbrowser?oid=0x%x' % oid,
+                                   size=formatSize(size))
+                              for oid, size in row['largest']]
+        return rows
+
+    def listLargestObjects(self):
+        return [dict(oid='0x%x' % oid,
+                     url='@@zodbbrowser?oid=0x%x' % oid,
+                     class_name=class_name,
+                     size=formatSize(size))
+                for size, oid, class_name in self.census['largest']]
+
+    def listLargestRevisions(self):
+        return [dict(oid='0x%x' % oid,
+                     url='@@zodbbrowser?oid=0x%x&tid=0x%x' % (oid, tid),
+                     class_name=class_name,
+                     size=formatSize(size),
+                     tid=self._tidToTimestamp(p64(tid)))
+                for size, oid, tid, class_name
+                in self.census['largest_revisions']]
+
+    def _tidToTimestamp(self, tid):
+        if isinstance(tid, bytes) and len(tid) == 8:
+            return str(TimeStamp(tid))
+        return tid_repr(tid)
+
 
 def getObjectType(obj):
     cls = getattr(obj, '__class__', None)
@@ -645,31 +1114,214 @@ def getObjectTypeShort(obj):
         return cls.__name__
 
 
-def getObjectPath(obj, tid):
-    path = []
-    seen_root = False
-    state = ZodbObjectState(obj, tid)
-    while True:
-        if state.isRoot():
-            path.append('/')
-            seen_root = True
+def prefetchValues(values, tid=None):
+    """Start loading the persistent objects among values.
+
+    Call this before rendering them, so they're all requested from the
+    storage at once and not one by one (see cache.prefetch).
+    """
+    records = {}
+    for value in values:
+        if not isinstance(value, Persistent) or value._p_oid is None:
+            continue
+        if tid is None and value._p_changed is not None:
+            # already loaded
+            continue
+        jar = value._p_jar
+        if jar is not None:
+            records.setdefault(jar, []).append((value._p_oid, tid))
+    for jar, jar_records in records.items():
+        cache.prefetch(jar, jar_records)
+
+
+def getRecordType(data):
+    """Return the class of an object record, formatted like getObjectType.
+
+    Reads only the first pickle of the record, so the object is not loaded.
+    """
+    if not data:
+        return ''
+    class_name = stats.getClassName(data)
+    if not class_name:
+        return ''
+    return "<class '%s'>" % class_name
+
+
+def getRecordPath(jar, oid):
+    """Return the path of an object if it's in the path index, or its oid."""
+    index = pathindex.getPathIndex(jar)
+    if index is not None:
+        path = index.getPath(u64(oid))
+        if path is not None:
+            return ''.join(name for name, path_oid in path)
+    return '0x%x' % u64(oid)
+
+
+def getObjectPath(obj, tid, memo=None, lock=None):
+    """Return the path of an object, for showing in transaction listings.
+
+    Prefers the path index, if there is one: looking up an object there
+    is much faster than following __parent__ pointers, even if it
+    may be out of date.
+
+    Paths are remembered in ``memo`` (by default a per-transaction cache of
+    the object's connection).  Threads that share a memo should also share
+    a ``lock``, so that the ancestors get loaded by only one of them.
+    """
+    index = pathindex.getPathIndex(obj._p_jar)
+    if index is not None:
+        path = index.getPath(u64(obj._p_oid))
+        if path is not None:
+            return ''.join(name for name, oid in path)
+    if memo is None:
+        memo = cache.getTransactionCache(obj._p_jar, 'paths')
+    path = memo.get((u64(obj._p_oid), tid))
+    if path is None:
+        state = ZodbObjectState(obj, tid)
+        if lock is None:
+            path = resolvePath(state, tid, memo, index)
         else:
-            if path:
-                path.append('/')
-            if not state.getName() and state.getParentState() is None:
+            with lock:
+                path = resolvePath(state, tid, memo, index)
+    return ''.join(name for name, oid in path)
+
+
+def resolvePath(state, tid, memo, index=None):
+    """Find the path of an object by following __parent__ pointers.
+
+    ``state`` is the ZodbObjectState of the object at ``tid``.
+
+    Returns a list of (name, oid) tuples, starting from the root.  Path
+    separators and the '...' that stands for an unknown part of the path
+    have None for oid.
+
+    The paths of the object and of all its ancestors are remembered in the
+    ``memo`` dict, so that objects with common ancestors don't have to load
+    the state of those ancestors over and over again.
+
+    Objects that have no __parent__ are looked up in the path ``index``,
+    if one is given.
+    """
+    oid = state.getObjectId()
+    path = memo.get((oid, tid))
+    if path is not None:
+        return path
+    if state.isRoot():
+        path = [('/', oid)]
+    else:
+        name = state.getName()
+        parent = state.getParent()
+        if parent is None and index is not None and oid in index:
+            path = index.getPath(oid)
+        elif parent is None:
+            if name:
+                path = [('/', None), ('...', None), ('/', None), (name, oid)]
+            else:
                 # not using hex() because we don't want L suffixes for
                 # 64-bit values
-                path.append('0x%x' % state.getObjectId())
-                break
-            path.append(state.getName() or '???')
-        state = state.getParentState()
-        if state is None:
-            if not seen_root:
-                path.append('/')
-                path.append('...')
-                path.append('/')
-            break
-    return ''.join(path[::-1])
+                path = [('0x%x' % oid, oid)]
+        else:
+            parent_path = None
+            if getattr(parent, '_p_oid', None) is not None:
+                parent_path = memo.get((u64(parent._p_oid), tid))
+            if parent_path is None:
+                parent_path = resolvePath(state.getParentState(), tid, memo,
+                                          index)
+            if parent_path[-1][0] != '/':
+                parent_path = parent_path + [('/', None)]
+            path = parent_path + [(name or '???', oid)]
+    memo[oid, tid] = path
+    return path
+
+
+def parseKey(text):
+    """Convert a BTree key from a URL into a Python value.
+
+    Understands Python literals, so 42 is a number and '42' is a string.
+    Anything else is taken to be a string.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def formatKey(key):
+    """Convert a BTree key into text for a URL; the reverse of parseKey.
+
+    Returns None if parseKey can't convert the text back into the key.
+    """
+    text = repr(key)
+    try:
+        parsed = parseKey(text)
+        if type(parsed) is type(key) and parsed == key:
+            return text
+    except Exception:
+        pass
+    return None
+
+
+def getRenderPool():
+    """Return the thread pool that describes object records.
+
+    There's one pool for the whole process, shared by all requests.
+    """
+    global _render_pool
+    with _render_lock:
+        if _render_pool is None:
+            _render_pool = ThreadPoolExecutor(
+                RENDER_THREADS, thread_name_prefix='zodbbrowser-render')
+        return _render_pool
+
+
+def getRenderConnection(db, generation=None):
+    """Return the connection to db of the current rendering thread.
+
+    Objects can't be shared between connections (or threads), so every
+    thread loads its own copies.  The connection is kept for later requests
+    and brought up to date whenever ``generation`` changes (i.e. once per
+    batch of records, keeping the per-transaction caches for the batch).
+    """
+    jars = getattr(_render_local, 'jars', None)
+    if jars is None:
+        jars = _render_local.jars = {}
+    if db not in jars:
+        jar = db.open(transaction_manager=transaction.TransactionManager())
+        jars[db] = [jar, generation]
+        with _render_lock:
+            _render_jars.append(jar)
+        return jar
+    jar, seen = jars[db]
+    if seen != generation:
+        # we never make changes; this just starts a new transaction
+        jar.transaction_manager.abort()
+        jar.cacheGC()
+        jars[db][1] = generation
+    return jar
+
+
+def setRenderThreads(count):
+    """Set the size of the rendering thread pool."""
+    global RENDER_THREADS
+    shutdownRenderPool()
+    RENDER_THREADS = count
+
+
+def shutdownRenderPool():
+    """Stop the rendering threads and close their connections."""
+    global _render_pool
+    with _render_lock:
+        pool, _render_pool = _render_pool, None
+        jars = _render_jars[:]
+        del _render_jars[:]
+    if pool is not None:
+        pool.shutdown()
+    for jar in jars:
+        if jar.opened is None:
+            # closed together with its database
+            continue
+        jar.transaction_manager.abort()
+        jar.close()
 
 
 def formatTime(seconds):
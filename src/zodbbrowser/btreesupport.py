@@ -10,7 +10,12 @@ The format of the picked BTree state is nicely documented in ZODB's source
 code, specifically, BTreeTemplate.c and BucketTemplate.c.
 """
 
-from BTrees.OOBTree import OOBTree, OOBucket
+import bisect
+import itertools
+from array import array
+
+from BTrees.Interfaces import IBTree, IMinimalDictionary, ISet, ITreeSet
+from ZODB.utils import p64, u64
 from zope.component import adapter, getMultiAdapter
 from zope.interface import implementer
 
@@ -25,42 +30,92 @@ try:
 except ImportError:
     from zope.app.container.btree import BTreeContainer # BBB
 
-from zodbbrowser.history import ZodbObjectHistory
+from zodbbrowser import cache
+from zodbbrowser.history import ZodbObjectHistory, getObjectHistory
 from zodbbrowser.interfaces import IObjectHistory, IStateInterpreter
 from zodbbrowser.state import GenericState
 
 
-@adapter(OOBTree)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@adapter(IBTree)
 @implementer(IObjectHistory)
-class OOBTreeHistory(ZodbObjectHistory):
-
-    def _load(self):
-        # find all objects (tree and buckets) that have ever participated in
-        # this OOBTree
-        queue = [self._obj]
-        seen = set(self._oid)
-        history_of = {}
+class BTreeHistory(ZodbObjectHistory):
+
+    _real_history = None
+
+    def _load(self, size=None):
+        # Always loads the full history, because we can't know which buckets
+        # changed recently without looking at all of them.  Merging the
+        # histories of all the buckets is slow for large trees, so the result
+        # is cached across requests and extended with new transactions only.
+        merged = cache.getBTreeHistoryCache(self._connection, self._oid)
+        storage = self._connection.db().storage
+        with merged['lock']:
+            # look at the last transaction before we start, so that anything
+            # committed while we're merging is looked at again next time
+            last_tid = storage.lastTransaction()
+            first_tid = cache.getFirstTid(storage)
+            if 'records' not in merged or merged['first_tid'] != first_tid:
+                # first time, or the database was packed
+                merged['oids'] = set()
+                merged['records'] = []
+                self._mergeHistory(merged, None)
+            elif merged['last_tid'] != last_tid:
+                self._mergeHistory(merged, merged['last_tid'])
+            merged['first_tid'] = first_tid
+            merged['last_tid'] = last_tid
+            self._history = merged['records']
+        self._complete = True
+        self._index_by_tid()
+
+    def _mergeHistory(self, merged, since):
+        """Merge history records newer than since into merged['records'].
+
+        Looks at the history of the tree and of all the buckets that have
+        ever participated in it (merged['oids']), following the firstbucket
+        and nextbucket pointers of every new revision to find new buckets.
+        When extending the history, looks only at those of them that were
+        modified by the transactions after since.
+        """
+        by_tid = dict((d['tid'], d) for d in merged['records'])
+        known = set(merged['oids'])
+        queue = sorted(known) or [self._oid]
+        if since is not None:
+            changed = changedOids(self._connection.db().storage, since)
+            if changed is not None:
+                queue = sorted(known & changed)
+                if not queue:
+                    return
+        merged['oids'].update(queue)
         while queue:
-            obj = queue.pop(0)
-            history = history_of[obj._p_oid] = ZodbObjectHistory(obj)
-            for d in history:
+            oid = queue.pop(0)
+            history = ZodbObjectHistory(self._connection.get(oid))
+            if since is not None and oid in known:
+                # most buckets haven't changed, so start small
+                history.initial_size = 1
+                records = takeNewerThan(history, since)
+            else:
+                records = history[:]
+            for d in records:
+                by_tid.setdefault(d['tid'], d)
                 state = history.loadState(d['tid'])
                 if state and len(state) > 1:
                     bucket = state[1]
-                    if bucket._p_oid not in seen:
-                        queue.append(bucket)
-                        seen.add(bucket._p_oid)
-        # merge the histories of all objects
-        by_tid = {}
-        for h in history_of.values():
-            for d in h:
-                by_tid.setdefault(d['tid'], d)
-        self._history = sorted(by_tid.values(),
-                               key=lambda d: d['tid'], reverse=True)
-        self._index_by_tid()
+                    if bucket._p_oid not in merged['oids']:
+                        queue.append(bucket._p_oid)
+                        merged['oids'].add(bucket._p_oid)
+        merged['records'] = sorted(by_tid.values(),
+                                   key=lambda d: d['tid'], reverse=True)
 
     def _lastRealChange(self, tid=None):
-        return ZodbObjectHistory(self._obj).lastChange(tid)
+        if self._real_history is None:
+            self._real_history = ZodbObjectHistory(self._obj)
+        return self._real_history.lastChange(tid)
 
     def loadStatePickle(self, tid=None):
         # lastChange would return the tid that modified self._obj or any
@@ -69,14 +124,15 @@ class OOBTreeHistory(ZodbObjectHistory):
         # XXX: this is used to show the pickled size of an object.  It
         # will be misleading for BTrees if we show just the size for the
         # main BTree object while we're hiding all the individual buckets.
-        return self._connection._storage.loadSerial(self._obj._p_oid,
-                                                    self._lastRealChange(tid))
+        return cache.loadSerial(self._connection, self._oid,
+                                self._lastRealChange(tid))
 
     def loadState(self, tid=None):
         # lastChange would return the tid that modified self._obj or any
         # of its subobjects, thanks to the history merging done by _load.
         # We need the real last change value.
-        return self._connection.oldstate(self._obj, self._lastRealChange(tid))
+        return cache.loadState(self._connection, self._oid,
+                               self._lastRealChange(tid))
 
     def canRollback(self):
         return False
@@ -85,60 +141,484 @@ class OOBTreeHistory(ZodbObjectHistory):
         raise NotImplementedError('This is too complicated/dangerous!')
 
 
-@adapter(OOBTree, tuple, None)
-@implementer(IStateInterpreter)
-class OOBTreeState(object):
-    """Non-empty OOBTrees have a complicated tuple structure."""
+@adapter(ITreeSet)
+class TreeSetHistory(BTreeHistory):
+    """TreeSets are made of Sets just like BTrees are made of Buckets."""
 
-    def __init__(self, type, state, tid):
-        self._items = []
-        # A BTree has two kinds of nodes: internal nodes are OOBTree objects,
-        # leaf nodes are OOBucket objects.  Internal nodes contain
-        # either OOBTrees or OOBuckets (or nothing, if it's an empty node).
+
+OOBTreeHistory = BTreeHistory  # BBB
+
+
+def changedOids(storage, since):
+    """Return the set of oids modified by the transactions after since.
+
+    Returns None if the storage can't iterate over its transactions.
+    """
+    if not hasattr(storage, 'iterator'):
+        return None
+    oids = set()
+    with cache.maybe_closing(storage.iterator(p64(u64(since) + 1))) as it:
+        for txn in it:
+            oids.update(record.oid for record in txn)
+    return oids
+
+
+def takeNewerThan(history, tid):
+    """Return the history records newer than tid, newest first."""
+    records = []
+    for d in history:
+        if d['tid'] <= tid:
+            break
+        records.append(d)
+    return records
+
+
+def loadNodeState(node, tid):
+    """Load the state of a BTree node or bucket as of tid.
+
+    Not through getObjectHistory(), which would keep the history of every
+    bucket of a big tree around until the end of the transaction.  The
+    states themselves are cached by cache.loadState(), which is bounded.
+    """
+    return ZodbObjectHistory(node).loadState(tid)
+
+
+def isInternalNode(node):
+    """Is this node of a BTree an internal node (and not a bucket)?"""
+    # BTrees and TreeSets have a _bucket_type, buckets and Sets don't
+    # (look at the class, or we'd unghostify the node)
+    return hasattr(type(node), '_bucket_type')
+
+
+def fanout(state):
+    """Return the number of children of an internal BTree node."""
+    if len(state) != 2:
+        # empty, or a single inlined bucket
+        return 1
+    return len(state[0]) // 2 + 1
+
+
+class BTreeItems(object):
+    """The items of a BTree, loaded one bucket at a time.
+
+    Behaves like a read-only list of (key, value) tuples, but loads only as
+    many buckets as needed to iterate over it or to get a slice.  len() has
+    to load every bucket, but doesn't build the tuples.
+
+    The items of a TreeSet (pairs=False) are (key, key) tuples.
+
+    fromKey() and fromOffset() descend through the internal nodes of the
+    tree to find the right bucket, without loading any buckets before it.
+    """
+
+    # (bucket state, index of the first item) when we don't start at the
+    # first item of the tree
+    _start = None
+
+    # how many buckets to ask the storage for at once (see cache.prefetch)
+    prefetch_size = 100
+
+    def __init__(self, state, tid, pairs=True):
+        # A BTree has two kinds of nodes: internal nodes are BTree objects,
+        # leaf nodes are Bucket objects.  Internal nodes contain
+        # either BTrees or Buckets (or nothing, if it's an empty node).
         # Buckets contain actual keys and values.  In addition, each internal
         # node has a firstbucket reference that points to the leftmost
         # grandchild, and each bucket has a nextbucket reference.  We
         # can start at firstbucket and follow nextbucket pointers and we'll
         # get all the items in increasing order by key.
         #
-        # The pickled state of an OOBTree can be:
+        # The pickled state of a BTree can be:
         # - `None` for an empty tree
         # - `((first_bucket_state, ), )` for a tree with one bucket
         # - `((child0, key1, child1, ...), firstbucket)` for the general case
         #
-        # The pickled state of an OOBucket is
+        # The pickled state of a Bucket is
         # - `((key0, value0, key1, value1, ...),)` for the last bucket
         # - `((key0, value0, key1, value1, ...), next_bucket)` for the general case
         #
+        # TreeSets are just like BTrees, except that their leaf nodes are Sets,
+        # and Sets have just the keys: `((key0, key1, ...), next_set)`.
+        #
         # This is documented in comments in BTreeTemplate.c and BucketTemplate.c.
         if not state:
             state = ()
         else:
             assert isinstance(state, tuple)
-        if len(state) == 1:
-            firstbucket_state = state[0][0]
-        elif len(state) == 2:
-            bucket = state[1]
-            firstbucket_state = IObjectHistory(bucket).loadState(tid)
+        assert len(state) <= 2
+        self._state = state
+        self._tid = tid
+        self._pairs = pairs
+        self._width = 2 if pairs else 1
+
+    def _firstBucket(self):
+        if len(self._state) == 1:
+            return self._state[0][0]
+        elif len(self._state) == 2:
+            bucket = self._state[1]
+            return loadNodeState(bucket, self._tid)
         else:
-            assert len(state) == 0
-            firstbucket_state = ((),)
+            return ((),)
+
+    def _keys(self, bucket):
+        return bucket[0][0::self._width]
+
+    def _bucketSize(self, bucket):
+        return len(bucket[0]) // self._width
+
+    def _loadNode(self, node):
+        return loadNodeState(node, self._tid)
 
-        state = firstbucket_state
+    def _descend(self, choose, state=None):
+        """Descend from the root of the tree to a bucket.
+
+        Calls choose(children, keys) at every internal node to pick one of
+        its children; keys are the separator keys between the children.
+
+        Returns the state of the bucket.
+        """
+        if state is None:
+            state = self._state
+        while True:
+            if not state:
+                return ((),)
+            if len(state) == 1:
+                # a tree with a single inlined bucket
+                return state[0][0]
+            # an internal node: ((child0, key1, child1, ...), firstbucket)
+            data = state[0]
+            child = data[2 * choose(data[0::2], data[1::2])]
+            state = self._loadNode(child)
+            if not isInternalNode(child):
+                return state
+
+    def _childSizes(self, children):
+        """Estimate relative sizes of the children of the root node.
+
+        The children of an internal node can differ in size by a factor of
+        two or more, and we can tell by looking at the number of their
+        own children.  Buckets are assumed to be all the same size.
+        """
+        if not isInternalNode(children[0]):
+            return [1] * len(children)
+        return [fanout(self._loadNode(child)) for child in children]
+
+    def _startingAt(self, bucket, index):
+        items = self.__class__(self._state, self._tid, self._pairs)
+        items._start = bucket, index
+        return items
+
+    def fromKey(self, key):
+        """Return the items with keys greater than or equal to key."""
+        bucket = self._descend(
+            lambda children, keys: bisect.bisect_right(keys, key))
+        index = bisect.bisect_left(self._keys(bucket), key)
+        return self._startingAt(bucket, index)
+
+    def beforeKey(self, key, count):
+        """Return up to count items with keys less than key, in order.
+
+        Buckets don't point to the previous bucket, so this descends from
+        the root once for every bucket it looks at.
+        """
+        items = []
+        while len(items) < count:
+            # the lower bound of the keys in the bucket we descend to
+            low = None
+
+            def choose(children, keys):
+                nonlocal low
+                i = bisect.bisect_left(keys, key)
+                if i > 0:
+                    low = keys[i - 1]
+                return i
+
+            bucket = self._descend(choose)
+            index = bisect.bisect_left(self._keys(bucket), key)
+            it = iter(bucket[0][:index * self._width])
+            if self._pairs:
+                items[:0] = zip(it, it)
+            else:
+                items[:0] = [(k, k) for k in it]
+            if low is None:
+                # that was the first bucket
+                break
+            key = low
+        return items[max(0, len(items) - count):]
+
+    def fromOffset(self, offset):
+        """Return the items starting at approximately the given offset.
+
+        Assumes that all the subtrees at the same level below the root
+        are about the same size, which is roughly true for BTrees.
+        """
+        fraction = max(0.0, min(1.0, offset / max(1, self.estimateLength())))
+        at_root = True
+
+        def choose(children, keys):
+            nonlocal fraction, at_root
+            if at_root:
+                sizes = self._childSizes(children)
+                at_root = False
+            else:
+                sizes = [1] * len(children)
+            position = fraction * sum(sizes)
+            for i, size in enumerate(sizes):
+                if position < size or i == len(sizes) - 1:
+                    break
+                position -= size
+            fraction = min(1.0, position / size)
+            return i
+
+        bucket = self._descend(choose)
+        size = self._bucketSize(bucket)
+        index = min(int(fraction * size), max(0, size - 1))
+        return self._startingAt(bucket, index)
+
+    def estimateLength(self, samples=5):
+        """Estimate the number of items without loading all the buckets.
+
+        Looks at the children of the root and then at the nodes along a
+        few paths down to a bucket.  The estimate is exact for small trees
+        that have just one bucket.
+        """
+        if len(self._state) != 2:
+            return self._bucketSize(self._firstBucket())
+        children = self._state[0][0::2]
+        sizes = self._childSizes(children)
+        # pick a few children of the root, spread evenly
+        picks = sorted(set(len(children) * (2 * i + 1) // (2 * samples)
+                           for i in range(samples)))
+        per_node = []
+        for i in picks:
+            # estimate the number of items per node one level below
+            # this child (or per child, if the child is a bucket)
+            size = 1
+
+            def choose(children, keys):
+                nonlocal size
+                size *= len(children)
+                return len(children) // 2
+
+            state = self._loadNode(children[i])
+            if isInternalNode(children[i]):
+                bucket = self._descend(choose, state)
+                size = size * self._bucketSize(bucket) / fanout(state)
+            else:
+                size = self._bucketSize(state)
+            per_node.append(size)
+        return int(sum(sizes) * sum(per_node) / len(per_node))
+
+    def buckets(self):
+        """Iterate over the states of all the buckets, in order."""
+        if self._start is not None:
+            state = self._start[0]
+        else:
+            self._prefetchBuckets()
+            state = self._firstBucket()
         while True:
             assert isinstance(state, tuple)
             assert 1 <= len(state) <= 2
             items = state[0]
             assert isinstance(items, tuple)
-            assert len(items) % 2 == 0
-            it = iter(items)
-            self._items.extend(zip(it, it))
+            assert len(items) % self._width == 0
+            yield state
 
             if len(state) == 1:
                 break
 
             bucket = state[1]
-            state = IObjectHistory(bucket).loadState(tid)
+            state = loadNodeState(bucket, self._tid)
+
+    def _prefetchBuckets(self):
+        """Ask the storage for the first buckets before we walk the chain.
+
+        Only the children of the root node are known without loading
+        anything, so this helps only for trees of depth two, but most
+        trees are small.
+        """
+        if len(self._state) != 2:
+            return
+        children = self._state[0][0::2][:self.prefetch_size]
+        if not children or isInternalNode(children[0]):
+            return
+        jar = getattr(children[0], '_p_jar', None)
+        if jar is not None:
+            cache.prefetch(jar, [(child._p_oid, self._tid)
+                                 for child in children])
+
+    def _iterFrom(self, start):
+        if self._start is not None:
+            start += self._start[1]
+        for state in self.buckets():
+            size = self._bucketSize(state)
+            if start >= size:
+                # skip the entire bucket
+                start -= size
+                continue
+            it = iter(state[0][start * self._width:])
+            start = 0
+            if self._pairs:
+                for item in zip(it, it):
+                    yield item
+            else:
+                for key in it:
+                    yield key, key
+
+    def __iter__(self):
+        return self._iterFrom(0)
+
+    def __len__(self):
+        skip = self._start[1] if self._start is not None else 0
+        return max(0, sum(self._bucketSize(state) for state in self.buckets()) - skip)
+
+    def __bool__(self):
+        for item in self:
+            return True
+        return False
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.start, index.stop, index.step
+            if (start or 0) < 0 or (stop or 0) < 0 or step not in (None, 1):
+                return list(self)[index]
+            return list(itertools.islice(self._iterFrom(start or 0),
+                                         None if stop is None
+                                         else max(0, stop - (start or 0))))
+        if index < 0:
+            return list(self)[index]
+        for item in self._iterFrom(index):
+            return item
+        raise IndexError(index)
+
+    def __eq__(self, other):
+        if isinstance(other, (BTreeItems, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '<%s of %r at tid %r>' % (self.__class__.__name__,
+                                         self._state, self._tid)
+
+
+# array typecodes for the keys and values of numeric BTree families, by the
+# letters in the name of the family (IIBTree, IFBTree, LQBTree etc.)
+NUMERIC_TYPECODES = {'I': 'i', 'U': 'I', 'L': 'q', 'Q': 'Q', 'F': 'd'}
+
+
+def getNumericTypes(obj):
+    """Return array typecodes for the keys and values of a BTree.
+
+    Returns None instead of a typecode for keys or values that aren't
+    numbers (e.g. the keys of an OIBTree, or the values of a TreeSet).
+    """
+    family = type(obj).__module__.rpartition('.')[2]
+    if len(family) != len('IIBTree') or not family.endswith('BTree'):
+        return None, None
+    if ITreeSet.providedBy(obj) or ISet.providedBy(obj):
+        return NUMERIC_TYPECODES.get(family[0]), None
+    return NUMERIC_TYPECODES.get(family[0]), NUMERIC_TYPECODES.get(family[1])
+
+
+def histogram(values, low, high, bins=10):
+    """Count how many values fall into each of several equal ranges.
+
+    Returns a list of (low, high, count) tuples.
+    """
+    if low == high:
+        # like numpy.histogram() does
+        low, high = low - 0.5, high + 0.5
+    if numpy is not None:
+        counts, edges = numpy.histogram(
+            numpy.frombuffer(values, dtype=values.typecode),
+            bins=bins, range=(low, high))
+        return [(edges[i].item(), edges[i + 1].item(), counts[i].item())
+                for i in range(bins)]
+    width = (high - low) / bins
+    counts = [0] * bins
+    for value in values:
+        counts[min(int((value - low) / width), bins - 1)] += 1
+    return [(low + i * width, low + (i + 1) * width, counts[i])
+            for i in range(bins)]
+
+
+def summarizeItems(obj, items, bins=10):
+    """Compute summary statistics of the items of a numeric BTree.
+
+    Returns None if the keys of the BTree aren't numbers, or if the items
+    aren't a BTreeItems.  Otherwise returns a dict with
+
+        count -- number of items
+        buckets -- number of buckets
+        min_key, max_key -- the smallest and the largest key
+        key_density -- fraction of integers between min_key and max_key
+                       that are keys (None if keys are floats)
+        key_histogram -- list of (low, high, count)
+        min_value, max_value, mean_value, value_histogram -- same for
+                       values (None if the values aren't numbers)
+
+    Keys and values are copied from the bucket states into arrays, without
+    building the (key, value) tuples, and aggregated with NumPy if it's
+    installed.
+    """
+    key_type, value_type = getNumericTypes(obj)
+    if key_type is None or not isinstance(items, BTreeItems):
+        return None
+    width = 2 if items._pairs else 1
+    keys = array(key_type)
+    values = array(value_type) if value_type else None
+    buckets = 0
+    for state in items.buckets():
+        buckets += 1
+        keys.extend(state[0][0::width])
+        if values is not None:
+            values.extend(state[0][1::2])
+    summary = dict(count=len(keys), buckets=buckets, min_key=None,
+                   max_key=None, key_density=None, key_histogram=None,
+                   min_value=None, max_value=None, mean_value=None,
+                   value_histogram=None)
+    if not keys:
+        return summary
+    # keys are sorted
+    summary['min_key'] = min_key = keys[0]
+    summary['max_key'] = max_key = keys[-1]
+    if key_type != 'd':
+        summary['key_density'] = len(keys) / (max_key - min_key + 1)
+    summary['key_histogram'] = histogram(keys, min_key, max_key, bins)
+    if values is not None:
+        if numpy is not None:
+            buf = numpy.frombuffer(values, dtype=values.typecode)
+            min_value, max_value = buf.min().item(), buf.max().item()
+            summary['mean_value'] = buf.mean().item()
+        else:
+            min_value, max_value = min(values), max(values)
+            summary['mean_value'] = sum(values) / len(values)
+        summary['min_value'] = min_value
+        summary['max_value'] = max_value
+        summary['value_histogram'] = histogram(values, min_value, max_value,
+                                               bins)
+    return summary
+
+
+@adapter(IBTree, tuple, None)
+@implementer(IStateInterpreter)
+class BTreeState(object):
+    """Non-empty BTrees have a complicated tuple structure.
+
+    Works for all the BTree families (OO, IO, OI, II, LL, fs, ...).
+    """
+
+    pairs = True
+
+    def __init__(self, type, state, tid):
+        # Buckets are loaded only when somebody looks at the items
+        self._items = BTreeItems(state, tid, self.pairs)
 
     def getError(self):
         return None
@@ -159,10 +639,28 @@ class OOBTreeState(object):
         return dict(self._items)
 
 
-@adapter(OOBTree, type(None), None)
+@adapter(IBTree, type(None), None)
+@implementer(IStateInterpreter)
+class EmptyBTreeState(BTreeState):
+    """Empty BTrees pickle to None."""
+
+
+@adapter(ITreeSet, tuple, None)
 @implementer(IStateInterpreter)
-class EmptyOOBTreeState(OOBTreeState):
-    """Empty OOBTrees pickle to None."""
+class TreeSetState(BTreeState):
+    """TreeSets have no values; their items are (key, key) pairs."""
+
+    pairs = False
+
+
+@adapter(ITreeSet, type(None), None)
+@implementer(IStateInterpreter)
+class EmptyTreeSetState(TreeSetState):
+    """Empty TreeSets pickle to None."""
+
+
+OOBTreeState = BTreeState  # BBB
+EmptyOOBTreeState = EmptyBTreeState  # BBB
 
 
 @adapter(Folder, dict, None)
@@ -174,7 +672,7 @@ class FolderState(GenericState):
         if not data:
             return []
         # data will be an OOBTree
-        loadedstate = IObjectHistory(data).loadState(self.tid)
+        loadedstate = getObjectHistory(data).loadState(self.tid)
         return getMultiAdapter((data, loadedstate, self.tid),
                                IStateInterpreter).listItems()
 
@@ -190,15 +688,15 @@ class BTreeContainerState(GenericState):
         if not data:
             return []
         # data will be an OOBTree
-        loadedstate = IObjectHistory(data).loadState(self.tid)
+        loadedstate = getObjectHistory(data).loadState(self.tid)
         return getMultiAdapter((data, loadedstate, self.tid),
                                IStateInterpreter).listItems()
 
 
-@adapter(OOBucket, tuple, None)
+@adapter(IMinimalDictionary, tuple, None)
 @implementer(IStateInterpreter)
-class OOBucketState(GenericState):
-    """A single OOBTree bucket, should you wish to look at the internals
+class BucketState(GenericState):
+    """A single BTree bucket, should you wish to look at the internals
 
     Here's the state description direct from BTrees/BucketTemplate.c::
 
@@ -243,3 +741,18 @@ class OOBucketState(GenericState):
     def asDict(self):
         return dict(self.listAttributes(), _items=dict(self.listItems()))
 
+
+@adapter(ISet, tuple, None)
+@implementer(IStateInterpreter)
+class SetState(BucketState):
+    """A Set, which is also a bucket of a TreeSet.
+
+    Its items are (key, key) pairs, like the items of a TreeSet.
+    """
+
+    def listItems(self):
+        return zip(self.state[0], self.state[0])
+
+
+OOBucketState = BucketState  # BBB
+
@@ -2,15 +2,316 @@
 Ad-hoc caching, because uncached zodbbrowser is slow and sad.
 """
 
+import bisect
+import collections
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
 import time
 import weakref
+from array import array
 from contextlib import contextmanager
 
+from ZODB.FileStorage.FileStorage import FileIterator, FileStorage
+from ZODB.utils import p64, u64
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+
+log = logging.getLogger(__name__)
+
 
 MINUTES = 60
 HOURS = 60 * MINUTES
 
+MB = 1024 * 1024
+
 STORAGE_TIDS = weakref.WeakKeyDictionary()
+TRANSACTION_CACHES = weakref.WeakKeyDictionary()
+STATE_CACHES = weakref.WeakKeyDictionary()
+BTREE_HISTORIES = weakref.WeakKeyDictionary()
+
+# Historical object records never change once written, so they can be
+# cached for as long as we like.  Pickles are cheap to keep around and can
+# be shared by all connections; unpickled state refers to persistent objects
+# of a particular connection, so it's cached per connection.
+PICKLE_CACHE_SIZE = 32 * MB
+STATE_CACHE_SIZE = 1000  # objects per connection; 0 disables the cache
+
+# The transaction index of a FileStorage is kept in a sidecar file next to
+# the Data.fs.  It starts with a header (magic, tid of the first transaction)
+# and then has one record (tid, file offset) for every transaction.  New
+# records are only ever appended.
+TRANSACTION_INDEX_SUFFIX = '.zodbbrowser-tids'
+TRANSACTION_INDEX_MAGIC = b'ZBTIDX01'
+TRANSACTION_INDEX_HEADER = struct.Struct('>8s8s')
+TRANSACTION_INDEX_RECORD = struct.Struct('>8sQ')
+
+# tid, length -- the beginning of every FileStorage transaction header
+TRANSACTION_HEADER = struct.Struct('>8sQ')
+
+
+class TidList(object):
+    """A compact list of transaction IDs.
+
+    Stores tids as packed 64-bit integers instead of a Python list of 8-byte
+    strings, which takes about five times less memory.  Supports the
+    subset of the list interface that zodbbrowser needs.
+    """
+
+    def __init__(self, tids=()):
+        self._array = array('Q')
+        self.extend(tids)
+
+    @classmethod
+    def fromArray(cls, a):
+        tids = cls()
+        tids._array = a
+        return tids
+
+    def __len__(self):
+        return len(self._array)
+
+    def __iter__(self):
+        return map(p64, self._array)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.fromArray(self._array[index])
+        return p64(self._array[index])
+
+    def __eq__(self, other):
+        if isinstance(other, TidList):
+            return self._array == other._array
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def append(self, tid):
+        self._array.append(u64(tid))
+
+    def extend(self, tids):
+        self._array.extend(map(u64, tids))
+
+    def index(self, tid):
+        return self._array.index(u64(tid))
+
+    def bisect(self, tid):
+        """Locate the insertion point for tid, assuming the list is sorted.
+
+        Returns the index after any existing entries equal to tid, just
+        like bisect.bisect_right().
+        """
+        return bisect.bisect_right(self._array, u64(tid))
+
+
+class LRUCache(object):
+    """A thread-safe mapping that forgets the least recently used items.
+
+    The total size of all the values is kept below ``max_size``.  The size
+    of a value is computed by ``sizeof``; by default every value counts as 1.
+    Values bigger than ``max_size`` are not cached at all.
+
+    Counts cache hits and misses in ``get()``, for tuning the size.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = value, size
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+PICKLE_CACHE = LRUCache(PICKLE_CACHE_SIZE, sizeof=len)
+
+
+def _pickleKey(connection, oid, tid):
+    # connection._storage is a per-connection MVCC adapter, so use the
+    # storage of the database for the cache key
+    return weakref.ref(connection.db().storage), oid, tid
+
+
+def loadSerial(connection, oid, tid):
+    """Load the pickle of an object revision, caching it.
+
+    Like connection._storage.loadSerial(oid, tid), but the cache is shared
+    by all connections to the same database.
+    """
+    key = _pickleKey(connection, oid, tid)
+    data = PICKLE_CACHE.get(key)
+    if data is None:
+        data = _loadSerial(connection, oid, tid)
+        PICKLE_CACHE.put(key, data)
+    return data
+
+
+def _loadSerial(connection, oid, tid):
+    storage = connection.db().storage
+    if hasattr(storage, 'prefetch'):
+        # ZEO's loadSerial() always asks the server, but loadBefore() is
+        # answered from the client cache, which is what prefetch() fills
+        try:
+            result = storage.loadBefore(oid, p64(u64(tid) + 1))
+        except KeyError:
+            result = None
+        if result is not None and result[1] == tid:
+            return result[0]
+    return connection._storage.loadSerial(oid, tid)
+
+
+def rememberPickle(connection, oid, tid, data):
+    """Cache the pickle of an object revision that we already have.
+
+    Transaction iterators hand us the data of every record, and it would
+    be a pity to ask the storage for it again when rendering.
+    """
+    if data:
+        PICKLE_CACHE.put(_pickleKey(connection, oid, tid), data)
+
+
+def prefetch(connection, records):
+    """Ask the storage to start loading object records we'll need soon.
+
+    ``records`` is a sequence of (oid, tid) pairs; an object is loaded as
+    it was right after transaction tid, or as the connection sees it now
+    if tid is None.
+
+    Only storages that can prefetch (i.e. ZEO) do anything here.  The
+    requests for all the records are sent without waiting for the replies,
+    so a page that needs N objects waits for about one network round-trip
+    instead of N.  Returns the number of records requested.
+    """
+    storage = connection.db().storage
+    if not hasattr(storage, 'prefetch'):
+        return 0
+    by_tid = {}
+    for oid, tid in records:
+        if oid is None:
+            continue
+        # a dict is an ordered set
+        by_tid.setdefault(tid, {})[oid] = None
+    count = 0
+    try:
+        for tid, oids in by_tid.items():
+            oids = list(oids)
+            if tid is None:
+                connection.prefetch(oids)
+            else:
+                storage.prefetch(oids, p64(u64(tid) + 1))
+            count += len(oids)
+    except Exception as e:
+        # it's only a hint, so don't break the page
+        log.debug('Prefetching failed: %s: %s', e.__class__.__name__, e)
+    return count
+
+
+def loadState(connection, oid, tid):
+    """Load and unpickle the state of an object revision, caching it.
+
+    Like connection.oldstate(obj, tid).  The state is shared, so callers
+    must not modify anything inside it, but they get a fresh copy of the
+    top-level dicts, because some __setstate__ methods modify those.
+    """
+    states = STATE_CACHES.get(connection)
+    if states is None:
+        states = STATE_CACHES[connection] = LRUCache(STATE_CACHE_SIZE)
+    key = oid, tid
+    state = states.get(key, states)
+    if state is states:
+        state = connection._reader.getState(loadSerial(connection, oid, tid))
+        states.put(key, state)
+    return copyState(state)
+
+
+def copyState(state):
+    """Make a shallow copy of the dicts in an unpickled object state.
+
+    Handles the two common state formats: a dict, and a (dict, slots)
+    tuple.  Returns anything else unchanged.
+    """
+    if isinstance(state, dict):
+        return dict(state)
+    if (isinstance(state, tuple) and len(state) == 2
+            and all(isinstance(d, (dict, type(None))) for d in state)):
+        return tuple(d if d is None else dict(d) for d in state)
+    return state
+
+
+def getBTreeHistoryCache(connection, oid):
+    """Return a dict for caching the merged history of a BTree.
+
+    Like loadSerial(), the cache is shared by all connections to the same
+    database.  The dict has a 'lock' that should be held while using it.
+    """
+    histories = BTREE_HISTORIES.setdefault(connection.db().storage, {})
+    return histories.setdefault(oid, {'lock': threading.Lock()})
+
+
+def getFirstTid(storage):
+    """Return the tid of the first transaction in the storage.
+
+    Returns None if the storage is empty or doesn't support iteration.
+    The first transaction changes when the database is packed.
+    """
+    if not hasattr(storage, 'iterator'):
+        return None
+    with maybe_closing(storage.iterator()) as it:
+        for txn in it:
+            return txn.tid
+    return None
 
 
 def expired(cache_dict, cache_for):
@@ -27,34 +328,319 @@ def maybe_closing(thing):
         thing.close()
 
 
+def getTransactionCache(connection, name):
+    """Return a dict for caching things until the current transaction ends.
+
+    Every name gets a separate dict.  Returns a new empty dict every time
+    if the connection isn't open.
+    """
+    try:
+        txn = connection.transaction_manager.get()
+    except Exception:
+        # closed connection (no transaction manager), or an explicit
+        # transaction manager outside a transaction
+        return {}
+    ref, caches = TRANSACTION_CACHES.get(connection, (None, None))
+    if ref is None or ref() is not txn:
+        ref, caches = weakref.ref(txn), {}
+        TRANSACTION_CACHES[connection] = ref, caches
+    return caches.setdefault(name, {})
+
+
+def getStorageFilename(storage):
+    """Return the Data.fs filename of a FileStorage, or None."""
+    if isinstance(storage, FileStorage):
+        return storage._file_name
+    return None
+
+
+def getSidecarIndex(storage, registry, suffix, load, cache_for=MINUTES):
+    """Return an index that was saved in a file next to the Data.fs.
+
+    ``load`` is called with the filename and should return the index
+    (or None if the file is damaged).  The index is kept in ``registry``,
+    a WeakKeyDictionary, and reloaded if the file changes.  Checks for
+    changes at most once every ``cache_for`` seconds.
+
+    Returns None if the storage is not a FileStorage or there's no
+    such file.
+    """
+    cache_dict = registry.setdefault(storage, {})
+    if expired(cache_dict, cache_for):
+        cache_dict['last_update'] = time.time()
+        filename = getStorageFilename(storage)
+        if filename is not None:
+            filename += suffix
+            try:
+                mtime = os.path.getmtime(filename)
+            except OSError:
+                mtime = None
+            if mtime != cache_dict.get('mtime'):
+                cache_dict['mtime'] = mtime
+                cache_dict['index'] = (load(filename)
+                                       if mtime is not None else None)
+    return cache_dict.get('index')
+
+
 def getStorageTids(storage, cache_for=5 * MINUTES):
+    return getStorageTransactions(storage, cache_for)[0]
+
+
+def getStorageTransactions(storage, cache_for=5 * MINUTES):
+    """Return the tids of all transactions and their file offsets.
+
+    Returns a tuple (tids, offsets); offsets is None if the storage is not
+    a FileStorage.  The two are replaced together when the database is
+    packed, so callers that need both should get them from one call.
+    """
     cache_dict = STORAGE_TIDS.setdefault(storage, {})
+    if ('transactions' in cache_dict
+            and cache_dict.get('refresher') is not None):
+        # a TidRefresher thread keeps it up to date, no need to block
+        return cache_dict['transactions']
     if expired(cache_dict, cache_for):
-        if cache_dict.get('tids'):
-            first = cache_dict['tids'][0]
-            last = cache_dict['tids'][-1]
-            try:
-                with maybe_closing(storage.iterator()) as it:
-                    first_record = next(it)
-            except StopIteration:  # pragma: nocover
-                # I don't think this is possible -- a database always
-                # has at least one transaction.  But, hey, maybe somebody
-                # truncated the file or something?
-                first_record = None
-            if first_record and first_record.tid == first:
-                # okay, look for new transactions appended at the end
-                with maybe_closing(storage.iterator(start=last)) as it:
-                    new = [t.tid for t in it]
-                if new and new[0] == last:
-                    del new[0]
-                cache_dict['tids'].extend(new)
+        refreshStorageTids(storage, cache_dict, cache_for)
+    return cache_dict['transactions']
+
+
+def refreshStorageTids(storage, cache_dict, cache_for=-1):
+    lock = cache_dict.setdefault('lock', threading.Lock())
+    with lock:
+        # somebody else might have refreshed it while we waited for the lock
+        if expired(cache_dict, cache_for):
+            filename = getStorageFilename(storage)
+            if filename:
+                updateTransactionIndex(cache_dict, filename)
             else:
-                # first record changed, we must've packed the DB
-                with maybe_closing(storage.iterator()) as it:
-                    cache_dict['tids'] = [t.tid for t in it]
+                updateStorageTids(cache_dict, storage)
+            cache_dict['last_update'] = time.time()
+
+
+def getStorageTidOffsets(storage):
+    """Return file offsets of the transactions listed by getStorageTids().
+
+    Returns None if the storage is not a FileStorage, or if getStorageTids()
+    wasn't called yet.
+    """
+    return STORAGE_TIDS.get(storage, {}).get('transactions', (None, None))[1]
+
+
+def updateStorageTids(cache_dict, storage):
+    tids = cache_dict.get('transactions', (None, None))[0]
+    if tids:
+        first = tids[0]
+        last = tids[-1]
+        try:
+            with maybe_closing(storage.iterator()) as it:
+                first_record = next(it)
+        except StopIteration:  # pragma: nocover
+            # I don't think this is possible -- a database always
+            # has at least one transaction.  But, hey, maybe somebody
+            # truncated the file or something?
+            first_record = None
+        if first_record and first_record.tid == first:
+            # okay, look for new transactions appended at the end
+            with maybe_closing(storage.iterator(start=last)) as it:
+                new = [t.tid for t in it]
+            if new and new[0] == last:
+                del new[0]
+            tids.extend(new)
         else:
+            # first record changed, we must've packed the DB
             with maybe_closing(storage.iterator()) as it:
-                cache_dict['tids'] = [t.tid for t in it]
-        cache_dict['last_update'] = time.time()
-    return cache_dict['tids']
+                tids = TidList(t.tid for t in it)
+    else:
+        with maybe_closing(storage.iterator()) as it:
+            tids = TidList(t.tid for t in it)
+    cache_dict['transactions'] = tids, None
+
+
+def updateTransactionIndex(cache_dict, filename):
+    """Bring the transaction index of a FileStorage up to date.
+
+    Reads the sidecar index file on first use, then scans only the
+    transactions appended to the Data.fs after the last indexed one.
+    """
+    index_filename = filename + TRANSACTION_INDEX_SUFFIX
+    if 'transactions' not in cache_dict:
+        tids, offsets = loadTransactionIndex(index_filename)
+    else:
+        tids, offsets = cache_dict['transactions']
+    with open(filename, 'rb') as f:
+        pos = findIndexEnd(f, tids, offsets)
+    if pos is None:
+        # the file was packed (or replaced, or truncated)
+        tids, offsets = TidList(), array('Q')
+        pos = 4
+    with maybe_closing(FileIterator(filename, pos=pos)) as it:
+        new = [(t.tid, t._tpos) for t in it]
+    if new:
+        n_old = len(tids)
+        # offsets first: readers may be using these very lists, and an
+        # offset without a tid is harmless, unlike a tid without an offset
+        offsets.extend(offset for tid, offset in new)
+        tids.extend(tid for tid, offset in new)
+        saveTransactionIndex(index_filename, tids, offsets, n_old)
+    with open(filename, 'rb') as f:
+        # not the size of the file: a transaction that is still being
+        # committed isn't indexed yet, so TidRefresher has to come back
+        cache_dict['file_size'] = findIndexEnd(f, tids, offsets)
+    # a single assignment, so nobody sees new tids with old offsets
+    cache_dict['transactions'] = tids, offsets
+
+
+def findIndexEnd(f, tids, offsets):
+    """Find where the next unindexed transaction starts in a Data.fs.
+
+    Returns None if the index doesn't match the file.
+    """
+    if not tids:
+        return 4
+    f.seek(4)
+    if f.read(8) != tids[0]:
+        return None
+    f.seek(offsets[-1])
+    data = f.read(TRANSACTION_HEADER.size)
+    if len(data) < TRANSACTION_HEADER.size:
+        return None
+    tid, length = TRANSACTION_HEADER.unpack(data)
+    end = offsets[-1] + length + 8
+    if tid != tids[-1] or end > os.fstat(f.fileno()).st_size:
+        return None
+    return end
+
+
+def loadTransactionIndex(index_filename):
+    """Load a transaction index sidecar file.
+
+    Returns a TidList and an array of file offsets.  Both will be empty if
+    the index doesn't exist or is damaged.
+    """
+    empty = TidList(), array('Q')
+    records = array('Q')
+    try:
+        with open(index_filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < TRANSACTION_INDEX_HEADER.size:
+                return empty
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, first = TRANSACTION_INDEX_HEADER.unpack_from(m)
+                if magic != TRANSACTION_INDEX_MAGIC:
+                    log.warning('Ignoring %s: bad magic', index_filename)
+                    return empty
+                start = TRANSACTION_INDEX_HEADER.size
+                # ignore a partially written record at the end, if any
+                end = size - (size - start) % TRANSACTION_INDEX_RECORD.size
+                records.frombytes(m[start:end])
+    except (IOError, OSError, ValueError):
+        return empty
+    if sys.byteorder == 'little':
+        records.byteswap()
+    # records are (tid, offset) pairs
+    tid_array = records[0::2]
+    if any(a >= b for a, b in zip(tid_array, tid_array[1:])):
+        # tids must strictly increase; this one was garbled by concurrent
+        # writers (on platforms without flock)
+        log.warning('Ignoring %s: tids out of order', index_filename)
+        return empty
+    tids = TidList.fromArray(tid_array)
+    offsets = records[1::2]
+    if tids and tids[0] != first:
+        return empty
+    return tids, offsets
+
+
+def saveTransactionIndex(index_filename, tids, offsets, n_old=0):
+    """Write a transaction index sidecar file.
+
+    Appends just the records past ``n_old`` if the file on disk has exactly
+    ``n_old`` records, otherwise rewrites the whole file.
+
+    Failures are logged and otherwise ignored: the index is an optimization,
+    and the directory containing the Data.fs may well be read-only.
+    """
+    header_size = TRANSACTION_INDEX_HEADER.size
+    try:
+        # 'ab' so we don't truncate the file before we hold the lock
+        with open(index_filename, 'ab') as f:
+            if fcntl is not None:
+                # other processes may be updating the same index
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            size = os.fstat(f.fileno()).st_size
+            if n_old and size == header_size + n_old * TRANSACTION_INDEX_RECORD.size:
+                start = n_old
+            else:
+                start = 0
+                f.truncate(0)
+                f.write(TRANSACTION_INDEX_HEADER.pack(TRANSACTION_INDEX_MAGIC,
+                                                      tids[0]))
+            f.write(b''.join(TRANSACTION_INDEX_RECORD.pack(tid, offset)
+                             for tid, offset in zip(tids[start:],
+                                                    offsets[start:])))
+    except (IOError, OSError) as e:
+        log.debug('Could not save transaction index %s: %s',
+                  index_filename, e)
+
+
+class TidRefresher(threading.Thread):
+    """Background thread that keeps getStorageTids() up to date.
+
+    Polls the storage every few seconds and scans any new transactions, so
+    that request threads never have to wait for it.
+    """
+
+    daemon = True
+
+    def __init__(self, storage, interval=5):
+        super(TidRefresher, self).__init__(name='zodbbrowser-tid-refresher')
+        self.storage = storage
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        self.refresh()
+        while not self._stopping.wait(self.interval):
+            self.refresh()
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def needsRefresh(self, cache_dict):
+        tids = cache_dict.get('transactions', (None, None))[0]
+        if not tids:
+            return True
+        filename = getStorageFilename(self.storage)
+        if filename:
+            # FileStorage opened read-only doesn't notice transactions
+            # committed by other processes, so look at the file instead
+            return os.path.getsize(filename) != cache_dict.get('file_size')
+        return self.storage.lastTransaction() != tids[-1]
+
+    def refresh(self):
+        cache_dict = STORAGE_TIDS.setdefault(self.storage, {})
+        try:
+            if self.needsRefresh(cache_dict):
+                refreshStorageTids(self.storage, cache_dict)
+        except Exception:
+            log.exception('Failed to refresh the transaction list')
+
+
+def startTidRefresher(storage, interval=5):
+    """Start a TidRefresher for the storage.
+
+    From now on getStorageTids(storage) will never block, once the initial
+    list of transactions is loaded.
+    """
+    refresher = TidRefresher(storage, interval)
+    STORAGE_TIDS.setdefault(storage, {})['refresher'] = refresher
+    refresher.start()
+    return refresher
+
 
+def stopTidRefresher(storage):
+    """Stop the TidRefresher started for the storage, if any."""
+    refresher = STORAGE_TIDS.get(storage, {}).pop('refresher', None)
+    if refresher is not None:
+        refresher.stop()
@@ -28,6 +28,7 @@ from zope.testbrowser.browser import HTTPError
 from zope.testbrowser.interfaces import IBrowser
 from zope.testing.renormalizing import RENormalizing
 
+from zodbbrowser.browser import shutdownRenderPool
 from zodbbrowser.compat import StringIO, basestring, escape
 from zodbbrowser.standalone import close_database, main
 from zodbbrowser.value import resetTruncations
@@ -380,6 +381,11 @@ def setUp(test):
     test.globs['url'] = TestsWithServer.url
 
 
+def tearDown(test):
+    # the rendering threads outlive requests
+    shutdownRenderPool()
+
+
 def test_suite():
     this = sys.modules[__name__]
     suite = unittest.defaultTestLoader.loadTestsFromModule(this)
@@ -415,6 +421,7 @@ def test_suite():
     for filename in sorted(glob.glob(os.path.join(here, '*.txt'))):
         test = doctest.DocFileSuite(os.path.basename(filename),
                                     setUp=setUp,
+                                    tearDown=tearDown,
                                     checker=checker,
                                     optionflags=optionflags)
         test.layer = TestsWithServer
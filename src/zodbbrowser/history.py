@@ -1,4 +1,5 @@
 from persistent import Persistent
+from ZODB.FileStorage.FileStorage import FileIterator
 from ZODB.interfaces import IConnection, IStorageIteration
 from ZODB.utils import tid_repr
 from zope.component import adapter
@@ -20,22 +21,38 @@ except ImportError:  # pragma: no-cover
 @implementer(IObjectHistory)
 class ZodbObjectHistory(object):
 
+    # How many history records to load at first.  Objects that are modified
+    # very often can have hundreds of thousands of them, so we only load
+    # more (doubling the number every time) when somebody looks further back.
+    initial_size = 50
+
     def __init__(self, obj):
         self._obj = removeAllProxies(obj)
         self._connection = self._obj._p_jar
         self._storage = self._connection._storage
         self._oid = self._obj._p_oid
         self._history = None
+        self._complete = False
         self._by_tid = {}
 
     def __len__(self):
-        if self._history is None:
-            self._load()
+        self._loadAtLeast(None)
+        return len(self._history)
+
+    def knownLength(self):
+        """Return the number of history records, if all of them are loaded.
+
+        Returns None if finding out would require loading more records.
+        """
+        if self._history is None or not self._complete:
+            return None
         return len(self._history)
 
-    def _load(self):
+    def _load(self, size=None):
         """Load history of changes made to a Persistent object.
 
+        Loads the latest ``size`` records, or all of them if size is None.
+
         Returns a list of dictionaries, from latest revision to the oldest.
         The dicts have various interesting pieces of data, such as:
 
@@ -46,18 +63,45 @@ class ZodbObjectHistory(object):
 
         See the 'history' method of ZODB.interfaces.IStorage.
         """
-        size = 999999999999 # "all of it"; ought to be sufficient
+        if size is None:
+            size = 999999999999 # "all of it"; ought to be sufficient
         self._history = self._storage.history(self._oid, size=size)
+        self._complete = len(self._history) < size
         self._index_by_tid()
 
+    def _loadAtLeast(self, n):
+        """Make sure the latest n history records are loaded.
+
+        Loads all of them if n is None.
+        """
+        if self._history is not None and self._complete:
+            return
+        if n is None:
+            self._load()
+        elif self._history is None:
+            self._load(max(n, self.initial_size))
+        elif len(self._history) < n:
+            # storage.history() has no way to skip the records we already
+            # have, so grow geometrically to keep the total work linear
+            self._load(max(n, 2 * len(self._history)))
+
     def _index_by_tid(self):
         for record in self._history:
             self._by_tid[record['tid']] = record
 
     def __getitem__(self, item):
-        if self._history is None:
-            self._load()
-        d = dict(self._history[item])
+        if isinstance(item, slice):
+            start, stop = item.start or 0, item.stop
+            if stop is None or start < 0 or stop < 0:
+                self._loadAtLeast(None)
+            else:
+                self._loadAtLeast(stop)
+            return [self._record(d) for d in self._history[item]]
+        self._loadAtLeast(item + 1 if item >= 0 else None)
+        return self._record(self._history[item])
+
+    def _record(self, d):
+        d = dict(d)
         if isinstance(d['user_name'], bytes):
             d['user_name'] = d['user_name'].decode('UTF-8', 'replace')
         if isinstance(d['description'], bytes):
@@ -65,39 +109,64 @@ class ZodbObjectHistory(object):
         return d
 
     def lastChange(self, tid=None):
-        if self._history is None:
-            self._load()
+        self._loadAtLeast(1)
         if tid in self._by_tid:
             # optimization
             return tid
         # sadly ZODB has no API for get revision at or before tid, so
         # we have to find the exact tid
-        for record in self._history:
-            # we assume records are ordered by tid, newest to oldest
-            if tid is None or record['tid'] <= tid:
-                return record['tid']
+        n = 0
+        while True:
+            for record in self._history[n:]:
+                # we assume records are ordered by tid, newest to oldest
+                if tid is None or record['tid'] <= tid:
+                    return record['tid']
+            if self._complete:
+                break
+            n = len(self._history)
+            self._loadAtLeast(n + 1)
         raise KeyError('%r did not exist in or before transaction %r' %
                        (self._obj, tid_repr(tid)))
 
     def loadStatePickle(self, tid=None):
-        return self._connection._storage.loadSerial(self._obj._p_oid,
-                                                    self.lastChange(tid))
+        return cache.loadSerial(self._connection, self._oid,
+                                self.lastChange(tid))
 
     def loadState(self, tid=None):
-        return self._connection.oldstate(self._obj, self.lastChange(tid))
+        return cache.loadState(self._connection, self._oid,
+                               self.lastChange(tid))
 
     def canRollback(self):
         return True
 
     def rollback(self, tid):
-        state = self.loadState(tid)
+        # don't use the shared cached state: __setstate__ would let later
+        # modifications of the object leak into it
+        state = self._connection.oldstate(self._obj, self.lastChange(tid))
         if state != self.loadState():
             self._obj.__setstate__(state)
             self._obj._p_changed = True
 
 
 def getObjectHistory(obj):
+    """Return the IObjectHistory of a persistent object.
+
+    Adapters are cached until the end of the current transaction, so
+    looking at the same object several times while rendering a page
+    doesn't have to reload its history every time.
+    """
     assert isinstance(obj, Persistent)
+    obj = removeAllProxies(obj)
+    if obj._p_jar is None or obj._p_oid is None:
+        return _newObjectHistory(obj)
+    histories = cache.getTransactionCache(obj._p_jar, 'histories')
+    history = histories.get(obj._p_oid)
+    if getattr(history, '_obj', None) is not obj:
+        history = histories[obj._p_oid] = _newObjectHistory(obj)
+    return history
+
+
+def _newObjectHistory(obj):
     history = IObjectHistory(obj, None)
     if history is None:
         # See LP: #1185175
@@ -112,16 +181,27 @@ class ZodbHistory(object):
     def __init__(self, connection):
         self._connection = connection
         self._storage = IStorageIteration(connection._storage)
-        self._tids = cache.getStorageTids(self._storage)
+        self._tids, self._offsets = cache.getStorageTransactions(
+            self._storage)
         self._iterators = []
 
     @property
     def tids(self):
-        return tuple(self._tids) # readonlify
+        return self._tids[:] # readonlify
 
     def __len__(self):
         return len(self._tids)
 
+    def findTransaction(self, tid):
+        """Return the index of the last transaction at or before tid.
+
+        Raises ValueError if there are no transactions at or before tid.
+        """
+        pos = self._tids.bisect(tid)
+        if pos == 0:
+            raise ValueError('no transactions at or before %s' % tid_repr(tid))
+        return pos - 1
+
     def _addcleanup(self, it):
         self._iterators.append(it)
         return it
@@ -135,16 +215,30 @@ class ZodbHistory(object):
     def __iter__(self):
         return self._addcleanup(self._storage.iterator())
 
+    def _iterator(self, index, stop):
+        """Iterate over transactions from self._tids[index] to stop."""
+        start = self._tids[index]
+        if self._offsets is not None and index < len(self._offsets):
+            # FileStorage.iterator() would have to look for the start tid,
+            # but we know exactly where in the file it is.
+            return self._addcleanup(FileIterator(
+                self._storage._file_name, start, stop,
+                pos=self._offsets[index]))
+        return self._addcleanup(self._storage.iterator(start, stop))
+
     def __getitem__(self, index):
         if isinstance(index, slice):
             assert index.step is None or index.step == 1
-            tids = self._tids[index]
-            if not tids:
+            indices = range(*index.indices(len(self._tids)))
+            if not indices:
                 return []
-            return self._addcleanup(self._storage.iterator(tids[0], tids[-1]))
+            return self._iterator(indices[0], self._tids[indices[-1]])
         else:
-            tid = self._tids[index]
-            return next(self._addcleanup(self._storage.iterator(tid, tid)))
+            if index < 0:
+                index += len(self._tids)
+            if not 0 <= index < len(self._tids):
+                raise IndexError(index)
+            return next(self._iterator(index, self._tids[index]))
 
 
 @adapter(MVCCAdapterInstance)
@@ -67,6 +67,12 @@ class IDatabaseHistory(Interface):
         Each record provides ZODB.interfaces.an IStorageTransactionInformation.
         """
 
+    def findTransaction(tid):
+        """Return the index of the last transaction at or before tid.
+
+        Raises ValueError if there are no transactions at or before tid.
+        """
+
     def cleanup():
         """Clean up all resources that may be left over.
 
@@ -117,6 +123,9 @@ class IStateInterpreter(Interface):
         Often these are not stored directly, but extracted from an attribute
         and presented as items for convenience.
 
+        Need not return an actual list: a lazy sequence that loads items
+        only when asked for them (e.g. from a very large BTree) is fine.
+
         May return None to indicate that this kind of object is not a
         container and cannot store items.
         """
@@ -135,3 +144,28 @@ class IStateInterpreter(Interface):
         while looking for changes.
         """
 
+
+class IDatabaseAnalysis(Interface):
+    """A whole-database analysis that can be run by zodbbrowser.scanner.
+
+    The scanner splits the database into ranges of oids, folds the current
+    records of every range into a partial result with map(), and then
+    combines the partial results with reduce().  Ranges may be scanned in
+    different processes, so analyses (and their results) must be picklable.
+    """
+
+    def initial():
+        """Return an empty partial result."""
+
+    def map(result, oid, data):
+        """Add a record to a partial result.
+
+        ``oid`` is the object ID (an 8-byte string) and ``data`` is the
+        pickle of the current state of the object.
+
+        Returns the new partial result (which may be the same object,
+        modified in place).
+        """
+
+    def reduce(result, other):
+        """Combine two partial results and return the combined result."""
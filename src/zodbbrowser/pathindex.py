@@ -0,0 +1,245 @@
+"""
+An index of object paths, so we can tell where an object lives with a
+single lookup instead of following __parent__ pointers through the state
+of every one of its ancestors.
+
+The index is built by crawling the containment tree from the root, looking
+at the items of every object (as listed by IStateInterpreter adapters), and
+is saved in a sidecar file next to the Data.fs.  It's a snapshot of the
+database at the time it was built; run ``zodbbrowser --build-path-index``
+again to refresh it.
+"""
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import weakref
+
+from persistent import Persistent
+from ZODB.utils import u64
+from zope.app.publication.zopepublication import ZopePublication
+
+from zodbbrowser import cache
+from zodbbrowser.state import ZodbObjectState
+
+
+log = logging.getLogger(__name__)
+
+
+PATH_INDEXES = weakref.WeakKeyDictionary()
+
+# The path index file starts with a header (magic, tid of the last
+# transaction when the index was built, root oid, number of records), then
+# has one record (oid, parent oid, offset of the name) for every object,
+# sorted by oid, and then all the names, encoded in UTF-8.
+PATH_INDEX_SUFFIX = '.zodbbrowser-paths'
+PATH_INDEX_MAGIC = b'ZBPATH01'
+PATH_INDEX_HEADER = struct.Struct('>8s8sQQ')
+PATH_INDEX_RECORD = struct.Struct('>QQQ')
+
+# How many objects to look at in one transaction when crawling
+CRAWL_GC_INTERVAL = 1000
+
+
+def getRootObject(connection):
+    """Return the object that is shown as / in paths."""
+    root = connection.root()
+    try:
+        return root[ZopePublication.root_name]
+    except KeyError:
+        return root
+
+
+def formatName(name):
+    """Convert an item key into a path component."""
+    if isinstance(name, bytes):
+        return name.decode('UTF-8', 'replace')
+    if not isinstance(name, str):
+        return str(name)
+    return name
+
+
+def crawl(root, gc_interval=CRAWL_GC_INTERVAL):
+    """Find all objects reachable from root through their items.
+
+    Yields (oid, parent oid, name) for every object.  The crawl is
+    breadth-first, so an object that is reachable through more than
+    one path gets the shortest one.
+
+    Every ``gc_interval`` objects the transaction is aborted, which drops
+    the history adapters cached for it (see getObjectHistory), and the
+    connection cache is garbage collected, so that crawling a large
+    database doesn't run out of memory.  The queue keeps only oids.
+    """
+    jar = root._p_jar
+    seen = set([root._p_oid])
+    queue = collections.deque([root._p_oid])
+    count = 0
+    while queue:
+        oid = queue.popleft()
+        count += 1
+        if count % gc_interval == 0:
+            jar.transaction_manager.abort()
+            jar.cacheGC()
+        try:
+            items = ZodbObjectState(jar.get(oid)).listItems()
+            for name, value in items or ():
+                if (not isinstance(value, Persistent)
+                        or value._p_oid is None or value._p_oid in seen):
+                    continue
+                seen.add(value._p_oid)
+                queue.append(value._p_oid)
+                yield u64(value._p_oid), u64(oid), formatName(name)
+        except Exception as e:
+            log.warning('Could not list the items of 0x%x: %s: %s',
+                        u64(oid), e.__class__.__name__, e)
+
+
+class PathIndex(object):
+    """A read-only mapping of oids to their parent oids and names.
+
+    ``data`` is the contents of a path index file, usually an mmap.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        (magic, self.tid, self.root_oid,
+         self._count) = PATH_INDEX_HEADER.unpack_from(data)
+        if magic != PATH_INDEX_MAGIC:
+            raise ValueError('bad magic')
+        self._names_start = (PATH_INDEX_HEADER.size
+                             + self._count * PATH_INDEX_RECORD.size)
+        if self._names_start > len(data):
+            raise ValueError('truncated file')
+
+    @classmethod
+    def load(cls, filename):
+        """Load a path index file.
+
+        Returns None if the file doesn't exist or is damaged.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(data)
+        except (IOError, OSError, ValueError, struct.error) as e:
+            log.debug('Could not load path index %s: %s', filename, e)
+            return None
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, n):
+        return PATH_INDEX_RECORD.unpack_from(
+            self._data, PATH_INDEX_HEADER.size + n * PATH_INDEX_RECORD.size)
+
+    def _find(self, oid):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < oid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._record(lo)[0] == oid:
+            return lo
+        return None
+
+    def __contains__(self, oid):
+        return self._find(oid) is not None
+
+    def lookup(self, oid):
+        """Return (parent oid, name) of an object, or None."""
+        n = self._find(oid)
+        if n is None:
+            return None
+        oid, parent, start = self._record(n)
+        if n + 1 < self._count:
+            end = self._record(n + 1)[2]
+        else:
+            end = len(self._data) - self._names_start
+        name = self._data[self._names_start + start:self._names_start + end]
+        return parent, name.decode('UTF-8')
+
+    def getPath(self, oid):
+        """Return the path of an object as a list of (name, oid) tuples.
+
+        The format is the same as returned by zodbbrowser.browser.resolvePath.
+        Returns None if the object is not in the index.
+        """
+        if oid == self.root_oid:
+            return [('/', oid)]
+        path = []
+        seen = set()
+        while oid != self.root_oid:
+            found = self.lookup(oid)
+            if found is None or oid in seen:
+                if not path:
+                    return None
+                # shouldn't happen, unless the file is damaged
+                path.append(('/', None))
+                path.append(('...', None))
+                path.append(('/', None))
+                return path[::-1]
+            seen.add(oid)
+            parent, name = found
+            if path:
+                path.append(('/', None))
+            path.append((name, oid))
+            oid = parent
+        path.append(('/', self.root_oid))
+        return path[::-1]
+
+
+def savePathIndex(filename, records, tid, root_oid):
+    """Write a path index file.
+
+    ``records`` is a list of (oid, parent oid, name) tuples.
+    """
+    records = sorted(records)
+    names = [name.encode('UTF-8') for oid, parent, name in records]
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(PATH_INDEX_HEADER.pack(PATH_INDEX_MAGIC, tid, root_oid,
+                                       len(records)))
+        offset = 0
+        for (oid, parent, name), encoded in zip(records, names):
+            f.write(PATH_INDEX_RECORD.pack(oid, parent, offset))
+            offset += len(encoded)
+        f.write(b''.join(names))
+    # os.rename() refuses to overwrite an existing file on Windows
+    os.replace(tmp_filename, filename)
+
+
+def buildPathIndex(connection, filename=None):
+    """Crawl the database and save a path index.
+
+    Saves it next to the Data.fs, unless a filename is given.
+
+    Returns the number of objects in the index.
+    """
+    storage = connection.db().storage
+    if filename is None:
+        filename = cache.getStorageFilename(storage)
+        if filename is None:
+            raise ValueError('Path indexes are supported only for FileStorage')
+        filename += PATH_INDEX_SUFFIX
+    tid = storage.lastTransaction()
+    root = getRootObject(connection)
+    records = list(crawl(root))
+    savePathIndex(filename, records, tid, u64(root._p_oid))
+    return len(records)
+
+
+def getPathIndex(connection, cache_for=60):
+    """Return the PathIndex of the database, or None if there isn't one.
+
+    Checks for a new version of the index file at most once a minute.
+    """
+    if connection is None:
+        return None
+    return cache.getSidecarIndex(connection.db().storage, PATH_INDEXES,
+                                 PATH_INDEX_SUFFIX, PathIndex.load,
+                                 cache_for)
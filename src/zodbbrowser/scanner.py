@@ -0,0 +1,160 @@
+"""
+Whole-database scans, spread over several processes.
+
+An analysis (see IDatabaseAnalysis) is a map/reduce pair: the scanner splits
+the oid space of a FileStorage into ranges, every worker process opens its
+own read-only FileStorage (once) and folds the current records of its range with
+map(), and the partial results are then combined with reduce().
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.util
+
+from ZODB.FileStorage import FileStorage
+from ZODB.utils import p64, u64
+from zope.interface import implementer
+
+from zodbbrowser import cache
+from zodbbrowser.interfaces import IDatabaseAnalysis
+
+
+log = logging.getLogger(__name__)
+
+
+@implementer(IDatabaseAnalysis)
+class Analysis(object):
+    """Base class for analyses.
+
+    Subclasses define map(), and usually override initial() and reduce().
+    """
+
+    def initial(self):
+        return None
+
+    def reduce(self, result, other):
+        return result + other
+
+
+class CombinedAnalysis(Analysis):
+    """Run several analyses in a single scan.
+
+    The result is a list with the results of every analysis.
+    """
+
+    def __init__(self, *analyses):
+        self.analyses = analyses
+
+    def initial(self):
+        return [analysis.initial() for analysis in self.analyses]
+
+    def map(self, result, oid, data):
+        return [analysis.map(partial, oid, data)
+                for analysis, partial in zip(self.analyses, result)]
+
+    def reduce(self, result, other):
+        return [analysis.reduce(partial, their)
+                for analysis, partial, their
+                in zip(self.analyses, result, other)]
+
+
+def iterRecords(storage, start=None, stop=None):
+    """Iterate over the current records of objects in a storage.
+
+    Yields (oid, data) for every object with start <= oid < stop (oids are
+    integers here; None means no limit).
+    """
+    next = p64(start) if start is not None else None
+    while True:
+        try:
+            oid, tid, data, next = storage.record_iternext(next)
+        except ValueError:
+            # empty storage, or nothing at or after start
+            return
+        if stop is not None and u64(oid) >= stop:
+            return
+        if data:
+            yield oid, data
+        if next is None:
+            return
+
+
+def splitOids(storage, chunks):
+    """Split the oids of a FileStorage into at most ``chunks`` ranges.
+
+    Returns a list of (start, stop) tuples of integers.
+    """
+    index = storage._index
+    if not len(index):
+        return []
+    first = u64(index.minKey())
+    last = u64(index.maxKey()) + 1
+    size = max(1, -(-(last - first) // chunks))
+    return [(start, min(start + size, last))
+            for start in range(first, last, size)]
+
+
+def scanRange(storage, analysis, start=None, stop=None):
+    """Run an analysis over a range of oids in this process."""
+    result = analysis.initial()
+    for oid, data in iterRecords(storage, start, stop):
+        result = analysis.map(result, oid, data)
+    return result
+
+
+# The FileStorage of a worker process, opened by _initWorker()
+_worker_storage = None
+
+
+def _initWorker(filename):
+    global _worker_storage
+    _worker_storage = FileStorage(filename, read_only=True)
+    # multiprocessing runs these finalizers when a worker exits
+    multiprocessing.util.Finalize(None, _closeWorker, exitpriority=10)
+
+
+def _closeWorker():
+    global _worker_storage
+    if _worker_storage is not None:
+        _worker_storage.close()
+        _worker_storage = None
+
+
+def _scanRangeInWorker(args):
+    analysis, start, stop = args
+    return scanRange(_worker_storage, analysis, start, stop)
+
+
+def scan(storage, analysis, processes=1, chunks_per_process=4):
+    """Run an analysis over the current records of all objects.
+
+    With ``processes`` > 1 (or None, meaning one per CPU) the work is
+    spread over a multiprocessing pool; this needs a FileStorage, since
+    every worker opens the Data.fs on its own.  Other storages are
+    scanned in this process.
+    """
+    filename = cache.getStorageFilename(storage)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or filename is None:
+        return scanRange(storage, analysis)
+    ranges = splitOids(storage, processes * chunks_per_process)
+    log.debug('Scanning %d oid ranges with %d processes',
+              len(ranges), processes)
+    result = analysis.initial()
+    pool = multiprocessing.Pool(processes, initializer=_initWorker,
+                                initargs=(filename, ))
+    try:
+        for partial in pool.imap_unordered(
+                _scanRangeInWorker,
+                [(analysis, start, stop) for start, stop in ranges]):
+            result = analysis.reduce(result, partial)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        # let the workers exit cleanly, closing their storages
+        pool.close()
+    finally:
+        pool.join()
+    return result
@@ -17,17 +17,21 @@ import warnings
 
 import waitress
 import zope.app.component.hooks
+from persistent.TimeStamp import TimeStamp
 from ZEO.ClientStorage import ClientStorage
 from ZODB.DB import DB
 from ZODB.FileStorage.FileStorage import FileStorage
 from ZODB.interfaces import IDatabase
 from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import p64
 from zope.app.appsetup.appsetup import SystemConfigurationParticipation
 from zope.app.wsgi import WSGIPublisherApplication
 from zope.component import provideUtility, queryUtility
 from zope.event import notify
 from zope.exceptions import exceptionformatter
 
+from zodbbrowser import backrefs, browser, cache, pathindex, stats
+from zodbbrowser.browser import formatSize
 from zodbbrowser.state import install_provides_hack
 
 
@@ -37,6 +41,9 @@ except ImportError:
     faulthandler = None  # pragma: PY2
 
 
+log = logging.getLogger(__name__)
+
+
 class Options(object):
     db_filename = None
     zeo_address = None
@@ -47,6 +54,11 @@ class Options(object):
     verbose = True
     debug = False
     threads = 4
+    refresh_interval = 5  # seconds
+    build_path_index = False
+    build_backref_index = False
+    stats = False
+    jobs = None  # one per CPU
     features = ('standalone-zodbbrowser', ) # maybe 'devmode' too?
     site_definition = """
         <configure xmlns="http://namespaces.zope.org/zope"
@@ -145,8 +157,10 @@ def serve_forever(server):
 
 
 def close_database():
+    browser.shutdownRenderPool()
     db = queryUtility(IDatabase, '<target>')
     if db:
+        cache.stopTidRefresher(db.storage)
         db.close()
 
 
@@ -199,11 +213,29 @@ def parse_args(args=None):
     parser.add_option('--rw', action='store_false', dest='readonly',
                       default=True,
                       help='open the database read-write (default: read-only)')
+    parser.add_option('--build-path-index', action='store_true',
+                      default=False,
+                      help='find the paths of all objects, save them in'
+                      ' a file next to the database, and exit')
+    parser.add_option('--build-backref-index', action='store_true',
+                      default=False,
+                      help='find all references between objects, save them in'
+                      ' a file next to the database, and exit')
+    parser.add_option('--stats', action='store_true', default=False,
+                      help='print the number and size of objects of every'
+                      ' class, and exit')
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      help='number of processes to use when building indexes'
+                      ' or statistics (default: one per CPU)')
     opts, args = parser.parse_args(args)
 
     options = Options()
     options.verbose = opts.verbose
     options.debug = opts.debug
+    options.build_path_index = opts.build_path_index
+    options.build_backref_index = opts.build_backref_index
+    options.stats = opts.stats
+    options.jobs = opts.jobs
 
     if opts.listen:
         if ':' in opts.listen:
@@ -231,6 +263,12 @@ def parse_args(args=None):
     if opts.storage and not opts.zeo:
         parser.error('a ZEO storage was specified without ZEO connection')
 
+    if opts.build_path_index and not opts.db:
+        parser.error('path indexes can only be built for a FileStorage')
+
+    if opts.build_backref_index and not opts.db:
+        parser.error('backreference indexes can only be built for a FileStorage')
+
     if opts.db:
         options.db_filename = opts.db
     elif opts.zeo:
@@ -275,7 +313,55 @@ def open_db(options):
                                 wait_timeout=options.zeo_timeout,
                                 storage=options.zeo_storage,
                                 read_only=options.readonly)
-    return DB(storage)
+    # every request thread has a connection, and so does every thread
+    # that renders transaction records (see browser.getRenderPool)
+    return DB(storage, pool_size=2 * options.threads)
+
+
+def build_path_index(db):
+    install_provides_hack()
+    conn = db.open()
+    try:
+        count = pathindex.buildPathIndex(conn)
+    finally:
+        conn.close()
+    log.info('Saved the paths of %d objects', count)
+
+
+def build_backref_index(db, processes=None):
+    count = backrefs.buildBackrefIndex(db.storage, processes=processes)
+    log.info('Saved %d backreferences', count)
+
+
+def print_stats(db, processes=None, file=None):
+    if file is None:
+        file = sys.stdout
+    conn = db.open()
+    try:
+        result = stats.getCensus(conn, processes)
+    finally:
+        conn.close()
+    census = result['census']
+    print('%10s %10s %10s  %s' % ('objects', 'size', 'average', 'class'),
+          file=file)
+    for row in stats.summarizeCensus(census):
+        print('%10d %10s %10s  %s' % (row['count'], formatSize(row['size']),
+                                      formatSize(row['average']),
+                                      row['class_name']),
+              file=file)
+        for oid, size in row['largest']:
+            print('%32s  0x%x' % (formatSize(size), oid), file=file)
+    print('', file=file)
+    print('Largest objects:', file=file)
+    for size, oid, class_name in result['largest']:
+        print('%10s  0x%x  %s' % (formatSize(size), oid, class_name),
+              file=file)
+    print('', file=file)
+    print('Largest revisions:', file=file)
+    for size, oid, tid, class_name in result['largest_revisions']:
+        print('%10s  0x%x  %s  %s' % (formatSize(size), oid,
+                                      TimeStamp(p64(tid)), class_name),
+              file=file)
 
 
 def set_up_logging(options):
@@ -308,6 +394,24 @@ def main(args=None, start_serving=True):
 
     provideUtility(db, IDatabase, name='<target>')
 
+    if (options.build_path_index or options.build_backref_index
+            or options.stats):
+        try:
+            if options.build_path_index:
+                build_path_index(db)
+            if options.build_backref_index:
+                build_backref_index(db, options.jobs)
+            if options.stats:
+                print_stats(db, options.jobs)
+        finally:
+            db.close()
+        return None
+
+    if options.refresh_interval:
+        cache.startTidRefresher(db.storage, options.refresh_interval)
+
+    browser.setRenderThreads(options.threads)
+
     notify(zope.app.appsetup.interfaces.DatabaseOpened(internal_db))
 
     server = start_server(options, internal_db)
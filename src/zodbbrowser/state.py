@@ -29,7 +29,7 @@ except ImportError:
     from zope.app.container.contained import ContainedProxy # BBB
 
 from zodbbrowser.history import getObjectHistory
-from zodbbrowser.interfaces import IObjectHistory, IStateInterpreter
+from zodbbrowser.interfaces import IStateInterpreter
 
 
 log = logging.getLogger(__name__)
@@ -268,11 +268,11 @@ class OrderedContainerState(GenericState):
         container = OrderedContainer()
         container.__setstate__(self.state)
         if isinstance(container._data, PersistentDict):
-            old_data_state = IObjectHistory(container._data).loadState(self.tid)
+            old_data_state = getObjectHistory(container._data).loadState(self.tid)
             container._data = PersistentDict()
             container._data.__setstate__(old_data_state)
         if isinstance(container._order, PersistentList):
-            old_order_state = IObjectHistory(container._order).loadState(self.tid)
+            old_order_state = getObjectHistory(container._order).loadState(self.tid)
             container._order = PersistentList()
             container._order.__setstate__(old_order_state)
         return container.items()
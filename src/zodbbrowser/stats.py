@@ -0,0 +1,261 @@
+"""
+Database statistics: how many objects of every class there are, how much
+space they take, and which object records are the largest.
+
+The class of an object is read from the first pickle of its record (the one
+getDisassembledPickleData shows first), so the state is never unpickled.
+"""
+
+import heapq
+import threading
+import weakref
+
+from ZODB.utils import get_pickle_metadata, u64
+
+from zodbbrowser import cache, scanner
+from zodbbrowser.interfaces import IDatabaseHistory
+
+
+CENSUSES = weakref.WeakKeyDictionary()
+
+LARGEST_INSTANCES = 5
+LEADERBOARD_SIZE = 20
+
+
+def getClassName(data):
+    """Return the dotted name of the class of a pickled object."""
+    module, name = get_pickle_metadata(data)
+    if not module:
+        return name
+    return '%s.%s' % (module, name)
+
+
+def addRecord(census, oid, class_name, size, largest=LARGEST_INSTANCES):
+    """Count an object record in a census.
+
+    A census maps class names to dicts with the number of objects, their
+    total pickle size, and the ``largest`` biggest instances (as a dict of
+    oids to sizes).
+    """
+    stats = census.get(class_name)
+    if stats is None:
+        stats = census[class_name] = dict(count=0, size=0, largest={})
+    stats['count'] += 1
+    stats['size'] += size
+    stats['largest'][oid] = size
+    if len(stats['largest']) > largest:
+        smallest = min(stats['largest'], key=stats['largest'].get)
+        del stats['largest'][smallest]
+
+
+def removeRecord(census, oid, class_name, size):
+    """Forget about an object record that was counted by addRecord()."""
+    stats = census.get(class_name)
+    if stats is None:
+        return
+    stats['count'] -= 1
+    stats['size'] -= size
+    stats['largest'].pop(oid, None)
+    if stats['count'] <= 0:
+        del census[class_name]
+
+
+def mergeCensus(census, other, largest=LARGEST_INSTANCES):
+    """Add the numbers of another census to a census."""
+    for class_name, theirs in other.items():
+        stats = census.get(class_name)
+        if stats is None:
+            census[class_name] = theirs
+            continue
+        stats['count'] += theirs['count']
+        stats['size'] += theirs['size']
+        stats['largest'].update(theirs['largest'])
+        if len(stats['largest']) > largest:
+            stats['largest'] = dict(
+                sorted(stats['largest'].items(),
+                       key=lambda item: item[1], reverse=True)[:largest])
+    return census
+
+
+def copyCensus(census):
+    """Return a copy of a census that addRecord() etc. won't change."""
+    return dict((class_name, dict(stats, largest=dict(stats['largest'])))
+                for class_name, stats in census.items())
+
+
+class ClassCensus(scanner.Analysis):
+    """Count objects and their pickle sizes by class."""
+
+    def __init__(self, largest=LARGEST_INSTANCES):
+        self.largest = largest
+
+    def initial(self):
+        return {}
+
+    def map(self, result, oid, data):
+        addRecord(result, u64(oid), getClassName(data), len(data),
+                  self.largest)
+        return result
+
+    def reduce(self, result, other):
+        return mergeCensus(result, other, self.largest)
+
+
+def pushBounded(heap, item, size):
+    """Push an item to a heap that keeps only the ``size`` largest items."""
+    if len(heap) < size:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+class LargestRecords(scanner.Analysis):
+    """Find the largest current object records.
+
+    The result is a heap of (size, oid, class name) tuples.
+    """
+
+    def __init__(self, size=LEADERBOARD_SIZE):
+        self.size = size
+
+    def initial(self):
+        return []
+
+    def map(self, result, oid, data):
+        pushBounded(result, (len(data), u64(oid), getClassName(data)),
+                    self.size)
+        return result
+
+    def reduce(self, result, other):
+        for item in other:
+            pushBounded(result, item, self.size)
+        return result
+
+
+def addRevision(revisions, oid, tid, data, size=LEADERBOARD_SIZE):
+    """Add an object record to a heap of the largest revisions."""
+    pushBounded(revisions, (len(data), oid, tid, getClassName(data)), size)
+
+
+def findLargestRevisions(transactions, size=LEADERBOARD_SIZE):
+    """Find the largest object records in the given transactions.
+
+    Returns a heap of (size, oid, tid, class name) tuples.
+    """
+    revisions = []
+    for txn in transactions:
+        for record in txn:
+            if record.data:
+                addRevision(revisions, u64(record.oid), u64(txn.tid),
+                            record.data, size)
+    return revisions
+
+
+def replaceRecord(largest, oid, data, size=LEADERBOARD_SIZE):
+    """Update a heap of the largest current records for a new revision."""
+    if any(item[1] == oid for item in largest):
+        largest[:] = [item for item in largest if item[1] != oid]
+        heapq.heapify(largest)
+    if data:
+        pushBounded(largest, (len(data), oid, getClassName(data)), size)
+
+
+def updateCensus(cache_dict, connection):
+    """Bring a census up to date with new transactions.
+
+    Instead of scanning the whole database again, looks at the records of
+    the transactions committed since the census was taken, and subtracts
+    the previous revision of every changed object.
+
+    Objects that shrink or get deleted fall out of the lists of the largest
+    records, and their places stay empty until the next full scan.
+    """
+    storage = connection.db().storage
+    history = IDatabaseHistory(connection)
+    try:
+        tids = history.tids
+        start = history.findTransaction(cache_dict['tid']) + 1
+        census = cache_dict['census']
+        for txn in history[start:]:
+            for record in txn:
+                oid = u64(record.oid)
+                try:
+                    previous = storage.loadBefore(record.oid, txn.tid)
+                except KeyError:
+                    previous = None
+                if previous is not None and previous[0]:
+                    data = previous[0]
+                    removeRecord(census, oid, getClassName(data), len(data))
+                if record.data:
+                    addRecord(census, oid, getClassName(record.data),
+                              len(record.data))
+                    addRevision(cache_dict['largest_revisions'], oid,
+                                u64(txn.tid), record.data)
+                replaceRecord(cache_dict['largest'], oid, record.data)
+        if tids and tids[-1] > cache_dict['tid']:
+            cache_dict['tid'] = tids[-1]
+    finally:
+        history.cleanup()
+
+
+def getCensus(connection, processes=1):
+    """Return the class census of the database.
+
+    Returns a dict with the census (see addRecord), the heaps of the largest
+    current records and largest revisions, and the tid of the last
+    transaction it knows about.  The census is taken once with a full scan
+    (see zodbbrowser.scanner) and a pass over all transactions, and then
+    updated incrementally.
+    """
+    storage = connection.db().storage
+    cache_dict = CENSUSES.setdefault(storage, {})
+    lock = cache_dict.setdefault('lock', threading.Lock())
+    with lock:
+        first_tid = cache.getFirstTid(storage)
+        if 'census' in cache_dict and cache_dict['first_tid'] == first_tid:
+            updateCensus(cache_dict, connection)
+        else:
+            # never taken, or the database was packed
+            cache_dict['tid'] = storage.lastTransaction()
+            cache_dict['first_tid'] = first_tid
+            cache_dict['census'], cache_dict['largest'] = scanner.scan(
+                storage, scanner.CombinedAnalysis(ClassCensus(),
+                                                  LargestRecords()),
+                processes)
+            history = IDatabaseHistory(connection)
+            try:
+                cache_dict['largest_revisions'] = findLargestRevisions(
+                    history)
+            finally:
+                history.cleanup()
+        # a copy: other requests update the census under the lock
+        return dict(census=copyCensus(cache_dict['census']),
+                    largest=sorted(cache_dict['largest'], reverse=True),
+                    largest_revisions=sorted(cache_dict['largest_revisions'],
+                                             reverse=True),
+                    tid=cache_dict['tid'])
+
+
+def hasCensus(connection):
+    """Has a census of this database been taken already?"""
+    return 'census' in CENSUSES.get(connection.db().storage, {})
+
+
+def summarizeCensus(census):
+    """Return a list of dicts describing every class in a census.
+
+    The list is sorted by total size, largest first.  The largest instances
+    are listed as (oid, size) tuples, largest first.
+    """
+    rows = []
+    for class_name, stats in census.items():
+        rows.append(dict(
+            class_name=class_name,
+            count=stats['count'],
+            size=stats['size'],
+            average=stats['size'] / stats['count'] if stats['count'] else 0,
+            largest=sorted(stats['largest'].items(),
+                           key=lambda item: (-item[1], item[0])),
+        ))
+    rows.sort(key=lambda row: (-row['size'], row['class_name']))
+    return rows
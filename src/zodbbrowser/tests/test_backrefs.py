@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.utils import u64
+
+from zodbbrowser.backrefs import (
+    BACKREF_INDEX_SUFFIX,
+    BackrefIndex,
+    buildBackrefIndex,
+    getBackrefIndex,
+    saveBackrefIndex,
+    scanReferences,
+)
+from zodbbrowser.tests.realdb import RealDatabaseTest
+
+
+class TestBackrefIndexFile(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(prefix='test-zodbbrowser-')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.filename)
+        saveBackrefIndex(self.filename, [
+            (5, 1),
+            (3, 1),
+            (5, 7),
+            (5, 2),
+            (9, 3),
+        ], b'\0' * 8)
+
+    def test_load(self):
+        index = BackrefIndex.load(self.filename)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.tid, b'\0' * 8)
+
+    def test_save_replaces_existing_index(self):
+        with mock.patch('os.rename', side_effect=FileExistsError), \
+                mock.patch('os.replace', wraps=os.replace) as replace:
+            saveBackrefIndex(self.filename, [(5, 1)], b'\0' * 8)
+        replace.assert_called_once()
+        self.assertEqual(len(BackrefIndex.load(self.filename)), 1)
+
+    def test_getReferrers(self):
+        index = BackrefIndex.load(self.filename)
+        self.assertEqual(index.getReferrers(5), [1, 2, 7])
+        self.assertEqual(index.getReferrers(3), [1])
+        self.assertEqual(index.getReferrers(9), [3])
+        self.assertEqual(index.getReferrers(1), [])
+        self.assertEqual(index.getReferrers(4), [])
+        self.assertEqual(index.getReferrers(100), [])
+
+    def test_load_missing_file(self):
+        self.assertEqual(BackrefIndex.load(self.filename + '-nonexistent'),
+                         None)
+
+    def test_load_damaged_file(self):
+        with open(self.filename, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertEqual(BackrefIndex.load(self.filename), None)
+
+    def test_load_truncated_file(self):
+        with open(self.filename, 'r+b') as f:
+            f.truncate(40)
+        self.assertEqual(BackrefIndex.load(self.filename), None)
+
+
+class TestScanReferences(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+        self.root['a'] = PersistentMapping()
+        self.root['b'] = PersistentMapping()
+        self.root['a']['b'] = self.root['b']
+        self.root['a']['self'] = self.root['a']
+        transaction.commit()
+
+    def oid(self, obj):
+        return u64(obj._p_oid)
+
+    def test_scanReferences(self):
+        refs = sorted(scanReferences(self.storage))
+        self.assertEqual(refs, sorted([
+            (self.oid(self.root['a']), 0),
+            (self.oid(self.root['b']), 0),
+            (self.oid(self.root['b']), self.oid(self.root['a'])),
+        ]))
+
+    def test_scanReferences_errors_are_logged(self):
+        with mock.patch('zodbbrowser.backrefs.referencesf',
+                        side_effect=Exception('oops')):
+            with self.assertLogs('zodbbrowser.backrefs') as cm:
+                self.assertEqual(list(scanReferences(self.storage)), [])
+        self.assertEqual(len(cm.output), 3)
+
+    def test_buildBackrefIndex(self):
+        self.assertEqual(buildBackrefIndex(self.storage), 3)
+        index = BackrefIndex.load(self.db_filename + BACKREF_INDEX_SUFFIX)
+        self.assertEqual(index.tid, self.storage.lastTransaction())
+        self.assertEqual(index.getReferrers(self.oid(self.root['b'])),
+                         sorted([0, self.oid(self.root['a'])]))
+
+    def test_scanReferences_in_parallel(self):
+        self.assertEqual(sorted(scanReferences(self.storage, processes=2)),
+                         sorted(scanReferences(self.storage)))
+
+    def test_buildBackrefIndex_not_a_filestorage(self):
+        with self.assertRaises(ValueError):
+            buildBackrefIndex(mock.Mock())
+
+    def test_getBackrefIndex(self):
+        self.assertEqual(getBackrefIndex(self.conn), None)
+        buildBackrefIndex(self.storage)
+        # checks for a new index file only once in a while
+        self.assertEqual(getBackrefIndex(self.conn), None)
+        index = getBackrefIndex(self.conn, cache_for=-1)
+        self.assertEqual(len(index), 3)
+        self.assertTrue(getBackrefIndex(self.conn) is index)
+
+    def test_getBackrefIndex_no_connection(self):
+        self.assertEqual(getBackrefIndex(None), None)
@@ -1,10 +1,21 @@
+import bisect
 import gc
 import json
+import pickle
 import unittest
+from urllib.parse import unquote
 
+import mock
 import transaction
+from BTrees.IIBTree import IIBTree
+from BTrees.OOBTree import OOBTree
 from persistent import Persistent
+from persistent.list import PersistentList
+from persistent.TimeStamp import TimeStamp
+from ZODB.DB import DB
 from ZODB.interfaces import IDatabase
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import POSKeyError
 from ZODB.utils import oid_repr, p64, tid_repr, u64
 from zope.app.container.btree import BTreeContainer
 from zope.app.container.interfaces import IContained
@@ -17,24 +28,42 @@ from zope.security.checker import ProxyFactory
 from zope.security.proxy import Proxy
 from zope.traversing.interfaces import IContainmentRoot
 
+import zodbbrowser.browser
+from zodbbrowser.backrefs import buildBackrefIndex
 from zodbbrowser.browser import (
+    StreamingResult,
     VeryCarefulView,
     ZodbHistoryView,
     ZodbInfoView,
     ZodbObjectAttribute,
+    ZodbStatsView,
+    formatKey,
     formatSize,
     formatTime,
     getObjectPath,
     getObjectType,
     getObjectTypeShort,
+    getRecordType,
+    getRenderConnection,
+    getRenderPool,
+    parseKey,
+    prefetchValues,
+    resolvePath,
+    setRenderThreads,
+    shutdownRenderPool,
+)
+from zodbbrowser.btreesupport import (
+    BTreeItems,
+    EmptyOOBTreeState,
+    loadNodeState,
 )
-from zodbbrowser.btreesupport import EmptyOOBTreeState
 from zodbbrowser.history import (
     ZodbHistory,
     ZodbObjectHistory,
     getIterableStorage,
 )
 from zodbbrowser.state import GenericState, ZodbObjectState
+from zodbbrowser.stats import CENSUSES
 from zodbbrowser.testing import SimpleValueRenderer
 
 from .realdb import RealDatabaseTest
@@ -335,9 +364,357 @@ class TestZodbInfoViewWithRealDb(RealDatabaseTest):
         view = ZodbInfoView(self.root, TestRequest(form={'tid': '2'}))
         self.assertEqual(view.getUrl(1), '@@zodbbrowser?oid=0x1&tid=2')
 
+    def testListReferrers_no_index(self):
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        self.assertEqual(view.listReferrers(), None)
+
+    def testListReferrers(self):
+        buildBackrefIndex(self.storage)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        referrers = view.listReferrers()
+        # the root, and the BTree that holds the __parent__ of 'member'
+        self.assertEqual(referrers['total'], 2)
+        self.assertEqual(referrers['referrers'][0],
+                         dict(oid='0x0', url='@@zodbbrowser?oid=0x0',
+                              type='PersistentMapping', path=None))
+        self.assertEqual(referrers['referrers'][1]['type'], 'OOBTree')
+
+    def testListReferrers_limit(self):
+        buildBackrefIndex(self.storage)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.referrers_limit = 0
+        referrers = view.listReferrers()
+        self.assertEqual(referrers['total'], 2)
+        self.assertEqual(referrers['referrers'], [])
+
+    def testListReferrers_deleted_object(self):
+        buildBackrefIndex(self.storage)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        with mock.patch.object(view.jar, 'get', side_effect=POSKeyError):
+            referrers = view.listReferrers()
+        self.assertEqual(referrers['total'], 2)
+        self.assertEqual(referrers['referrers'], [])
+
+
+class Counter(Persistent):
+    count = 0
+
+
+class TestPrefetchValues(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        root = self.conn.root()
+        root['a'] = RandomThing()
+        root['b'] = RandomThing()
+        transaction.commit()
+        self.conn2 = self.db.open()
+        self.addCleanup(self.conn2.close)
+
+    def test_ghosts(self):
+        root = self.conn2.root()
+        a, b = root['a'], root['b']
+        b._p_activate()
+        with mock.patch('zodbbrowser.cache.prefetch') as prefetch:
+            prefetchValues([a, b, 'not persistent', RandomThing()])
+        prefetch.assert_called_once_with(self.conn2, [(a._p_oid, None)])
+
+    def test_historical(self):
+        root = self.conn2.root()
+        a, b = root['a'], root['b']
+        b._p_activate()
+        tid = a._p_serial
+        with mock.patch('zodbbrowser.cache.prefetch') as prefetch:
+            prefetchValues([a, b], tid)
+        prefetch.assert_called_once_with(
+            self.conn2, [(a._p_oid, tid), (b._p_oid, tid)])
+
+    def test_nothing_to_load(self):
+        with mock.patch('zodbbrowser.cache.prefetch') as prefetch:
+            prefetchValues([self.conn.root()['a'], 42])
+        self.assertFalse(prefetch.called)
+
+
+class TestZodbInfoViewItemsPaging(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.tree = self.conn.root()['tree'] = OOBTree()
+        for n in range(1000):
+            self.tree['k%04d' % n] = n
+        transaction.commit()
+        provideAdapter(ZodbObjectHistory)
+
+    def makeView(self, url='@@zodbbrowser?oid=0x1&items_limit=30'):
+        form = dict(pair.split('=', 1)
+                    for pair in url.partition('?')[2].split('&'))
+        form = {name: unquote(value) for name, value in form.items()}
+        view = ZodbInfoView(None, TestRequest(form=form))
+        view.getUrl = lambda: '@@zodbbrowser?oid=0x1'
+        view.state = ZodbObjectStateStub(PersistentStub())
+        view.state.requestedTid = None
+        view.state.listItems = lambda: BTreeItems(self.tree.__getstate__(),
+                                                  None)
+        return view
+
+    def test_next_and_previous(self):
+        keys = []
+        url = '@@zodbbrowser?oid=0x1&items_limit=30'
+        pages = []
+        while url:
+            view = self.makeView(url)
+            page = [item.name for item in view.listItems()]
+            pages.append((url, page))
+            keys.extend(page)
+            url = view.items_next_url
+        self.assertEqual(keys, sorted(self.tree.keys()))
+        # going back we see the same pages
+        for (url, page), (prev_url, prev_page) in zip(pages[1:], pages):
+            view = self.makeView(url)
+            view.listItems()
+            view = self.makeView(view.items_prev_url)
+            self.assertEqual([item.name for item in view.listItems()],
+                             prev_page)
+
+    def test_offset_does_not_walk_the_bucket_chain(self):
+        view = self.makeView(
+            '@@zodbbrowser?oid=0x1&items_offset=900&items_limit=30')
+        with mock.patch('zodbbrowser.btreesupport.loadNodeState',
+                        wraps=loadNodeState) as loads:
+            items = view.listItems()
+        self.assertTrue(850 <= items[0].value <= 950, items[0].value)
+        # a few descents from the root to estimate the length and find
+        # the page, instead of a walk along the first 900 / 30 buckets
+        self.assertTrue(loads.call_count < 20, loads.call_count)
+
+
+class TestZodbInfoViewHistory(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        self.addCleanup(setup.placelessTearDown)
+        RealDatabaseTest.setUp(self)
+        provideAdapter(GenericState)
+        provideAdapter(SimpleValueRenderer)
+        provideAdapter(ZodbObjectHistory)
+        self.counter = self.conn.root()['counter'] = Counter()
+        transaction.commit()
+        for n in range(1, 7):
+            self.counter.count = n
+            transaction.commit()
+
+    def _listHistory(self, **form):
+        view = ZodbInfoView(self.counter, TestRequest(form=form))
+        view.template = view.listHistory
+        return view, view()
+
+    def test_listHistory_one_page(self):
+        view, history = self._listHistory()
+        self.assertEqual([h['index'] for h in history], [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual([h['latest'] for h in history],
+                         [True] + [False] * 6)
+        self.assertEqual(view.history_newer, None)
+        self.assertEqual(view.history_older, None)
+
+    def test_listHistory_first_page(self):
+        view, history = self._listHistory(history_size='3')
+        self.assertEqual(len(history), 3)
+        self.assertTrue(history[0]['latest'])
+        self.assertEqual(view.history_newer, None)
+        self.assertEqual(view.history_older, 3)
+        self.assertEqual(view.getHistoryUrl(view.history_older),
+                         '@@zodbbrowser?oid=0x%x&history_start=3&history_size=3'
+                         % u64(self.counter._p_oid))
+
+    def test_listHistory_diffs_oldest_record_on_page(self):
+        view, history = self._listHistory(history_size='3')
+        # compared with the previous revision, not with an empty state
+        self.assertTrue('changed to 4' in history[-1]['diff'],
+                        history[-1]['diff'])
+
+    def test_listHistory_last_page(self):
+        view, history = self._listHistory(history_size='3', history_start='6')
+        self.assertEqual([h['index'] for h in history], [1])
+        self.assertEqual(view.history_newer, 3)
+        self.assertEqual(view.history_older, None)
+
+    def test_listHistory_does_not_load_everything(self):
+        self.addCleanup(setattr, ZodbObjectHistory, 'initial_size',
+                        ZodbObjectHistory.initial_size)
+        ZodbObjectHistory.initial_size = 2
+        view, history = self._listHistory(history_size='1')
+        self.assertEqual([h['index'] for h in history], [None])
+        self.assertEqual(view.history_older, 1)
+
+    def test_listHistory_shows_page_with_requested_tid(self):
+        tid = ZodbObjectHistory(self.counter)[4]['tid']
+        view, history = self._listHistory(history_size='3',
+                                          tid=str(u64(tid)))
+        self.assertEqual(view.history_start, 3)
+        self.assertEqual([h['current'] for h in history],
+                         [False, True, False])
+
+
+class TestZodbStatsView(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.conn.root()['list'] = PersistentList()
+        transaction.commit()
+        provideAdapter(ZodbHistory)
+        provideAdapter(getIterableStorage)
+        self.addCleanup(CENSUSES.pop, self.storage, None)
+
+    def _zodbStatsView(self, form={}):
+        view = ZodbStatsView(self.conn.root(), TestRequest(form=form))
+        view.template = lambda: ''
+        view()
+        return view
+
+    def test_not_computed(self):
+        view = self._zodbStatsView()
+        self.assertEqual(view.census, None)
+
+    def test_compute(self):
+        view = self._zodbStatsView({'compute': '1'})
+        root_size = len(self.storage.load(p64(0))[0])
+        list_size = len(self.storage.load(p64(1))[0])
+        self.assertEqual(view.getTotals(),
+                         dict(count=2, size=formatSize(root_size + list_size),
+                              classes=2))
+        self.assertEqual(view.getCensusTidNice(),
+                         str(TimeStamp(self.storage.lastTransaction())))
+        rows = view.listClasses()
+        self.assertEqual(rows[0]['class_name'],
+                         'persistent.mapping.PersistentMapping')
+        self.assertEqual(rows[0]['largest'], [
+            dict(oid='0x0', url='@@zodbbrowser?oid=0x0',
+                 size=formatSize(root_size)),
+        ])
+
+    def test_listLargestObjects(self):
+        view = self._zodbStatsView({'compute': '1'})
+        root_size = len(self.storage.load(p64(0))[0])
+        self.assertEqual(view.listLargestObjects()[0],
+                         dict(oid='0x0', url='@@zodbbrowser?oid=0x0',
+                              class_name='persistent.mapping.PersistentMapping',
+                              size=formatSize(root_size)))
+
+    def test_listLargestRevisions(self):
+        view = self._zodbStatsView({'compute': '1'})
+        tid = self.storage.lastTransaction()
+        self.assertEqual(view.listLargestRevisions()[0],
+                         dict(oid='0x0',
+                              url='@@zodbbrowser?oid=0x0&tid=0x%x' % u64(tid),
+                              class_name='persistent.mapping.PersistentMapping',
+                              size=view.listLargestObjects()[0]['size'],
+                              tid=str(TimeStamp(tid))))
+
+    def test_remembers_census(self):
+        self._zodbStatsView({'compute': '1'})
+        view = self._zodbStatsView()
+        self.assertEqual(view.getTotals()['count'], 2)
+
+
+class TemplateStub(object):
+
+    macros = {'one': 'first section', 'two': 'second section'}
+
+    def __call__(self, streaming=None, macro=None):
+        if macro is not None:
+            return '<%s>' % macro
+        if streaming is not None:
+            return '<html>%s</html>' % streaming
+        return '<html>everything</html>'
+
+
+class TestStreaming(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        self.addCleanup(setup.placelessTearDown)
+        RealDatabaseTest.setUp(self)
+        getGlobalSiteManager().registerUtility(self.db, IDatabase,
+                                               name='<target>')
+        provideAdapter(GenericState)
+        provideAdapter(ZodbObjectHistory)
+        transaction.commit()
+
+    def _makeView(self, **kw):
+        view = ZodbInfoView(None, TestRequest(**kw))
+        view.template = view.section_template = TemplateStub()
+        view.streamed_sections = ('one', '<br />', 'two')
+        return view
+
+    def test_streaming(self):
+        view = self._makeView()
+        result = view()
+        self.assertTrue(isinstance(result, StreamingResult))
+        self.assertEqual(b''.join(result),
+                         b'<html><first section><br />\n<second section></html>')
+        self.assertEqual(view.request.response.getHeader('Content-Type'),
+                         'text/html;charset=utf-8')
+
+    def test_streaming_keeps_connection_open_until_closed(self):
+        view = self._makeView()
+        result = view()
+        self.assertFalse(view.jar.opened is None)
+        self.assertFalse(view.jar.transaction_manager is transaction.manager.manager)
+        result.close()
+        self.assertTrue(view.jar.opened is None)
+
+    def test_streaming_section_error(self):
+        view = self._makeView()
+        view.streamed_sections = ('three', 'one')
+        with mock.patch('zodbbrowser.browser.log'):
+            body = b''.join(view())
+        self.assertEqual(body,
+                         b'<html><div class="error">KeyError: \'three\'</div>'
+                         b'<first section></html>')
+
+    def test_no_streaming_for_rollback(self):
+        view = self._makeView(form={'ROLLBACK': '1', 'rtid': '0',
+                                    'confirmed': '0'})
+        view.confirmation_template = lambda: 'confirm?'
+        self.assertEqual(view(), 'confirm?')
+        self.assertTrue(view.jar.transaction_manager is transaction.manager.manager)
+
+    def test_no_streaming_if_asked(self):
+        view = self._makeView(form={'nostream': '1'})
+        self.assertEqual(view(), '<html>everything</html>')
+
+    def test_cleanups_when_rendering_fails(self):
+        view = self._makeView()
+        view.template = None  # not callable
+        with self.assertRaises(TypeError):
+            view()
+        self.assertTrue(view.jar.opened is None)
+
+
+class TestStreamingResult(unittest.TestCase):
+
+    def test_iter(self):
+        result = StreamingResult(iter(['abc', u'\N{SNOWMAN}', '', b'xyz']))
+        self.assertEqual(list(result),
+                         [b'abc', u'\N{SNOWMAN}'.encode('UTF-8'), b'xyz'])
+
+    def test_close(self):
+        calls = []
+
+        def fail():
+            calls.append('fail')
+            raise Exception('oops')
+
+        result = StreamingResult([], [fail, lambda: calls.append('ok')])
+        with mock.patch('zodbbrowser.browser.log'):
+            result.close()
+        self.assertEqual(calls, ['fail', 'ok'])
+
 
 class ZodbObjectStateStub(object):
 
+    requestedTid = None
+
     def __init__(self, context):
         self.context = context
 
@@ -436,6 +813,44 @@ class TestZodbInfoViewBreadcrumbs(unittest.TestCase):
                           ('???', '@@zodbbrowser?oid=0x37'), ])
 
 
+class TestResolvePath(unittest.TestCase):
+
+    def setUp(self):
+        self.root = RootFolderStub()
+        self.root._p_oid = p64(1)
+        self.foo = PersistentStub()
+        self.foo._p_oid = p64(27)
+        self.root['foo'] = self.foo
+        self.foobar = PersistentStub()
+        self.foobar._p_oid = p64(32)
+        self.foo['bar'] = self.foobar
+
+    def test(self):
+        memo = {}
+        self.assertEqual(
+            resolvePath(ZodbObjectStateStub(self.foobar), None, memo),
+            [('/', 1), ('foo', 27), ('/', None), ('bar', 32)])
+        self.assertEqual(memo[27, None], [('/', 1), ('foo', 27)])
+        self.assertEqual(memo[1, None], [('/', 1)])
+
+    def test_uses_index_for_objects_without_parent(self):
+        orphan = PersistentStub()
+        orphan._p_oid = p64(42)
+        orphan['child'] = child = PersistentStub()
+        child._p_oid = p64(43)
+        index = mock.Mock(getPath=lambda oid: [('/', 1), ('found', oid)])
+        index.__contains__ = lambda self, oid: oid == 42
+        self.assertEqual(
+            resolvePath(ZodbObjectStateStub(child), None, {}, index),
+            [('/', 1), ('found', 42), ('/', None), ('child', 43)])
+
+    def test_uses_memo(self):
+        memo = {(27, None): [('/', 1), ('...', None)]}
+        self.assertEqual(
+            resolvePath(ZodbObjectStateStub(self.foobar), None, memo),
+            [('/', 1), ('...', None), ('/', None), ('bar', 32)])
+
+
 class TestZodbInfoView(unittest.TestCase):
 
     def assertEqual(self, first, second):
@@ -521,6 +936,144 @@ class TestZodbInfoView(unittest.TestCase):
                          [ZodbObjectAttribute('zoinks', 17, 42),
                           ZodbObjectAttribute('scoobysnack', None, 42)])
 
+    def test_listItems_from_key(self):
+        view = ZodbInfoView(None, TestRequest(form={'from_key': '2'}))
+        view.getUrl = lambda: '@@zodbbrowser?oid=0x1'
+        view.state = ZodbObjectStateStub(PersistentStub())
+        view.state.requestedTid = 42
+        items = BTreeItems(((((1, 'a', 2, 'b', 3, 'c'),),),), None)
+        view.state.listItems = lambda: items
+        self.assertEqual(view.listItems(),
+                         [ZodbObjectAttribute(2, 'b', 42),
+                          ZodbObjectAttribute(3, 'c', 42)])
+
+    def makePagedView(self, form, items):
+        view = ZodbInfoView(None, TestRequest(form=form))
+        view.getUrl = lambda: '@@zodbbrowser?oid=0x1'
+        view.state = ZodbObjectStateStub(PersistentStub())
+        view.state.requestedTid = None
+        view.state.listItems = lambda: items
+        return view
+
+    def test_listItems_paging(self):
+        items = [(n, str(n)) for n in range(5)]
+        view = self.makePagedView({'items_offset': '2', 'items_limit': '2'},
+                                  items)
+        self.assertEqual(view.listItems(),
+                         [ZodbObjectAttribute(2, '2', None),
+                          ZodbObjectAttribute(3, '3', None)])
+        self.assertEqual(view.getItemsTotal(), '5')
+        self.assertEqual(view.items_prev_url,
+                         '@@zodbbrowser?oid=0x1&items_limit=2&items_offset=0')
+        self.assertEqual(view.items_next_url,
+                         '@@zodbbrowser?oid=0x1&items_limit=2&items_offset=4')
+
+    def test_listItems_paging_last_page(self):
+        items = [(n, str(n)) for n in range(5)]
+        view = self.makePagedView({'items_offset': '4', 'items_limit': '2'},
+                                  items)
+        self.assertEqual(view.listItems(), [ZodbObjectAttribute(4, '4', None)])
+        self.assertEqual(view.items_prev_url,
+                         '@@zodbbrowser?oid=0x1&items_limit=2&items_offset=2')
+        self.assertEqual(view.items_next_url, None)
+
+    def test_listItems_paging_default_limit(self):
+        items = [(n, str(n)) for n in range(5)]
+        view = self.makePagedView({}, items)
+        view.items_limit = 3
+        self.assertEqual(len(view.listItems()), 3)
+        self.assertEqual(view.items_prev_url, None)
+        self.assertEqual(view.items_next_url,
+                         '@@zodbbrowser?oid=0x1&items_offset=3')
+
+    def test_listItems_paging_btree_estimates_total(self):
+        items = BTreeItems(((((1, 'a', 2, 'b', 3, 'c'),),),), None)
+        view = self.makePagedView({'items_limit': '2'}, items)
+        self.assertEqual(len(view.listItems()), 2)
+        self.assertEqual(view.getItemsTotal(), 'about 3')
+
+    def test_listItems_paging_btree_knows_total_of_single_page(self):
+        items = BTreeItems(((((1, 'a', 2, 'b', 3, 'c'),),),), None)
+        view = self.makePagedView({}, items)
+        self.assertEqual(len(view.listItems()), 3)
+        self.assertEqual(view.getItemsTotal(), '3')
+        self.assertEqual(view.items_prev_url, None)
+        self.assertEqual(view.items_next_url, None)
+
+    def test_listItems_paging_btree_offset(self):
+        items = BTreeItems(((((1, 'a', 2, 'b', 3, 'c'),),),), None)
+        view = self.makePagedView({'items_offset': '2', 'items_limit': '2'},
+                                  items)
+        self.assertEqual(view.listItems(), [ZodbObjectAttribute(3, 'c', None)])
+        # the offset is approximate, so links use keys
+        self.assertEqual(view.items_offset, None)
+        self.assertEqual(view.items_prev_url,
+                         '@@zodbbrowser?oid=0x1&before_key=3&items_limit=2')
+        self.assertEqual(view.items_next_url, None)
+
+    def test_listItems_paging_btree_keys_not_for_urls(self):
+        keys = [object() for n in range(3)]
+        items = BTreeItems(((((keys[0], 'a', keys[1], 'b', keys[2], 'c'),),),),
+                           None)
+        view = self.makePagedView({'items_offset': '1', 'items_limit': '1'},
+                                  items)
+        self.assertEqual(view.listItems(),
+                         [ZodbObjectAttribute(keys[1], 'b', None)])
+        self.assertEqual(view.items_offset, 1)
+        self.assertEqual(view.items_prev_url,
+                         '@@zodbbrowser?oid=0x1&items_limit=1&items_offset=0')
+        self.assertEqual(view.items_next_url,
+                         '@@zodbbrowser?oid=0x1&items_limit=1&items_offset=2')
+
+    def test_formatKey(self):
+        self.assertEqual(formatKey(42), '42')
+        self.assertEqual(formatKey('42'), "'42'")
+        self.assertEqual(formatKey(('a', 1)), "('a', 1)")
+        self.assertEqual(formatKey(object()), None)
+        self.assertEqual(formatKey(IIBTree), None)
+
+    def test_getItemsUrl(self):
+        view = self.makePagedView({'items_limit': '10'}, [])
+        self.assertEqual(view.getItemsUrl(from_key="'a b'"),
+                         "@@zodbbrowser?oid=0x1&from_key=%27a%20b%27"
+                         "&items_limit=10")
+
+    def makeSummaryView(self, form):
+        view = ZodbInfoView(None, TestRequest(form=form))
+        view.obj = IIBTree({1: 10, 2: 20, 4: 40})
+        view.state = ZodbObjectStateStub(PersistentStub())
+        view.state.listItems = lambda: BTreeItems(view.obj.__getstate__(),
+                                                  None)
+        return view
+
+    def test_canSummarizeItems(self):
+        view = self.makeSummaryView({})
+        self.assertTrue(view.canSummarizeItems())
+        view.obj = PersistentStub()
+        self.assertFalse(view.canSummarizeItems())
+
+    def test_getItemsSummary_not_requested(self):
+        view = self.makeSummaryView({})
+        self.assertEqual(view.getItemsSummary(), None)
+
+    def test_getItemsSummary(self):
+        view = self.makeSummaryView({'summary': '1'})
+        summary = view.getItemsSummary()
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['key_density'], 0.75)
+        self.assertEqual(summary['key_histogram'][0],
+                         dict(low=1, high=1.3, count=1, width='100%'))
+        self.assertEqual(summary['key_histogram'][1]['width'], '0%')
+        self.assertEqual(summary['value_histogram'][-1]['count'], 1)
+
+    def test_listItems_from_key_wrong_type(self):
+        view = ZodbInfoView(None, TestRequest(form={'from_key': 'x'}))
+        view.state = ZodbObjectStateStub(PersistentStub())
+        view.state.requestedTid = 42
+        items = BTreeItems(((((1, 'a'),),),), None)
+        view.state.listItems = lambda: items
+        self.assertEqual(view.listItems(), [ZodbObjectAttribute(1, 'a', 42)])
+
     def test_listItems_empty(self):
         view = ZodbInfoView(None, None)
         view.state = ZodbObjectStateStub(PersistentStub())
@@ -536,8 +1089,8 @@ class TestZodbInfoView(unittest.TestCase):
     def test_loadHistoricalState(self):
         view = ZodbInfoView(None, None)
         view.obj = None
-        view.history = [{}]  # injected fault: KeyError('tid')
-        self.assertEqual(view._loadHistoricalState(),
+        records = [{}]  # injected fault: KeyError('tid')
+        self.assertEqual(view._loadHistoricalState(records),
                          [{'state': {}, 'error': "KeyError: 'tid'"},
                           {'state': {}, 'error': None}])
 
@@ -554,6 +1107,16 @@ class TestZodbInfoView(unittest.TestCase):
         self.assertFalse(view.canRollback())
 
 
+class TestParseKey(unittest.TestCase):
+
+    def test(self):
+        self.assertEqual(parseKey('42'), 42)
+        self.assertEqual(parseKey("'42'"), '42')
+        self.assertEqual(parseKey('(1, 2)'), (1, 2))
+        self.assertEqual(parseKey('foo'), 'foo')
+        self.assertEqual(parseKey('foo bar'), 'foo bar')
+
+
 class HistoryStub(object):
     def __init__(self, tids=()):
         self.tids = list(tids)
@@ -561,6 +1124,12 @@ class HistoryStub(object):
     def __len__(self):
         return len(self.tids)
 
+    def findTransaction(self, tid):
+        pos = bisect.bisect_right(self.tids, tid)
+        if pos == 0:
+            raise ValueError(tid)
+        return pos - 1
+
     def __getitem__(self, idx):
         if isinstance(idx, slice):
             return [TransactionRecordStub()
@@ -584,6 +1153,8 @@ class TestZodbHistoryView(RealDatabaseTest):
 
     def setUp(self):
         RealDatabaseTest.setUp(self)
+        # before the database gets closed
+        self.addCleanup(shutdownRenderPool)
         self.root = self.conn.root()
         self.root['root'] = RootFolderStub()
         transaction.get().note(u'test setup')
@@ -654,7 +1225,10 @@ class TestZodbHistoryView(RealDatabaseTest):
         self.assertEqual(view.findPage(1050), 18)
         self.assertEqual(view.findPage(1040), 19)
         self.assertEqual(view.findPage(1000), 19)
-        self.assertEqual(view.findPage(1337), 0)
+        # nonexistent tids map to the last transaction before them
+        self.assertEqual(view.findPage(1337), 13)
+        self.assertEqual(view.findPage(9999), 0)
+        self.assertEqual(view.findPage(999), 0)
 
     def test_listHistory(self):
         view = self._makeView(form={'tid': '123'})
@@ -673,6 +1247,173 @@ class TestZodbHistoryView(RealDatabaseTest):
         prepared_history = view.listHistory()
         self.assertEqual(prepared_history[0]['size'], None)
 
+    def test_listHistory_fast(self):
+        view = self._makeView(form={'fast': '1'})
+        view.update()
+        with mock.patch.object(view.jar, 'get', side_effect=AssertionError):
+            prepared_history = view.listHistory()
+        objects = prepared_history[0]['objects']
+        self.assertEqual(
+            [(obj['path'], obj['class_repr'], obj['repr'])
+             for obj in objects[:2]],
+            [('0x0', "<class 'persistent.mapping.PersistentMapping'>",
+              '(view object)'),
+             ('0x1', "<class 'zodbbrowser.tests.test_browser.RootFolderStub'>",
+              '(view object)')])
+
+    def registerTargetDB(self):
+        registry = getGlobalSiteManager()
+        registry.registerUtility(self.db, IDatabase, name='<target>')
+        self.addCleanup(registry.unregisterUtility,
+                        self.db, IDatabase, name='<target>')
+
+    def test_listHistory_in_threads(self):
+        def describe(history):
+            return [[(obj['path'], obj['class_repr'])
+                     for obj in txn['objects']] for txn in history]
+
+        self.registerTargetDB()
+        view = self._makeView()
+        with mock.patch('zodbbrowser.browser.RENDER_THREADS', 1):
+            view.update()
+            expected = describe(view.listHistory())
+        view = self._makeView()
+        view.update()
+        self.assertEqual(describe(view.listHistory()), expected)
+        jars = list(zodbbrowser.browser._render_jars)
+        self.assertTrue(jars)
+        for jar in jars:
+            self.assertIsNot(jar, view.jar)
+        shutdownRenderPool()
+        self.assertEqual(zodbbrowser.browser._render_pool, None)
+        self.assertEqual(zodbbrowser.browser._render_jars, [])
+        for jar in jars:
+            self.assertEqual(jar.opened, None)
+
+    def test_no_threads_inside_applications(self):
+        # no '<target>' database: we're a view in somebody's application
+        view = self._makeView()
+        view.update()
+        records = list(view.history[-1])
+        self.assertTrue(len(records) > 1)
+        self.assertFalse(view.canRenderInThreads(records))
+        view._describeRecords(records, records[0].tid)
+        self.assertEqual(zodbbrowser.browser._render_pool, None)
+        self.assertEqual(zodbbrowser.browser._render_jars, [])
+
+    def test_threads_load_common_parents_once(self):
+        folder = self.root['root']['folder'] = PersistentStub()
+        transaction.commit()
+        for n in range(60):
+            folder['item%d' % n] = PersistentStub()
+        transaction.commit()
+        self.registerTargetDB()
+
+        def countParentStates(threads):
+            view = self._makeView()
+            view.update()
+            records = list(view.history[-1])
+            with mock.patch('zodbbrowser.browser.RENDER_THREADS', threads), \
+                    mock.patch.object(ZodbObjectState, 'getParentState',
+                                      autospec=True,
+                                      side_effect=ZodbObjectState.getParentState
+                                      ) as getParentState:
+                objects = view._describeRecords(records, records[0].tid)
+            self.assertEqual(
+                sum(obj['path'].startswith('/folder/item') for obj in objects),
+                60)
+            return getParentState.call_count
+
+        serial = countParentStates(1)
+        self.assertTrue(serial < 5)
+        self.assertEqual(countParentStates(4), serial)
+
+    def test_render_pool_is_shared_by_requests(self):
+        self.registerTargetDB()
+        view = self._makeView()
+        view.update()
+        view.listHistory()
+        pool = getRenderPool()
+        jars = list(zodbbrowser.browser._render_jars)
+        view = self._makeView()
+        view.update()
+        view.listHistory()
+        self.assertIs(getRenderPool(), pool)
+        # the connections of the first request are still used
+        self.assertEqual(zodbbrowser.browser._render_jars[:len(jars)], jars)
+        self.assertTrue(len(zodbbrowser.browser._render_jars)
+                        <= zodbbrowser.browser.RENDER_THREADS)
+
+    def test_render_connections_see_new_transactions(self):
+        db = self.root._p_jar.db()
+        jar = getRenderPool().submit(getRenderConnection, db, 0).result()
+        self.root['new'] = 42
+        transaction.commit()
+        for n in range(zodbbrowser.browser.RENDER_THREADS * 2):
+            jar = getRenderPool().submit(getRenderConnection, db, 1).result()
+            self.assertEqual(jar.get(self.root._p_oid)['new'], 42)
+
+    def test_render_connections_are_synced_once_per_batch(self):
+        self.addCleanup(setRenderThreads, zodbbrowser.browser.RENDER_THREADS)
+        setRenderThreads(1)
+        db = self.root._p_jar.db()
+        pool = getRenderPool()
+        jar = pool.submit(getRenderConnection, db, 0).result()
+        with mock.patch.object(jar.transaction_manager, 'abort') as abort:
+            for n in range(3):
+                self.assertIs(
+                    pool.submit(getRenderConnection, db, 0).result(), jar)
+            self.assertEqual(abort.call_count, 0)
+            for n in range(3):
+                self.assertIs(
+                    pool.submit(getRenderConnection, db, 1).result(), jar)
+            self.assertEqual(abort.call_count, 1)
+
+    def test_shutdownRenderPool_after_closing_the_database(self):
+        db = DB(MappingStorage())
+        jar = getRenderPool().submit(getRenderConnection, db).result()
+        db.close()
+        shutdownRenderPool()
+        self.assertEqual(jar.opened, None)
+
+    def test_setRenderThreads(self):
+        pool = getRenderPool()
+        self.addCleanup(setRenderThreads, zodbbrowser.browser.RENDER_THREADS)
+        setRenderThreads(2)
+        self.assertEqual(zodbbrowser.browser.RENDER_THREADS, 2)
+        self.assertIsNot(getRenderPool(), pool)
+        self.assertEqual(getRenderPool()._max_workers, 2)
+
+    def test_describeRecords_uses_thread_connections(self):
+        self.registerTargetDB()
+        view = self._makeView()
+        view.update()
+        seen = []
+        describe = view._describeRecord
+
+        def _describeRecord(jar, idx, record, tid, *args):
+            seen.append(jar)
+            return describe(jar, idx, record, tid, *args)
+
+        view._describeRecord = _describeRecord
+        records = list(view.history[-1])
+        self.assertTrue(len(records) > 1)
+        objects = view._describeRecords(records, records[0].tid)
+        self.assertEqual([obj['oid'] for obj in objects],
+                         [u64(record.oid) for record in records])
+        self.assertNotIn(view.jar, seen)
+
+    def test_listHistory_fast_with_path_index(self):
+        index = mock.Mock(getPath=lambda oid: [('/', oid)])
+        view = self._makeView(form={'fast': '1'})
+        view.update()
+        with mock.patch('zodbbrowser.pathindex.getPathIndex',
+                        return_value=index):
+            prepared_history = view.listHistory()
+        self.assertEqual(set(obj['path']
+                             for obj in prepared_history[0]['objects']),
+                         set(['/']))
+
 
 class TestHelperFunctions(unittest.TestCase):
 
@@ -689,6 +1430,17 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(getObjectTypeShort(ProxyFactory(NonpersistentStub())),
                          Proxy.__name__ + ' - NonpersistentStub')
 
+    def test_getRecordType(self):
+        data = pickle.dumps(NonpersistentStub, 3) + pickle.dumps({}, 3)
+        self.assertEqual(getRecordType(data),
+                         "<class 'zodbbrowser.tests.test_browser.NonpersistentStub'>")
+
+    def test_getRecordType_no_data(self):
+        self.assertEqual(getRecordType(None), '')
+
+    def test_getRecordType_garbage(self):
+        self.assertEqual(getRecordType(b'garbage'), '')
+
     def test_formatTime(self):
         self.assertEqual(formatTime(0), '0.000s')
         self.assertEqual(formatTime(1.5), '1.500s')
@@ -722,6 +1474,46 @@ class TestHelperFunctionsWithRealDb(RealDatabaseTest):
             getObjectPath(self.root['root']['item']['subitem'], None),
             '/item/subitem')
 
+    def test_getObjectPath_resolves_each_parent_once(self):
+        item = self.root['root']['item']
+        item['other'] = PersistentStub()
+        transaction.commit()
+        with mock.patch.object(ZodbObjectState, 'getParentState',
+                               autospec=True,
+                               side_effect=ZodbObjectState.getParentState
+                               ) as getParentState:
+            self.assertEqual(getObjectPath(item['subitem'], None),
+                             '/item/subitem')
+            self.assertEqual(getObjectPath(item['other'], None),
+                             '/item/other')
+            self.assertEqual(getObjectPath(item, None), '/item')
+        # subitem -> item -> root, and nothing else
+        self.assertEqual(getParentState.call_count, 2)
+
+    def test_getObjectPath_memo_is_per_tid(self):
+        item = self.root['root']['item']
+        tid = item._p_serial
+        item.__name__ = 'renamed'
+        transaction.commit()
+        self.assertEqual(getObjectPath(item, tid), '/item')
+        self.assertEqual(getObjectPath(item, None), '/renamed')
+
+    def test_getObjectPath_uses_path_index(self):
+        item = self.root['detached_item']
+        index = mock.Mock(getPath=lambda oid: [('/', 1), ('elsewhere', oid)])
+        with mock.patch('zodbbrowser.pathindex.getPathIndex',
+                        return_value=index):
+            self.assertEqual(getObjectPath(item, None), '/elsewhere')
+
+    def test_getObjectPath_not_in_path_index(self):
+        index = mock.Mock(getPath=lambda oid: None)
+        index.__contains__ = lambda self, oid: False
+        with mock.patch('zodbbrowser.pathindex.getPathIndex',
+                        return_value=index):
+            self.assertEqual(
+                getObjectPath(self.root['root']['item']['subitem'], None),
+                '/item/subitem')
+
     def test_getObjectPath_no_path_no_name(self):
         oid = u64(self.root['detached_item']._p_oid)
         self.assertEqual(getObjectPath(self.root['detached_item'], None),
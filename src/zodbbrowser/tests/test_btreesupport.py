@@ -1,20 +1,45 @@
 import unittest
+from array import array
 
+import mock
 import transaction
-from BTrees.OOBTree import OOBTree, OOBucket
+from BTrees.fsBTree import fsBTree
+from BTrees.IFBTree import IFBTree
+from BTrees.IIBTree import IIBTree, IIBucket, IISet
+from BTrees.Interfaces import ITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.LLBTree import LLBTree, LLTreeSet
+from BTrees.OIBTree import OIBTree
+from BTrees.OOBTree import OOBTree, OOBucket, OOTreeSet
+from ZODB.utils import p64, u64
 from zope.app.container.btree import BTreeContainer
 from zope.app.folder import Folder
 from zope.app.testing import setup
-from zope.component import provideAdapter
+from zope.component import getMultiAdapter, provideAdapter
 from zope.interface.verify import verifyObject
 
+from zodbbrowser import cache
 from zodbbrowser.btreesupport import (
     BTreeContainerState,
+    BTreeHistory,
+    BTreeItems,
+    BTreeState,
+    BucketState,
+    EmptyBTreeState,
     EmptyOOBTreeState,
+    EmptyTreeSetState,
     FolderState,
     OOBTreeHistory,
     OOBTreeState,
     OOBucketState,
+    SetState,
+    TreeSetHistory,
+    TreeSetState,
+    getNumericTypes,
+    histogram,
+    isInternalNode,
+    loadNodeState,
+    summarizeItems,
 )
 from zodbbrowser.history import ZodbObjectHistory
 from zodbbrowser.interfaces import IObjectHistory, IStateInterpreter
@@ -58,6 +83,12 @@ class TestOOBTreeState(unittest.TestCase):
     def test_asDict(self):
         self.assertEqual(dict(self.state.asDict()), {1: 42, 2: 23, 3: 17})
 
+    def test_listItems_small_tree(self):
+        items = self.state.listItems()
+        self.assertEqual(items.estimateLength(), 3)
+        self.assertEqual(items.fromKey(2), [(2, 23), (3, 17)])
+        self.assertEqual(items.fromOffset(1), [(2, 23), (3, 17)])
+
 
 class TestLargeOOBTreeState(RealDatabaseTest):
 
@@ -95,6 +126,95 @@ class TestLargeOOBTreeState(RealDatabaseTest):
         self.assertEqual(sum(state.asDict().values()), -1000)
         self.assertEqual(sum(self.tree.values()), 0)
 
+    def test_isInternalNode_does_not_unghostify(self):
+        self.conn.cacheMinimize()
+        self.assertEqual(self.tree._p_status, 'ghost')
+        self.assertTrue(isInternalNode(self.tree))
+        self.assertEqual(self.tree._p_status, 'ghost')
+        bucket = self.tree.__getstate__()[0][0]
+        self.assertEqual(bucket._p_status, 'ghost')
+        self.assertFalse(isInternalNode(bucket))
+        self.assertEqual(bucket._p_status, 'ghost')
+
+    def test_listItems_is_lazy(self):
+        with mock.patch('zodbbrowser.btreesupport.loadNodeState',
+                        wraps=loadNodeState) as loads:
+            items = self.getState(None).listItems()
+            self.assertEqual(loads.call_count, 0)
+            self.assertEqual(items[:3], [(0, 1), (1, -1), (2, 1)])
+            self.assertEqual(loads.call_count, 1)
+
+    def test_walking_the_tree_does_not_keep_bucket_histories(self):
+        items = self.getState(None).listItems()
+        self.assertEqual(len(list(items)), 1000)
+        histories = cache.getTransactionCache(self.conn, 'histories')
+        self.assertTrue(len(histories) <= 1, len(histories))
+
+    def test_listItems_len(self):
+        items = self.getState(None).listItems()
+        self.assertEqual(len(items), 1000)
+        self.assertTrue(items)
+
+    def test_listItems_slicing(self):
+        items = self.getState(None).listItems()
+        expected = sorted(self.tree.items())
+        self.assertEqual(items[500:503], expected[500:503])
+        self.assertEqual(items[998:], expected[998:])
+        self.assertEqual(items[-2:], expected[-2:])
+        self.assertEqual(items[1000:], [])
+        self.assertEqual(items[::100], expected[::100])
+        self.assertEqual(items[999], expected[999])
+        self.assertEqual(items[-1], expected[-1])
+        with self.assertRaises(IndexError):
+            items[1000]
+
+    def test_listItems_fromKey(self):
+        items = self.getState(None).listItems()
+        with mock.patch('zodbbrowser.btreesupport.loadNodeState',
+                        wraps=loadNodeState) as loads:
+            self.assertEqual(items.fromKey(500)[:2], [(500, 1), (501, -1)])
+        # root -> bucket, not root -> first bucket -> next -> ... -> bucket
+        self.assertTrue(loads.call_count <= 3, loads.call_count)
+
+    def test_listItems_fromKey_between_keys(self):
+        items = self.getState(None).listItems()
+        self.assertEqual(items.fromKey(499.5)[:1], [(500, 1)])
+        self.assertEqual(items.fromKey(-1)[:1], [(0, 1)])
+        self.assertEqual(items.fromKey(1000)[:1], [])
+        self.assertEqual(len(items.fromKey(990)), 10)
+
+    def test_listItems_fromKey_historical(self):
+        items = self.getState(self.tids[-1]).listItems()
+        self.assertEqual(items.fromKey(500)[:2], [(500, -1), (501, -1)])
+
+    def test_listItems_fromOffset(self):
+        items = self.getState(None).listItems()
+        key, value = items.fromOffset(500)[0]
+        self.assertTrue(400 <= key <= 600, key)
+        self.assertEqual(items.fromOffset(0)[0], (0, 1))
+        self.assertEqual(items.fromOffset(5000)[:1], [(999, -1)])
+
+    def test_listItems_estimateLength(self):
+        items = self.getState(None).listItems()
+        self.assertTrue(900 <= items.estimateLength() <= 1100,
+                        items.estimateLength())
+
+    def test_listItems_prefetches_buckets(self):
+        with mock.patch.object(self.storage, 'prefetch',
+                               create=True) as prefetch:
+            items = self.getState(self.tids[-1]).listItems()
+            self.assertEqual(len(items), 1000)
+        oids, before = prefetch.call_args[0]
+        buckets = self.tree.__getstate__()[0][0::2]
+        self.assertEqual(oids, [bucket._p_oid for bucket in buckets])
+        self.assertEqual(before, p64(u64(self.tids[-1]) + 1))
+
+    def test_listItems_equality(self):
+        items = self.getState(None).listItems()
+        self.assertEqual(items, sorted(self.tree.items()))
+        self.assertNotEqual(items, [])
+        self.assertNotEqual(items, None)
+
 
 class TestLargeOOBTreeHistory(RealDatabaseTest):
 
@@ -129,6 +249,68 @@ class TestLargeOOBTreeHistory(RealDatabaseTest):
             # POSKeyErrors.  LP#953480
             IObjectHistory(self.tree).loadStatePickle(tids[i])
 
+    def test_merged_history_is_cached(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        with mock.patch.object(self.conn._storage, 'history') as history:
+            self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.assertEqual(history.call_count, 0)
+
+    def test_merged_history_is_extended_incrementally(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.tree[1000] = 'new'
+        transaction.commit()
+        with mock.patch.object(self.conn._storage, 'history',
+                               wraps=self.conn._storage.history) as history:
+            history_after = OOBTreeHistory(self.tree)
+            self.assertEqual(len(history_after), 101)
+        self.assertEqual(history_after[0]['tid'],
+                         self.storage.lastTransaction())
+        # one or two calls per object, asking for just a couple of records
+        self.assertTrue(max(kw['size'] for args, kw in history.call_args_list)
+                        <= 4, history.call_args_list)
+        state = self.getState(history_after[0]['tid'])
+        self.assertEqual(len(state.asDict()), 101)
+
+    def test_merged_history_looks_only_at_changed_buckets(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.tree[1000] = 'new'
+        transaction.commit()
+        with mock.patch.object(self.conn._storage, 'history',
+                               wraps=self.conn._storage.history) as history:
+            self.assertEqual(len(OOBTreeHistory(self.tree)), 101)
+        # just the last bucket, where the new key went
+        oids = set(args[0] for args, kw in history.call_args_list)
+        self.assertEqual(len(oids), 1)
+
+    def test_merged_history_ignores_unrelated_transactions(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.conn.root()['other'] = OOBTree()
+        transaction.commit()
+        with mock.patch.object(self.conn._storage, 'history') as history:
+            self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.assertEqual(history.call_count, 0)
+
+    def test_merged_history_finds_new_buckets(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        for i in range(100, 1000):
+            self.tree[i] = i
+        transaction.commit()
+        tids = [d['tid'] for d in OOBTreeHistory(self.tree)]
+        self.assertEqual(len(tids), 101)
+        expected = [d['tid'] for d in ZodbObjectHistory(self.tree)]
+        # the tree itself changed, but all the buckets were merged in
+        self.assertTrue(set(expected) < set(tids))
+        state = self.getState(tids[0])
+        self.assertEqual(len(state.asDict()), 1000)
+
+    def test_merged_history_after_pack(self):
+        self.assertEqual(len(OOBTreeHistory(self.tree)), 100)
+        self.packDatabase()
+        tids = [d['tid'] for d in OOBTreeHistory(self.tree)]
+        cache.BTREE_HISTORIES.clear()
+        self.assertEqual(tids, [d['tid'] for d in OOBTreeHistory(self.tree)])
+        self.assertTrue(len(tids) < 100)
+
     def test_rollback_is_not_supported(self):
         history = IObjectHistory(self.tree)
         tid = history[len(history) // 2]['tid']
@@ -157,6 +339,8 @@ class TestEmptyOOBTreeState(unittest.TestCase):
 
     def test_listItems(self):
         self.assertEqual(list(self.state.listItems()), [])
+        self.assertFalse(self.state.listItems())
+        self.assertEqual(len(self.state.listItems()), 0)
 
     def test_asDict(self):
         self.assertEqual(dict(self.state.asDict()), {})
@@ -251,3 +435,193 @@ class TestOOBucketState(unittest.TestCase):
         self.assertEqual(self.state.asDict(),
                          dict(_next=None, _items={1: 42, 2: 23, 3: 17}))
 
+
+class TestSetState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = SetState(None, IISet([3, 1, 2]).__getstate__(), None)
+
+    def test_interface_compliance(self):
+        verifyObject(IStateInterpreter, self.state)
+
+    def test_listAttributes(self):
+        self.assertEqual(self.state.listAttributes(), [('_next', None)])
+
+    def test_listItems(self):
+        self.assertEqual(list(self.state.listItems()),
+                         [(1, 1), (2, 2), (3, 3)])
+
+    def test_asDict(self):
+        self.assertEqual(self.state.asDict(),
+                         dict(_next=None, _items={1: 1, 2: 2, 3: 3}))
+
+
+class TestAllBTreeFamilies(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbObjectHistory)
+        provideAdapter(BTreeHistory)
+        provideAdapter(TreeSetHistory)
+        provideAdapter(BTreeState)
+        provideAdapter(EmptyBTreeState)
+        provideAdapter(TreeSetState)
+        provideAdapter(EmptyTreeSetState)
+        provideAdapter(BucketState)
+        provideAdapter(SetState)
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def getState(self, obj, tid=None):
+        history = IObjectHistory(obj)
+        state = history.loadState(tid)
+        return getMultiAdapter((obj, state, tid), IStateInterpreter)
+
+    def test_IOBTree(self):
+        tree = self.root['tree'] = IOBTree()
+        for i in range(1000):
+            tree[i] = str(i)
+        transaction.commit()
+        self.assertIsInstance(IObjectHistory(tree), BTreeHistory)
+        state = self.getState(tree)
+        self.assertIsInstance(state, BTreeState)
+        self.assertEqual(len(state.listItems()), 1000)
+        self.assertEqual(state.listItems().fromKey(500)[:1], [(500, '500')])
+
+    def test_fsBTree(self):
+        tree = self.root['tree'] = fsBTree()
+        tree[b'ab'] = b'123456'
+        transaction.commit()
+        self.assertEqual(list(self.getState(tree).listItems()),
+                         [(b'ab', b'123456')])
+
+    def test_empty_LLBTree(self):
+        tree = self.root['tree'] = LLBTree()
+        transaction.commit()
+        state = self.getState(tree)
+        self.assertIsInstance(state, EmptyBTreeState)
+        self.assertEqual(list(state.listItems()), [])
+
+    def test_IIBucket(self):
+        bucket = self.root['bucket'] = IIBucket({1: 2})
+        transaction.commit()
+        state = self.getState(bucket)
+        self.assertIsInstance(state, BucketState)
+        self.assertEqual(list(state.listItems()), [(1, 2)])
+
+    def test_IISet(self):
+        iiset = self.root['set'] = IISet([1, 2])
+        transaction.commit()
+        state = self.getState(iiset)
+        self.assertIsInstance(state, SetState)
+        self.assertEqual(list(state.listItems()), [(1, 1), (2, 2)])
+
+    def test_LLTreeSet(self):
+        treeset = self.root['treeset'] = LLTreeSet(range(0, 2000, 2))
+        transaction.commit()
+        treeset.add(1)
+        transaction.commit()
+        history = IObjectHistory(treeset)
+        self.assertIsInstance(history, TreeSetHistory)
+        self.assertEqual(len(history), 2)
+        state = self.getState(treeset)
+        self.assertIsInstance(state, TreeSetState)
+        items = state.listItems()
+        self.assertEqual(len(items), 1001)
+        self.assertEqual(items[:3], [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual(items.fromKey(1001)[:1], [(1002, 1002)])
+        self.assertTrue(900 <= items.estimateLength() <= 1100)
+        old_state = self.getState(treeset, history[1]['tid'])
+        self.assertEqual(len(old_state.listItems()), 1000)
+
+    def test_empty_TreeSet(self):
+        treeset = self.root['treeset'] = OOTreeSet()
+        transaction.commit()
+        state = self.getState(treeset)
+        self.assertIsInstance(state, EmptyTreeSetState)
+        self.assertEqual(list(state.listItems()), [])
+        self.assertEqual(state.asDict(), {})
+
+
+class TestSummary(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbObjectHistory)
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def getItems(self, obj):
+        state = IObjectHistory(obj).loadState()
+        return BTreeItems(state, None, not ITreeSet.providedBy(obj))
+
+    def test_getNumericTypes(self):
+        self.assertEqual(getNumericTypes(IFBTree()), ('i', 'd'))
+        self.assertEqual(getNumericTypes(LLBTree()), ('q', 'q'))
+        self.assertEqual(getNumericTypes(LLTreeSet()), ('q', None))
+        self.assertEqual(getNumericTypes(IISet()), ('i', None))
+        self.assertEqual(getNumericTypes(IOBTree()), ('i', None))
+        self.assertEqual(getNumericTypes(OIBTree()), (None, 'i'))
+        self.assertEqual(getNumericTypes(OOBTree()), (None, None))
+        self.assertEqual(getNumericTypes(fsBTree()), (None, None))
+        self.assertEqual(getNumericTypes(Folder()), (None, None))
+
+    def test_histogram(self):
+        self.assertEqual(histogram(array('i', [0, 1, 2, 3, 10]), 0, 10, 2),
+                         [(0, 5, 4), (5, 10, 1)])
+
+    def test_histogram_single_value(self):
+        self.assertEqual(histogram(array('d', [1.0]), 1.0, 1.0, 2),
+                         [(0.5, 1.0, 0), (1.0, 1.5, 1)])
+
+    @mock.patch('zodbbrowser.btreesupport.numpy', None)
+    def test_histogram_without_numpy(self):
+        self.assertEqual(histogram(array('q', [0, 1, 2, 3, 10]), 0, 10, 2),
+                         [(0, 5, 4), (5, 10, 1)])
+
+    def test_summarizeItems(self):
+        tree = self.root['tree'] = IFBTree()
+        for i in range(1000):
+            tree[i * 2] = i % 10 * 0.5
+        transaction.commit()
+        summary = summarizeItems(tree, self.getItems(tree), bins=4)
+        self.assertEqual(summary['count'], 1000)
+        self.assertTrue(summary['buckets'] > 1)
+        self.assertEqual(summary['min_key'], 0)
+        self.assertEqual(summary['max_key'], 1998)
+        self.assertAlmostEqual(summary['key_density'], 0.5, 3)
+        self.assertEqual([count for low, high, count
+                          in summary['key_histogram']], [250] * 4)
+        self.assertEqual(summary['min_value'], 0)
+        self.assertEqual(summary['max_value'], 4.5)
+        self.assertEqual(summary['mean_value'], 2.25)
+        self.assertEqual(sum(count for low, high, count
+                             in summary['value_histogram']), 1000)
+
+    def test_summarizeItems_TreeSet(self):
+        treeset = self.root['treeset'] = LLTreeSet([5, 6, 7])
+        transaction.commit()
+        summary = summarizeItems(treeset, self.getItems(treeset))
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['key_density'], 1.0)
+        self.assertEqual(summary['value_histogram'], None)
+
+    def test_summarizeItems_empty(self):
+        tree = self.root['tree'] = IIBTree()
+        transaction.commit()
+        summary = summarizeItems(tree, self.getItems(tree))
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['key_histogram'], None)
+
+    def test_summarizeItems_not_numeric(self):
+        tree = self.root['tree'] = OIBTree()
+        transaction.commit()
+        self.assertEqual(summarizeItems(tree, self.getItems(tree)), None)
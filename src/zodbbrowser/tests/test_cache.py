@@ -1,9 +1,40 @@
+import os
+import struct
 import time
 import unittest
 
+import mock
 import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.DB import DB
+from ZODB.FileStorage.FileStorage import FileIterator
+from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import p64, u64
 
-from zodbbrowser.cache import MINUTES, expired, getStorageTids
+from zodbbrowser import cache
+from zodbbrowser.cache import (
+    MINUTES,
+    PICKLE_CACHE,
+    STORAGE_TIDS,
+    TRANSACTION_INDEX_SUFFIX,
+    LRUCache,
+    TidList,
+    TidRefresher,
+    copyState,
+    expired,
+    getFirstTid,
+    getStorageTidOffsets,
+    getStorageTids,
+    getStorageTransactions,
+    loadSerial,
+    loadTransactionIndex,
+    maybe_closing,
+    prefetch,
+    rememberPickle,
+    saveTransactionIndex,
+    startTidRefresher,
+    stopTidRefresher,
+)
 from zodbbrowser.tests.realdb import RealDatabaseTest
 
 
@@ -16,6 +47,209 @@ class TestCache(unittest.TestCase):
         self.assertTrue(expired({'last_update': now - 1 - 5 * MINUTES}, 5 * MINUTES))
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 42), 42)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_hits_and_misses(self):
+        cache = LRUCache(10)
+        cache.get('a')
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.put('a', b'xxxx')
+        cache.put('b', b'yyyy')
+        self.assertEqual(cache.size, 8)
+        cache.put('a', b'zz')
+        self.assertEqual(cache.size, 6)
+        cache.put('c', b'wwwww')
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+        self.assertEqual(cache.size, 7)
+
+    def test_too_big(self):
+        cache = LRUCache(10, sizeof=len)
+        cache.put('a', b'x' * 11)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = LRUCache(10)
+        cache.put('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+class TestCopyState(unittest.TestCase):
+
+    def test_dict(self):
+        state = {'a': [1]}
+        copy = copyState(state)
+        self.assertEqual(copy, state)
+        self.assertFalse(copy is state)
+        self.assertTrue(copy['a'] is state['a'])
+
+    def test_dict_and_slots(self):
+        state = ({'a': 1}, {'b': 2})
+        copy = copyState(state)
+        self.assertEqual(copy, state)
+        self.assertFalse(copy[0] is state[0])
+        self.assertFalse(copy[1] is state[1])
+
+    def test_no_dict_only_slots(self):
+        state = (None, {'b': 2})
+        self.assertEqual(copyState(state), state)
+
+    def test_other(self):
+        state = ((1, 2, 3), None)
+        self.assertTrue(copyState(state) is state)
+
+
+class TestPickleCache(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        PICKLE_CACHE.clear()
+        self.addCleanup(PICKLE_CACHE.clear)
+        self.obj = self.conn.root()['obj'] = PersistentMapping()
+        transaction.commit()
+        self.first_tid = self.obj._p_serial
+        self.obj['x'] = 1
+        transaction.commit()
+        self.oid = self.obj._p_oid
+
+    def test_loadSerial(self):
+        data = loadSerial(self.conn, self.oid, self.first_tid)
+        self.assertEqual(data, self.storage.loadSerial(self.oid,
+                                                       self.first_tid))
+        with mock.patch.object(self.storage, 'loadSerial') as load:
+            loadSerial(self.conn, self.oid, self.first_tid)
+        self.assertFalse(load.called)
+
+    def test_loadSerial_prefers_loadBefore_if_storage_can_prefetch(self):
+        expected = self.storage.loadSerial(self.oid, self.first_tid)
+        with mock.patch.object(self.storage, 'prefetch', create=True):
+            with mock.patch.object(self.storage, 'loadSerial') as load:
+                data = loadSerial(self.conn, self.oid, self.first_tid)
+        self.assertEqual(data, expected)
+        self.assertFalse(load.called)
+
+    def test_loadSerial_falls_back_to_loadSerial(self):
+        expected = self.storage.loadSerial(self.oid, self.first_tid)
+        with mock.patch.object(self.storage, 'prefetch', create=True):
+            with mock.patch.object(self.storage, 'loadBefore',
+                                   side_effect=KeyError):
+                data = loadSerial(self.conn, self.oid, self.first_tid)
+        self.assertEqual(data, expected)
+
+    def test_rememberPickle(self):
+        rememberPickle(self.conn, self.oid, self.first_tid, b'pickle')
+        self.assertEqual(loadSerial(self.conn, self.oid, self.first_tid),
+                         b'pickle')
+
+    def test_rememberPickle_ignores_deletions(self):
+        rememberPickle(self.conn, self.oid, self.first_tid, None)
+        self.assertEqual(len(PICKLE_CACHE), 0)
+
+    def test_prefetch_not_supported(self):
+        self.assertEqual(prefetch(self.conn, [(self.oid, None)]), 0)
+
+    def test_prefetch(self):
+        other = p64(42)
+        with mock.patch.object(self.storage, 'prefetch',
+                               create=True) as storage_prefetch:
+            n = prefetch(self.conn, [(self.oid, None),
+                                     (self.oid, self.first_tid),
+                                     (other, self.first_tid),
+                                     (self.oid, self.first_tid),
+                                     (None, self.first_tid)])
+        self.assertEqual(n, 3)
+        # Connection.prefetch() passes a generator
+        calls = [(list(oids), before)
+                 for (oids, before), kw in storage_prefetch.call_args_list]
+        self.assertEqual(calls, [
+            ([self.oid], mock.ANY),
+            ([self.oid, other], p64(u64(self.first_tid) + 1)),
+        ])
+
+    def test_prefetch_errors_are_ignored(self):
+        with mock.patch.object(self.storage, 'prefetch', create=True,
+                               side_effect=IOError('disconnected')):
+            self.assertEqual(prefetch(self.conn,
+                                      [(self.oid, self.first_tid)]), 0)
+
+
+class TestTidList(unittest.TestCase):
+
+    def setUp(self):
+        self.tids = TidList([p64(1), p64(2), p64(0xFFFFFFFFFFFFFFFF)])
+
+    def test_len(self):
+        self.assertEqual(len(self.tids), 3)
+        self.assertEqual(len(TidList()), 0)
+        self.assertFalse(TidList())
+
+    def test_getitem(self):
+        self.assertEqual(self.tids[0], p64(1))
+        self.assertEqual(self.tids[-1], b'\xff' * 8)
+        with self.assertRaises(IndexError):
+            self.tids[3]
+
+    def test_slicing(self):
+        self.assertIsInstance(self.tids[1:], TidList)
+        self.assertEqual(list(self.tids[1:]), [p64(2), b'\xff' * 8])
+        self.assertEqual(self.tids[5:], TidList())
+
+    def test_iter(self):
+        self.assertEqual(list(self.tids), [p64(1), p64(2), b'\xff' * 8])
+
+    def test_equality(self):
+        self.assertEqual(self.tids, TidList(self.tids))
+        self.assertEqual(self.tids, [p64(1), p64(2), b'\xff' * 8])
+        self.assertNotEqual(self.tids, TidList())
+        self.assertNotEqual(self.tids, [p64(1)])
+        self.assertNotEqual(self.tids, 'something else')
+
+    def test_append_and_extend(self):
+        self.tids.append(p64(3))
+        self.tids.extend([p64(4), p64(5)])
+        self.assertEqual(len(self.tids), 6)
+        self.assertEqual(self.tids[-1], p64(5))
+
+    def test_index(self):
+        self.assertEqual(self.tids.index(p64(2)), 1)
+        with self.assertRaises(ValueError):
+            self.tids.index(p64(3))
+
+    def test_repr(self):
+        self.assertEqual(repr(TidList([p64(1)])),
+                         "TidList([b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x01'])")
+
+
 class TestStorageTids(RealDatabaseTest):
 
     def setUp(self):
@@ -58,3 +292,211 @@ class TestStorageTids(RealDatabaseTest):
                 should_be=[t.tid for t in self.storage.iterator()],
             )
         )
+
+    def test_getFirstTid(self):
+        with maybe_closing(self.storage.iterator()) as it:
+            first = next(it).tid
+        self.assertEqual(getFirstTid(self.storage), first)
+
+    def test_getFirstTid_not_iterable(self):
+        self.assertEqual(getFirstTid(object()), None)
+
+
+class TestTransactionIndex(RealDatabaseTest):
+
+    def setUp(self):
+        super(TestTransactionIndex, self).setUp()
+        self.root = self.conn.root()
+        self.root['adam'] = None
+        transaction.commit()
+        self.root['eve'] = None
+        transaction.commit()
+        self.index_filename = self.db_filename + TRANSACTION_INDEX_SUFFIX
+
+    def test_getStorageTids_writes_index(self):
+        tids = getStorageTids(self.storage)
+        self.assertTrue(os.path.exists(self.index_filename))
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+
+    def test_getStorageTidOffsets(self):
+        tids = getStorageTids(self.storage)
+        offsets = getStorageTidOffsets(self.storage)
+        self.assertEqual(len(offsets), len(tids))
+        self.assertEqual(offsets[0], 4)
+        self.assertEqual([t._tpos for t in self.storage.iterator()],
+                         list(offsets))
+
+    def test_getStorageTidOffsets_not_a_filestorage(self):
+        storage = MappingStorage()
+        DB(storage).close()
+        self.assertEqual(len(getStorageTids(storage)), 1)
+        self.assertEqual(getStorageTidOffsets(storage), None)
+
+    def test_index_is_reused(self):
+        tids = getStorageTids(self.storage)[:]
+        del STORAGE_TIDS[self.storage]
+        self.root['bob'] = None
+        transaction.commit()
+        with mock.patch('zodbbrowser.cache.FileIterator',
+                        wraps=FileIterator) as FileIteratorMock:
+            tids_again = getStorageTids(self.storage)
+        FileIteratorMock.assert_called_once_with(
+            self.db_filename, pos=getStorageTidOffsets(self.storage)[-1])
+        self.assertEqual(tids_again[:-1], tids)
+        self.assertEqual(len(loadTransactionIndex(self.index_filename)[0]), 4)
+
+    def test_index_notices_db_packing(self):
+        getStorageTids(self.storage)
+        del STORAGE_TIDS[self.storage]
+        time.sleep(0.001)
+        self.packDatabase()
+        tids = getStorageTids(self.storage)
+        self.assertEqual(tids, [t.tid for t in self.storage.iterator()])
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+
+    def test_packing_replaces_tids_and_offsets_together(self):
+        tids, offsets = getStorageTransactions(self.storage)
+        old = tids[:], offsets[:]
+        time.sleep(0.001)
+        self.packDatabase()
+        new_tids, new_offsets = getStorageTransactions(self.storage,
+                                                       cache_for=-1)
+        # whoever got the old lists still has a matching pair
+        self.assertEqual((tids, offsets), old)
+        with maybe_closing(self.storage.iterator()) as it:
+            expected = [(t.tid, t._tpos) for t in it]
+        self.assertEqual(list(zip(new_tids, new_offsets)), expected)
+
+    def test_getStorageTransactions_not_a_filestorage(self):
+        storage = MappingStorage()
+        DB(storage).close()
+        tids, offsets = getStorageTransactions(storage)
+        self.assertEqual(len(tids), 1)
+        self.assertEqual(offsets, None)
+
+    def test_damaged_index_is_ignored(self):
+        tids = getStorageTids(self.storage)[:]
+        del STORAGE_TIDS[self.storage]
+        with open(self.index_filename, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertEqual(len(loadTransactionIndex(self.index_filename)[0]), 0)
+        self.assertEqual(getStorageTids(self.storage), tids)
+
+    def test_truncated_index_record_is_ignored(self):
+        tids = getStorageTids(self.storage)[:]
+        with open(self.index_filename, 'ab') as f:
+            f.write(b'\0' * 5)
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+
+    def test_index_with_tids_out_of_order_is_ignored(self):
+        tids = getStorageTids(self.storage)[:]
+        offsets = getStorageTidOffsets(self.storage)
+        del STORAGE_TIDS[self.storage]
+        saveTransactionIndex(self.index_filename, [tids[0], tids[2], tids[1]],
+                             [offsets[0], offsets[2], offsets[1]])
+        self.assertEqual(len(loadTransactionIndex(self.index_filename)[0]), 0)
+        self.assertEqual(getStorageTids(self.storage), tids)
+
+    @unittest.skipIf(cache.fcntl is None, "No flock on this platform")
+    def test_saveTransactionIndex_locks_the_file(self):
+        tids = getStorageTids(self.storage)[:]
+        offsets = getStorageTidOffsets(self.storage)
+        with mock.patch('fcntl.flock') as mock_flock:
+            saveTransactionIndex(self.index_filename, tids, offsets)
+        mock_flock.assert_called_once_with(mock.ANY, cache.fcntl.LOCK_EX)
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+
+    def test_saveTransactionIndex_appends(self):
+        tids = getStorageTids(self.storage)[:]
+        offsets = getStorageTidOffsets(self.storage)
+        saveTransactionIndex(self.index_filename, tids[:2], offsets[:2])
+        saveTransactionIndex(self.index_filename, tids, offsets, 2)
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+        # the file on disk doesn't have n_old records: rewrite it
+        saveTransactionIndex(self.index_filename, tids, offsets, 2)
+        self.assertEqual(loadTransactionIndex(self.index_filename)[0], tids)
+
+    def test_missing_index(self):
+        tids, offsets = loadTransactionIndex(self.index_filename)
+        self.assertEqual(len(tids), 0)
+        self.assertEqual(len(offsets), 0)
+
+    def test_saveTransactionIndex_failure_is_not_fatal(self):
+        saveTransactionIndex(os.path.join(self.tmpdir, 'nosuchdir', 'index'),
+                             [b'\0' * 8], [4])
+
+
+class TestTidRefresher(RealDatabaseTest):
+
+    def setUp(self):
+        super(TestTidRefresher, self).setUp()
+        self.root = self.conn.root()
+
+    def commit(self, key):
+        self.root[key] = None
+        transaction.commit()
+
+    def test_refresh(self):
+        refresher = TidRefresher(self.storage)
+        refresher.refresh()
+        self.assertEqual(len(getStorageTids(self.storage)), 1)
+        self.commit('adam')
+        refresher.refresh()
+        self.assertEqual(len(getStorageTids(self.storage)), 2)
+
+    def test_refresh_comes_back_for_transactions_in_progress(self):
+        refresher = TidRefresher(self.storage)
+        refresher.refresh()
+        cache_dict = STORAGE_TIDS[self.storage]
+        self.assertFalse(refresher.needsRefresh(cache_dict))
+        # the header of a transaction that is being committed right now
+        with open(self.db_filename, 'ab') as f:
+            f.write(struct.pack('>8sQcHHH', b'\xff' * 8, 100, b'c', 0, 0, 0))
+        refresher.refresh()
+        self.assertEqual(len(getStorageTids(self.storage)), 1)
+        self.assertTrue(refresher.needsRefresh(cache_dict))
+
+    def test_refresh_not_a_filestorage(self):
+        storage = MappingStorage()
+        db = DB(storage)
+        self.addCleanup(db.close)
+        refresher = TidRefresher(storage)
+        refresher.refresh()
+        self.assertEqual(len(getStorageTids(storage)), 1)
+        self.assertFalse(refresher.needsRefresh(STORAGE_TIDS[storage]))
+        with db.transaction() as conn:
+            conn.root()['adam'] = None
+        self.assertTrue(refresher.needsRefresh(STORAGE_TIDS[storage]))
+        refresher.refresh()
+        self.assertEqual(len(getStorageTids(storage)), 2)
+
+    def test_refresh_errors_are_logged(self):
+        refresher = TidRefresher(self.storage)
+        with mock.patch('zodbbrowser.cache.updateTransactionIndex',
+                        side_effect=IOError('oops')):
+            with self.assertLogs('zodbbrowser.cache') as cm:
+                refresher.refresh()
+        self.assertIn('Failed to refresh', cm.output[0])
+
+    def test_requests_do_not_refresh_while_refresher_runs(self):
+        tids = getStorageTids(self.storage)[:]
+        STORAGE_TIDS[self.storage]['refresher'] = mock.Mock()
+        self.commit('adam')
+        self.assertEqual(getStorageTids(self.storage, cache_for=-1), tids)
+
+    def test_start_and_stop(self):
+        refresher = startTidRefresher(self.storage, interval=0.01)
+        self.addCleanup(stopTidRefresher, self.storage)
+        self.commit('adam')
+        for n in range(500):
+            transactions = STORAGE_TIDS[self.storage].get('transactions')
+            if transactions and len(transactions[0]) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(getStorageTids(self.storage)), 2)
+        stopTidRefresher(self.storage)
+        self.assertFalse(refresher.is_alive())
+        self.assertNotIn('refresher', STORAGE_TIDS[self.storage])
+
+    def test_stop_without_start(self):
+        stopTidRefresher(self.storage)
@@ -1,13 +1,17 @@
+import mock
 import transaction
 from persistent import Persistent
 from persistent.dict import PersistentDict
-from zope.component import provideAdapter
+from ZODB.FileStorage.FileStorage import FileIterator
+from ZODB.utils import p64, u64
+from zope.component import getGlobalSiteManager, provideAdapter
 from zope.interface.verify import verifyObject
 
 from zodbbrowser.history import (
     ZodbHistory,
     ZodbObjectHistory,
     getIterableStorage,
+    getObjectHistory,
 )
 from zodbbrowser.interfaces import IDatabaseHistory, IObjectHistory
 from zodbbrowser.tests.realdb import RealDatabaseTest
@@ -46,6 +50,50 @@ class TestFileStorage(RealDatabaseTest):
         self.assertTrue(history.canRollback())
 
 
+class TestGetObjectHistory(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.obj = self.conn.root()['obj'] = PersistentDict()
+        self.other = self.conn.root()['other'] = PersistentDict()
+        transaction.commit()
+
+    def test_adapter_lookup(self):
+        provideAdapter(ZodbObjectHistoryCustom)
+        self.addCleanup(getGlobalSiteManager().unregisterAdapter,
+                        ZodbObjectHistoryCustom)
+        history = getObjectHistory(self.obj)
+        self.assertIsInstance(history, ZodbObjectHistoryCustom)
+
+    def test_fallback(self):
+        history = getObjectHistory(self.obj)
+        self.assertIsInstance(history, ZodbObjectHistory)
+
+    def test_cached_within_transaction(self):
+        history = getObjectHistory(self.obj)
+        self.assertIs(getObjectHistory(self.obj), history)
+        self.assertIsNot(getObjectHistory(self.other), history)
+
+    def test_not_cached_across_transactions(self):
+        history = getObjectHistory(self.obj)
+        transaction.abort()
+        self.assertIsNot(getObjectHistory(self.obj), history)
+
+    def test_not_cached_for_new_objects(self):
+        obj = PersistentObject()
+        obj._p_jar = self.conn
+        self.assertIsNot(getObjectHistory(obj), getObjectHistory(obj))
+
+    def test_not_cached_when_connection_is_closed(self):
+        obj = self.obj
+        self.conn.close()
+        self.assertIsNot(getObjectHistory(obj), getObjectHistory(obj))
+
+
+class ZodbObjectHistoryCustom(ZodbObjectHistory):
+    pass
+
+
 class WorkloadMixin(object):
 
     def commitSomeStuff(self):
@@ -94,6 +142,58 @@ class TestLoadState(WorkloadMixin, RealDatabaseTest):
         else:
             self.fail("did not raise")
 
+    def test_state_is_cached(self):
+        history = ZodbObjectHistory(self.adam)
+        tid = history[1]['tid']
+        pickle = history.loadStatePickle(tid)
+        state = history.loadState(tid)
+        with mock.patch.object(self.conn._storage, 'loadSerial') as loadSerial:
+            history = ZodbObjectHistory(self.adam)
+            self.assertEqual(history.loadStatePickle(tid), pickle)
+            self.assertEqual(history.loadState(tid), state)
+        self.assertFalse(loadSerial.called)
+
+    def test_cached_state_cannot_be_modified_by_setstate(self):
+        history = ZodbObjectHistory(self.adam)
+        history.loadState().pop('laptop')
+        self.assertEqual(history.loadState(), dict(laptop='ThinkPad T61'))
+
+    def test_rollback_is_not_affected_by_cache(self):
+        history = ZodbObjectHistory(self.adam)
+        tid = history[-2]['tid']
+        history.rollback(tid)
+        self.adam.laptop = 'Dell'
+        self.assertEqual(history.loadState(tid), dict(laptop='ThinkPad T23'))
+
+    def test_loads_history_lazily(self):
+        history = ZodbObjectHistory(self.adam)
+        history.initial_size = 2
+        self.assertEqual(history.lastChange(), history[0]['tid'])
+        self.assertEqual(len(history._history), 2)
+        self.assertEqual(history.knownLength(), None)
+        self.assertEqual(len(history[:3]), 3)
+        self.assertEqual(len(history._history), 4)
+        self.assertEqual(history.knownLength(), None)
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.knownLength(), 4)
+
+    def test_lastChange_loads_more_history(self):
+        history = ZodbObjectHistory(self.adam)
+        history.initial_size = 1
+        tid = ZodbObjectHistory(self.eve)[-1]['tid']
+        self.assertEqual(history.lastChange(tid),
+                         ZodbObjectHistory(self.adam)[-1]['tid'])
+
+    def test_iteration_loads_more_history(self):
+        history = ZodbObjectHistory(self.adam)
+        history.initial_size = 1
+        self.assertEqual(len(list(history)), 4)
+
+    def test_negative_index(self):
+        history = ZodbObjectHistory(self.adam)
+        history.initial_size = 1
+        self.assertEqual(history[-1], ZodbObjectHistory(self.adam)[3])
+
     def test_rollback_does_nothing(self):
         history = ZodbObjectHistory(self.adam)
         history.rollback(history.lastChange())
@@ -135,3 +235,49 @@ class TestZodbHistory(WorkloadMixin, RealDatabaseTest):
         self.assertEqual([tr.tid for tr in history][-5:],
                          [tr.tid for tr in history[-5:]])
 
+    def test_findTransaction(self):
+        self.commitSomeStuff()
+        history = ZodbHistory(self.conn)
+        tids = history.tids
+        self.assertEqual(history.findTransaction(tids[0]), 0)
+        self.assertEqual(history.findTransaction(tids[3]), 3)
+        self.assertEqual(history.findTransaction(tids[-1]), len(tids) - 1)
+        self.assertEqual(history.findTransaction(p64(u64(tids[3]) + 1)), 3)
+        self.assertEqual(history.findTransaction(b'\xff' * 8), len(tids) - 1)
+        with self.assertRaises(ValueError):
+            history.findTransaction(p64(u64(tids[0]) - 1))
+
+    def test_slice_seeks_to_offset(self):
+        self.commitSomeStuff()
+        history = ZodbHistory(self.conn)
+        self.addCleanup(history.cleanup)
+        all_tids = [tr.tid for tr in history]
+        offsets = [tr._tpos for tr in self.storage.iterator()]
+        with mock.patch('zodbbrowser.history.FileIterator',
+                        wraps=FileIterator) as FileIteratorMock:
+            self.assertEqual([tr.tid for tr in history[3:5]],
+                             all_tids[3:5])
+            self.assertEqual(history[-2].tid, all_tids[-2])
+        self.assertEqual(FileIteratorMock.call_args_list, [
+            mock.call(self.db_filename, all_tids[3], all_tids[4],
+                      pos=offsets[3]),
+            mock.call(self.db_filename, all_tids[-2], all_tids[-2],
+                      pos=offsets[-2]),
+        ])
+
+    def test_index_out_of_range(self):
+        history = ZodbHistory(self.conn)
+        self.addCleanup(history.cleanup)
+        with self.assertRaises(IndexError):
+            history[1]
+        with self.assertRaises(IndexError):
+            history[-2]
+
+    def test_not_a_filestorage(self):
+        self.commitSomeStuff()
+        history = ZodbHistory(self.conn)
+        self.addCleanup(history.cleanup)
+        history._offsets = None
+        self.assertEqual([tr.tid for tr in history][-5:],
+                         [tr.tid for tr in history[-5:]])
+        self.assertEqual(history[-1].tid, history.tids[-1])
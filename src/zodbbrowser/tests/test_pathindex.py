@@ -0,0 +1,197 @@
+import os
+import tempfile
+import unittest
+
+import mock
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.utils import u64
+from zope.app.folder import Folder, rootFolder
+from zope.app.testing import setup
+from zope.component import provideAdapter
+
+from zodbbrowser.btreesupport import BTreeState, FolderState
+from zodbbrowser.cache import getTransactionCache
+from zodbbrowser.history import ZodbObjectHistory
+from zodbbrowser.pathindex import (
+    PATH_INDEX_SUFFIX,
+    PathIndex,
+    buildPathIndex,
+    crawl,
+    formatName,
+    getPathIndex,
+    getRootObject,
+    savePathIndex,
+)
+from zodbbrowser.state import GenericState, PersistentMappingState
+from zodbbrowser.tests.realdb import RealDatabaseTest
+
+
+class TestFormatName(unittest.TestCase):
+
+    def test(self):
+        self.assertEqual(formatName('foo'), 'foo')
+        self.assertEqual(formatName(b'foo'), 'foo')
+        self.assertEqual(formatName(42), '42')
+
+
+class TestPathIndexFile(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = self.mktemp()
+        savePathIndex(self.filename, [
+            (5, 1, u'b\xe9'),
+            (3, 1, u'a'),
+            (7, 3, u'c'),
+            (9, 42, u'orphan'),
+        ], b'\0' * 8, 1)
+
+    def mktemp(self):
+        fd, filename = tempfile.mkstemp(prefix='test-zodbbrowser-')
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        return filename
+
+    def test_load(self):
+        index = PathIndex.load(self.filename)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.root_oid, 1)
+        self.assertEqual(index.tid, b'\0' * 8)
+
+    def test_save_replaces_existing_index(self):
+        with mock.patch('os.rename', side_effect=FileExistsError), \
+                mock.patch('os.replace', wraps=os.replace) as replace:
+            savePathIndex(self.filename, [(3, 1, u'a')], b'\0' * 8, 1)
+        replace.assert_called_once()
+        self.assertEqual(len(PathIndex.load(self.filename)), 1)
+
+    def test_lookup(self):
+        index = PathIndex.load(self.filename)
+        self.assertEqual(index.lookup(3), (1, u'a'))
+        self.assertEqual(index.lookup(5), (1, u'b\xe9'))
+        self.assertEqual(index.lookup(9), (42, u'orphan'))
+        self.assertEqual(index.lookup(4), None)
+        self.assertEqual(index.lookup(100), None)
+        self.assertTrue(7 in index)
+        self.assertFalse(1 in index)
+
+    def test_getPath(self):
+        index = PathIndex.load(self.filename)
+        self.assertEqual(index.getPath(1), [('/', 1)])
+        self.assertEqual(index.getPath(7),
+                         [('/', 1), ('a', 3), ('/', None), ('c', 7)])
+        self.assertEqual(index.getPath(2), None)
+
+    def test_getPath_broken_chain(self):
+        index = PathIndex.load(self.filename)
+        self.assertEqual(index.getPath(9),
+                         [('/', None), ('...', None), ('/', None),
+                          ('orphan', 9)])
+
+    def test_load_missing_file(self):
+        self.assertEqual(PathIndex.load(self.filename + '-nonexistent'),
+                         None)
+
+    def test_load_damaged_file(self):
+        with open(self.filename, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertEqual(PathIndex.load(self.filename), None)
+
+    def test_load_truncated_file(self):
+        with open(self.filename, 'r+b') as f:
+            f.truncate(40)
+        self.assertEqual(PathIndex.load(self.filename), None)
+
+
+class TestCrawl(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbObjectHistory)
+        provideAdapter(GenericState)
+        provideAdapter(PersistentMappingState)
+        provideAdapter(FolderState)
+        provideAdapter(BTreeState)
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()['Application'] = rootFolder()
+        self.root['a'] = Folder()
+        self.root['a']['b'] = Folder()
+        self.root['c'] = Folder()
+        # the same object in two places: the shorter path wins
+        self.root['a']['b']['deep'] = self.root['c']
+        self.root['mapping'] = PersistentMapping()
+        transaction.commit()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def oid(self, obj):
+        return u64(obj._p_oid)
+
+    def test_getRootObject(self):
+        self.assertEqual(getRootObject(self.conn), self.root)
+
+    def test_getRootObject_no_zope_root(self):
+        del self.conn.root()['Application']
+        self.assertEqual(getRootObject(self.conn), self.conn.root())
+
+    def test_crawl(self):
+        records = sorted(crawl(self.root))
+        expected = sorted([
+            (self.oid(self.root['a']), self.oid(self.root), u'a'),
+            (self.oid(self.root['a']['b']), self.oid(self.root['a']), u'b'),
+            (self.oid(self.root['c']), self.oid(self.root), u'c'),
+            (self.oid(self.root['mapping']), self.oid(self.root), u'mapping'),
+        ])
+        self.assertEqual(records, expected)
+
+    def test_crawl_in_small_transactions(self):
+        expected = sorted(crawl(self.root))
+        with mock.patch.object(self.conn.transaction_manager, 'abort') as abort:
+            records = sorted(crawl(self.root, gc_interval=2))
+        self.assertEqual(records, expected)
+        self.assertEqual(abort.call_count, (len(expected) + 1) // 2)
+
+    def test_crawl_drops_cached_histories(self):
+        list(crawl(self.root))
+        everything = len(getTransactionCache(self.conn, 'histories'))
+        transaction.abort()
+        list(crawl(self.root, gc_interval=2))
+        some = len(getTransactionCache(self.conn, 'histories'))
+        self.assertTrue(0 < some < everything)
+
+    def test_crawl_errors_are_logged(self):
+        with mock.patch('zodbbrowser.pathindex.ZodbObjectState',
+                        side_effect=Exception('oops')):
+            with self.assertLogs('zodbbrowser.pathindex') as cm:
+                self.assertEqual(list(crawl(self.root)), [])
+        self.assertEqual(len(cm.output), 1)
+
+    def test_buildPathIndex(self):
+        self.assertEqual(buildPathIndex(self.conn), 4)
+        index = PathIndex.load(self.db_filename + PATH_INDEX_SUFFIX)
+        self.assertEqual(index.root_oid, self.oid(self.root))
+        self.assertEqual(index.tid, self.storage.lastTransaction())
+        self.assertEqual(
+            ''.join(name for name, oid
+                    in index.getPath(self.oid(self.root['a']['b']))),
+            '/a/b')
+
+    def test_buildPathIndex_not_a_filestorage(self):
+        with mock.patch('zodbbrowser.cache.getStorageFilename',
+                        return_value=None):
+            with self.assertRaises(ValueError):
+                buildPathIndex(self.conn)
+
+    def test_getPathIndex(self):
+        self.assertEqual(getPathIndex(self.conn), None)
+        buildPathIndex(self.conn)
+        # checks for a new index file only once in a while
+        self.assertEqual(getPathIndex(self.conn), None)
+        index = getPathIndex(self.conn, cache_for=-1)
+        self.assertEqual(len(index), 4)
+        self.assertTrue(getPathIndex(self.conn) is index)
+
+    def test_getPathIndex_no_connection(self):
+        self.assertEqual(getPathIndex(None), None)
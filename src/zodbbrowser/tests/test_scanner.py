@@ -0,0 +1,136 @@
+import unittest
+
+import mock
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.FileStorage import FileStorage
+from ZODB.utils import u64
+from zope.interface.verify import verifyObject
+
+from zodbbrowser import scanner
+from zodbbrowser.interfaces import IDatabaseAnalysis
+from zodbbrowser.scanner import (
+    Analysis,
+    CombinedAnalysis,
+    iterRecords,
+    scan,
+    scanRange,
+    splitOids,
+)
+from zodbbrowser.tests.realdb import RealDatabaseTest
+
+
+class CountingAnalysis(Analysis):
+
+    def initial(self):
+        return 0
+
+    def map(self, result, oid, data):
+        return result + 1
+
+
+class OidsAnalysis(Analysis):
+
+    def initial(self):
+        return []
+
+    def map(self, result, oid, data):
+        result.append(u64(oid))
+        return result
+
+
+class TestAnalysis(unittest.TestCase):
+
+    def test_interface(self):
+        verifyObject(IDatabaseAnalysis, CountingAnalysis())
+
+    def test_defaults(self):
+        analysis = Analysis()
+        self.assertEqual(analysis.initial(), None)
+        self.assertEqual(analysis.reduce([1], [2]), [1, 2])
+
+
+class TestCombinedAnalysis(unittest.TestCase):
+
+    def test(self):
+        analysis = CombinedAnalysis(CountingAnalysis(), OidsAnalysis())
+        result = analysis.initial()
+        result = analysis.map(result, b'\0' * 7 + b'\1', b'')
+        result = analysis.map(result, b'\0' * 7 + b'\2', b'')
+        self.assertEqual(result, [2, [1, 2]])
+        other = analysis.map(analysis.initial(), b'\0' * 7 + b'\3', b'')
+        self.assertEqual(analysis.reduce(result, other), [3, [1, 2, 3]])
+
+
+class TestScanner(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        root = self.conn.root()
+        for n in range(10):
+            root[n] = PersistentMapping()
+        transaction.commit()
+
+    def test_iterRecords(self):
+        oids = [u64(oid) for oid, data in iterRecords(self.storage)]
+        self.assertEqual(oids, list(range(11)))
+
+    def test_iterRecords_range(self):
+        oids = [u64(oid) for oid, data in iterRecords(self.storage, 3, 5)]
+        self.assertEqual(oids, [3, 4])
+
+    def test_iterRecords_past_the_end(self):
+        self.assertEqual(list(iterRecords(self.storage, 100)), [])
+
+    def test_iterRecords_empty_storage(self):
+        storage = mock.Mock()
+        storage.record_iternext.side_effect = ValueError
+        self.assertEqual(list(iterRecords(storage)), [])
+
+    def test_splitOids(self):
+        self.assertEqual(splitOids(self.storage, 4),
+                         [(0, 3), (3, 6), (6, 9), (9, 11)])
+        self.assertEqual(splitOids(self.storage, 1), [(0, 11)])
+        self.assertEqual(len(splitOids(self.storage, 100)), 11)
+
+    def test_splitOids_empty_storage(self):
+        storage = mock.Mock(_index={})
+        self.assertEqual(splitOids(storage, 4), [])
+
+    def test_scanRange(self):
+        self.assertEqual(scanRange(self.storage, CountingAnalysis()), 11)
+        self.assertEqual(scanRange(self.storage, OidsAnalysis(), 2, 4),
+                         [2, 3])
+
+    def test_scan(self):
+        self.assertEqual(scan(self.storage, CountingAnalysis()), 11)
+
+    def test_scan_in_parallel(self):
+        self.assertEqual(scan(self.storage, CountingAnalysis(), processes=2),
+                         11)
+        self.assertEqual(
+            sorted(scan(self.storage, OidsAnalysis(), processes=3)),
+            list(range(11)))
+
+    def test_worker_opens_storage_once(self):
+        with mock.patch('zodbbrowser.scanner.FileStorage',
+                        wraps=FileStorage) as mock_fs:
+            with mock.patch('multiprocessing.util.Finalize'):
+                scanner._initWorker(self.db_filename)
+            try:
+                self.assertEqual(
+                    scanner._scanRangeInWorker((CountingAnalysis(), 0, 5)), 5)
+                self.assertEqual(
+                    scanner._scanRangeInWorker((CountingAnalysis(), 5, 20)),
+                    6)
+            finally:
+                storage = scanner._worker_storage
+                scanner._closeWorker()
+        mock_fs.assert_called_once_with(self.db_filename, read_only=True)
+        self.assertIsNone(scanner._worker_storage)
+        self.assertTrue(storage._is_read_only)
+
+    def test_scan_not_a_filestorage(self):
+        storage = mock.Mock()
+        storage.record_iternext.side_effect = ValueError
+        self.assertEqual(scan(storage, CountingAnalysis(), processes=2), 0)
@@ -8,18 +8,25 @@ import tempfile
 import unittest
 
 import mock
+from persistent.TimeStamp import TimeStamp
 from ZEO.Exceptions import ClientDisconnected
 from zope.app.testing import setup
+from zope.component import provideAdapter
 
+from zodbbrowser.browser import formatSize
 from zodbbrowser.compat import StringIO
+from zodbbrowser.history import ZodbHistory, getIterableStorage
 from zodbbrowser.standalone import (
     Options,
+    build_backref_index,
+    build_path_index,
     close_database,
     format_exception,
     main,
     open_db,
     parse_args,
     print_exception,
+    print_stats,
     serve_forever,
     start_server,
 )
@@ -127,12 +134,47 @@ class TestParseArgs(SocketMixin, unittest.TestCase):
         options = parse_args(['--zeo', sockfilename])
         self.assertEqual(options.zeo_address, sockfilename)
 
+    def test_build_path_index(self):
+        options = parse_args(['--build-path-index', 'Data.fs'])
+        self.assertTrue(options.build_path_index)
+
+    def test_build_backref_index(self):
+        options = parse_args(['--build-backref-index', 'Data.fs'])
+        self.assertTrue(options.build_backref_index)
+
+    def test_jobs(self):
+        options = parse_args(['--build-backref-index', '-j', '4', 'Data.fs'])
+        self.assertEqual(options.jobs, 4)
+
+    def test_stats(self):
+        options = parse_args(['--stats', '--zeo', 'localhost'])
+        self.assertTrue(options.stats)
+
+    def test_build_backref_index_zeo(self):
+        with self.assertRaises(SystemExit), mock.patch('sys.stderr'):
+            parse_args(['--build-backref-index', '--zeo', 'localhost'])
+
+    def test_build_path_index_zeo(self):
+        with self.assertRaises(SystemExit), mock.patch('sys.stderr'):
+            parse_args(['--build-path-index', '--zeo', 'localhost'])
+
     def test_bad_zeo_socket(self):
         with self.assertRaises(SystemExit), mock.patch('sys.stderr'):
             parse_args(['--zeo', __file__])
 
 
-class TestOpenDb(unittest.TestCase):
+class TestOpenDb(RealDatabaseTest):
+
+    open_db = False
+
+    def test_pool_size(self):
+        options = Options()
+        options.db_filename = self.db_filename
+        options.readonly = False
+        options.threads = 6
+        db = open_db(options)
+        self.addCleanup(db.close)
+        self.assertEqual(db.getPoolSize(), 12)
 
     @unittest.skipIf(sys.platform == 'win32', "This test hangs on Windows")
     def test_zeo(self):
@@ -202,11 +244,17 @@ class TestServeForever(unittest.TestCase):
         serve_forever(server)
         server.close.assert_called_once()
 
+    @mock.patch('zodbbrowser.browser.shutdownRenderPool')
+    def test_stops_rendering_threads(self, mock_shutdown):
+        serve_forever(mock.Mock())
+        mock_shutdown.assert_called_once()
+
 
 @mock.patch('zodbbrowser.standalone.open_db', mock.Mock())
 @mock.patch('zodbbrowser.standalone.configure', mock.Mock())
 @mock.patch('zodbbrowser.standalone.start_server', mock.Mock())
 @mock.patch('zodbbrowser.standalone.serve_forever', mock.Mock())
+@mock.patch('zodbbrowser.cache.startTidRefresher', mock.Mock())
 class TestMain(RealDatabaseTest):
 
     open_db = False
@@ -237,3 +285,98 @@ class TestMain(RealDatabaseTest):
     def test_debug_logging(self, mock_basicConfig):
         main(['--quiet', '--listen', '0', '--debug', '--rw', self.db_filename])
         self.assertEqual(logging.getLogger('zodbbrowser').level, logging.DEBUG)
+
+    def test_starts_tid_refresher(self):
+        from zodbbrowser.cache import startTidRefresher
+        startTidRefresher.reset_mock()
+        main(['--quiet', '--listen', '0', self.db_filename])
+        startTidRefresher.assert_called_once()
+
+    @mock.patch('zodbbrowser.standalone.build_path_index')
+    def test_build_path_index(self, mock_build_path_index):
+        from zodbbrowser.standalone import start_server
+        start_server.reset_mock()
+        main(['--quiet', '--build-path-index', self.db_filename])
+        mock_build_path_index.assert_called_once()
+        start_server.assert_not_called()
+
+    @mock.patch('zodbbrowser.standalone.build_backref_index')
+    def test_build_backref_index(self, mock_build_backref_index):
+        from zodbbrowser.standalone import open_db, start_server
+        start_server.reset_mock()
+        main(['--quiet', '--build-backref-index', self.db_filename])
+        mock_build_backref_index.assert_called_once()
+        open_db().close.assert_called()
+        start_server.assert_not_called()
+
+    @mock.patch('zodbbrowser.standalone.print_stats')
+    def test_stats(self, mock_print_stats):
+        from zodbbrowser.standalone import start_server
+        start_server.reset_mock()
+        main(['--quiet', '--stats', '-j', '2', self.db_filename])
+        mock_print_stats.assert_called_once_with(mock.ANY, 2)
+        start_server.assert_not_called()
+
+
+class TestBuildPathIndex(unittest.TestCase):
+
+    def setUp(self):
+        setup.placelessSetUp()
+
+    def tearDown(self):
+        setup.placelessTearDown()
+
+    def test(self):
+        db = mock.Mock()
+        with mock.patch('zodbbrowser.pathindex.buildPathIndex',
+                        return_value=42):
+            with self.assertLogs('zodbbrowser.standalone') as cm:
+                build_path_index(db)
+        db.open().close.assert_called_once()
+        self.assertEqual(cm.output, [
+            'INFO:zodbbrowser.standalone:Saved the paths of 42 objects'])
+
+
+class TestBuildBackrefIndex(unittest.TestCase):
+
+    def test(self):
+        db = mock.Mock()
+        with mock.patch('zodbbrowser.backrefs.buildBackrefIndex',
+                        return_value=42) as mock_build:
+            with self.assertLogs('zodbbrowser.standalone') as cm:
+                build_backref_index(db)
+        mock_build.assert_called_once_with(db.storage, processes=None)
+        self.assertEqual(cm.output, [
+            'INFO:zodbbrowser.standalone:Saved 42 backreferences'])
+
+
+class TestPrintStats(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbHistory)
+        provideAdapter(getIterableStorage)
+        RealDatabaseTest.setUp(self)
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def test(self):
+        file = StringIO()
+        print_stats(self.db, processes=1, file=file)
+        size = formatSize(len(self.storage.load(b'\0' * 8)[0]))
+        tid = TimeStamp(self.storage.lastTransaction())
+        self.assertEqual(file.getvalue().splitlines(), [
+            '   objects       size    average  class',
+            '         1 %10s %10s  persistent.mapping.PersistentMapping'
+            % (size, size),
+            '%32s  0x0' % size,
+            '',
+            'Largest objects:',
+            '%10s  0x0  persistent.mapping.PersistentMapping' % size,
+            '',
+            'Largest revisions:',
+            '%10s  0x0  %s  persistent.mapping.PersistentMapping'
+            % (size, tid),
+        ])
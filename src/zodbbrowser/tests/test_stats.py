@@ -0,0 +1,217 @@
+import pickle
+import unittest
+
+import mock
+import transaction
+from persistent.list import PersistentList
+from persistent.mapping import PersistentMapping
+from ZODB.utils import u64
+from zope.app.testing import setup
+from zope.component import provideAdapter
+
+from zodbbrowser import cache
+from zodbbrowser.history import ZodbHistory, getIterableStorage
+from zodbbrowser.stats import (
+    CENSUSES,
+    addRecord,
+    findLargestRevisions,
+    getCensus,
+    getClassName,
+    hasCensus,
+    mergeCensus,
+    pushBounded,
+    removeRecord,
+    replaceRecord,
+    summarizeCensus,
+)
+from zodbbrowser.tests.realdb import RealDatabaseTest
+
+
+class TestCensus(unittest.TestCase):
+
+    def test_addRecord(self):
+        census = {}
+        addRecord(census, 1, 'Foo', 10, largest=2)
+        addRecord(census, 2, 'Foo', 30, largest=2)
+        addRecord(census, 3, 'Foo', 20, largest=2)
+        addRecord(census, 4, 'Bar', 5, largest=2)
+        self.assertEqual(census, {
+            'Foo': dict(count=3, size=60, largest={2: 30, 3: 20}),
+            'Bar': dict(count=1, size=5, largest={4: 5}),
+        })
+
+    def test_removeRecord(self):
+        census = {}
+        addRecord(census, 1, 'Foo', 10)
+        addRecord(census, 2, 'Foo', 30)
+        addRecord(census, 3, 'Bar', 5)
+        removeRecord(census, 2, 'Foo', 30)
+        removeRecord(census, 3, 'Bar', 5)
+        removeRecord(census, 4, 'Baz', 5)
+        self.assertEqual(census, {
+            'Foo': dict(count=1, size=10, largest={1: 10}),
+        })
+
+    def test_mergeCensus(self):
+        census = {}
+        addRecord(census, 1, 'Foo', 10)
+        addRecord(census, 2, 'Foo', 30)
+        other = {}
+        addRecord(other, 3, 'Foo', 20)
+        addRecord(other, 4, 'Bar', 5)
+        self.assertEqual(mergeCensus(census, other, largest=2), {
+            'Foo': dict(count=3, size=60, largest={2: 30, 3: 20}),
+            'Bar': dict(count=1, size=5, largest={4: 5}),
+        })
+
+    def test_summarizeCensus(self):
+        census = {}
+        addRecord(census, 1, 'Foo', 10)
+        addRecord(census, 2, 'Foo', 30)
+        addRecord(census, 3, 'Bar', 50)
+        self.assertEqual(summarizeCensus(census), [
+            dict(class_name='Bar', count=1, size=50, average=50,
+                 largest=[(3, 50)]),
+            dict(class_name='Foo', count=2, size=40, average=20,
+                 largest=[(2, 30), (1, 10)]),
+        ])
+
+
+class TestLeaderboards(unittest.TestCase):
+
+    def test_pushBounded(self):
+        heap = []
+        for n in [5, 1, 7, 3, 9, 2]:
+            pushBounded(heap, n, 3)
+        self.assertEqual(sorted(heap), [5, 7, 9])
+
+    def test_replaceRecord(self):
+        data = pickle.dumps(PersistentList, 1) + b'x' * 10
+        largest = []
+        replaceRecord(largest, 1, data * 3, size=2)
+        replaceRecord(largest, 2, data * 2, size=2)
+        replaceRecord(largest, 3, data, size=2)
+        self.assertEqual([oid for size, oid, class_name
+                          in sorted(largest)], [2, 1])
+        # shrinking objects fall out of the leaderboard
+        replaceRecord(largest, 1, data, size=2)
+        self.assertEqual([oid for size, oid, class_name
+                          in sorted(largest)], [1, 2])
+        # and so do deleted objects
+        replaceRecord(largest, 2, None, size=2)
+        self.assertEqual([oid for size, oid, class_name
+                          in sorted(largest)], [1])
+        self.assertEqual(largest[0][2], 'persistent.list.PersistentList')
+
+
+class TestClassCensus(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbHistory)
+        provideAdapter(getIterableStorage)
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+        self.root['a'] = PersistentMapping()
+        self.root['b'] = PersistentList()
+        transaction.commit()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def takeCensus(self):
+        # the list of transactions is cached for a while
+        cache.STORAGE_TIDS.pop(self.storage, None)
+        return getCensus(self.conn)
+
+    def countsAndSizes(self, census):
+        return dict((name, (stats['count'], stats['size']))
+                    for name, stats in census.items())
+
+    def test_getClassName(self):
+        data, tid = self.storage.load(self.root['a']._p_oid)
+        self.assertEqual(getClassName(data),
+                         'persistent.mapping.PersistentMapping')
+
+    def test_getCensus(self):
+        self.assertFalse(hasCensus(self.conn))
+        result = self.takeCensus()
+        self.assertTrue(hasCensus(self.conn))
+        self.assertEqual(result['tid'], self.storage.lastTransaction())
+        census = result['census']
+        self.assertEqual(
+            sorted((name, stats['count']) for name, stats in census.items()),
+            [('persistent.list.PersistentList', 1),
+             ('persistent.mapping.PersistentMapping', 2)])
+        self.assertIn(u64(self.root['b']._p_oid),
+                      census['persistent.list.PersistentList']['largest'])
+
+    def test_getCensus_returns_a_snapshot(self):
+        result = self.takeCensus()
+        census = result['census']
+        expected = self.countsAndSizes(census)
+        largest = dict(census['persistent.list.PersistentList']['largest'])
+        self.root['c'] = PersistentList()
+        self.root['d'] = PersistentList()
+        del self.root['b']
+        transaction.commit()
+        self.takeCensus()
+        self.assertEqual(self.countsAndSizes(census), expected)
+        self.assertEqual(census['persistent.list.PersistentList']['largest'],
+                         largest)
+
+    def test_getCensus_largest(self):
+        result = self.takeCensus()
+        self.assertEqual(
+            [(oid, class_name)
+             for size, oid, class_name in result['largest']],
+            [(0, 'persistent.mapping.PersistentMapping'),
+             (1, 'persistent.mapping.PersistentMapping'),
+             (2, 'persistent.list.PersistentList')])
+        tids = [u64(txn.tid) for txn in self.storage.iterator()]
+        self.assertEqual(
+            sorted((oid, tid)
+                   for size, oid, tid, class_name
+                   in result['largest_revisions']),
+            [(0, tids[0]), (0, tids[1]), (1, tids[1]), (2, tids[1])])
+
+    def test_findLargestRevisions(self):
+        revisions = findLargestRevisions(self.storage.iterator(), size=1)
+        self.assertEqual([oid for size, oid, tid, class_name in revisions],
+                         [0])
+
+    def test_getCensus_incremental(self):
+        self.takeCensus()
+        self.root['a']['x'] = 'a long string' * 10
+        self.root['c'] = PersistentList()
+        del self.root['b']
+        transaction.commit()
+        with mock.patch('zodbbrowser.scanner.scan') as mock_scan:
+            result = self.takeCensus()
+        mock_scan.assert_not_called()
+        self.assertEqual(result['tid'], self.storage.lastTransaction())
+        incremental = self.countsAndSizes(result['census'])
+        # the unreferenced list is still there until the database is packed,
+        # and the new one is there too
+        self.assertEqual(incremental['persistent.list.PersistentList'][0], 2)
+        self.assertEqual(result['largest'][0][1], u64(self.root['a']._p_oid))
+        self.assertEqual(result['largest_revisions'][0][1:3],
+                         (u64(self.root['a']._p_oid),
+                          u64(self.storage.lastTransaction())))
+        del CENSUSES[self.storage]
+        fresh = self.takeCensus()
+        self.assertEqual(incremental, self.countsAndSizes(fresh['census']))
+        self.assertEqual(result['largest'], fresh['largest'])
+        self.assertEqual(result['largest_revisions'],
+                         fresh['largest_revisions'])
+
+    def test_getCensus_after_pack(self):
+        self.takeCensus()
+        with mock.patch('zodbbrowser.cache.getFirstTid',
+                        return_value=b'\xff' * 8):
+            with mock.patch('zodbbrowser.scanner.scan',
+                            return_value=[{}, []]) as mock_scan:
+                result = self.takeCensus()
+        mock_scan.assert_called_once()
+        self.assertEqual(result['census'], {})
@@ -1,5 +1,8 @@
+import time
 import unittest
 
+import mock
+import transaction
 from BTrees.OOBTree import OOBTree
 from persistent import Persistent
 from persistent.dict import PersistentDict
@@ -9,9 +12,14 @@ from zope.component import adapter, provideAdapter
 from zope.interface import Interface, alsoProvides, implementer
 from zope.interface.verify import verifyObject
 
+from zodbbrowser.history import ZodbObjectHistory
 from zodbbrowser.interfaces import IObjectHistory, IValueRenderer
+from zodbbrowser.tests.realdb import RealDatabaseTest
 from zodbbrowser.value import (
+    CURRENT_RENDER_CACHE,
+    CURRENT_RENDER_TTL,
     MAX_CACHE_SIZE,
+    RENDER_CACHE,
     TRUNCATIONS,
     TRUNCATIONS_IN_ORDER,
     DictValue,
@@ -490,6 +498,91 @@ class TestPersistentValue(unittest.TestCase):
             '&lt;PersistentFrob&gt;')
 
 
+class Thing(Persistent):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return '<Thing: %s>' % self.value
+
+
+class TestPersistentValueCache(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(GenericValue)
+        provideAdapter(ZodbObjectHistory)
+        RealDatabaseTest.setUp(self)
+        for cache in RENDER_CACHE, CURRENT_RENDER_CACHE:
+            cache.clear()
+            self.addCleanup(cache.clear)
+        self.obj = self.conn.root()['thing'] = Thing('old')
+        transaction.commit()
+        self.old_tid = self.obj._p_serial
+        self.obj.value = 'new'
+        transaction.commit()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def render(self, tid=None, can_link=False):
+        return PersistentValue(self.obj).render(tid, can_link=can_link)
+
+    def test_historical(self):
+        self.assertEqual(self.render(self.old_tid), '&lt;Thing: old&gt;')
+        with mock.patch('zodbbrowser.value.getObjectHistory') as history:
+            self.assertEqual(self.render(self.old_tid), '&lt;Thing: old&gt;')
+        self.assertFalse(history.called)
+        self.assertEqual(len(RENDER_CACHE), 1)
+
+    def test_failed_historical_loads_are_not_cached(self):
+        with mock.patch('zodbbrowser.value.getObjectHistory',
+                        side_effect=IOError('disconnected')):
+            # falls back to the current state
+            self.assertEqual(self.render(self.old_tid), '&lt;Thing: new&gt;')
+        self.assertEqual(len(RENDER_CACHE), 0)
+        self.assertEqual(self.render(self.old_tid), '&lt;Thing: old&gt;')
+
+    def test_links_are_cached_separately(self):
+        self.assertEqual(self.render(self.old_tid), '&lt;Thing: old&gt;')
+        self.assertTrue(self.render(self.old_tid, can_link=True)
+                        .startswith('<a class="objlink"'))
+        self.assertEqual(len(RENDER_CACHE), 2)
+
+    def test_current(self):
+        self.assertEqual(self.render(), '&lt;Thing: new&gt;')
+        self.assertEqual(len(CURRENT_RENDER_CACHE), 1)
+        self.assertEqual(len(RENDER_CACHE), 0)
+        self.obj.value = 'newer'
+        # not cached while there are unsaved changes
+        self.assertEqual(self.render(), '&lt;Thing: newer&gt;')
+        transaction.commit()
+        self.assertEqual(self.render(), '&lt;Thing: newer&gt;')
+
+    def test_current_expires(self):
+        self.assertEqual(self.render(), '&lt;Thing: new&gt;')
+        self.obj.__dict__['value'] = 'sneaky'
+        self.assertEqual(self.render(), '&lt;Thing: new&gt;')
+        with mock.patch('time.time',
+                        return_value=time.time() + CURRENT_RENDER_TTL + 1):
+            self.assertEqual(self.render(), '&lt;Thing: sneaky&gt;')
+
+    def test_truncated_values_are_not_cached(self):
+        self.obj.value = 'x' * 300
+        transaction.commit()
+        self.assertTrue('class="truncated"' in self.render())
+        self.assertEqual(len(CURRENT_RENDER_CACHE), 0)
+
+    def test_objects_not_in_database_are_not_cached(self):
+        obj = Thing('new')
+        obj._p_oid = p64(23)
+        self.assertEqual(PersistentValue(obj).render(can_link=False),
+                         '&lt;Thing: new&gt;')
+        self.assertEqual(len(CURRENT_RENDER_CACHE), 0)
+
+
 class TestPersistentDictValue(unittest.TestCase):
 
     def setUp(self):
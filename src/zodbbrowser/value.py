@@ -2,6 +2,8 @@ import collections
 import itertools
 import logging
 import re
+import time
+import weakref
 from functools import partial
 
 from persistent import Persistent
@@ -14,6 +16,7 @@ from zope.interface import Interface, implementer
 from zope.interface.declarations import ProvidesClass
 from zope.security.proxy import removeSecurityProxy
 
+from zodbbrowser.cache import MB, LRUCache
 from zodbbrowser.compat import basestring, escape
 from zodbbrowser.history import getObjectHistory
 from zodbbrowser.interfaces import IValueRenderer
@@ -39,6 +42,17 @@ TRUNCATIONS = {}
 TRUNCATIONS_IN_ORDER = collections.deque()
 next_id = partial(next, itertools.count(1))
 
+# Rendered links to persistent objects.  Old revisions never change, so
+# they can be cached for as long as we like; renderings of the current
+# revision are forgotten after a few seconds, or as soon as somebody
+# commits a transaction.  Both caches are limited by the length of the HTML.
+RENDER_CACHE_SIZE = 4 * MB
+CURRENT_RENDER_CACHE_SIZE = 1 * MB
+CURRENT_RENDER_TTL = 10  # seconds
+RENDER_CACHE = LRUCache(RENDER_CACHE_SIZE, sizeof=len)
+CURRENT_RENDER_CACHE = LRUCache(CURRENT_RENDER_CACHE_SIZE,
+                                sizeof=lambda value: len(value[1]))
+
 
 def resetTruncations(): # for tests only!
     global next_id
@@ -255,7 +269,52 @@ class PersistentValue(object):
         self.context = removeSecurityProxy(context)
 
     def render(self, tid=None, can_link=True):
+        key = self._cacheKey(tid, can_link)
+        if key is None:
+            return self._render(tid, can_link)[0]
+        if tid is not None:
+            html = RENDER_CACHE.get(key)
+        else:
+            expires, html = CURRENT_RENDER_CACHE.get(key, (0, None))
+            if expires < time.time():
+                html = None
+        if html is None:
+            html, cacheable = self._render(tid, can_link)
+            # the full text of truncated values is kept in TRUNCATIONS only
+            # for a while
+            if cacheable and 'class="truncated"' not in html:
+                if tid is not None:
+                    RENDER_CACHE.put(key, html)
+                else:
+                    CURRENT_RENDER_CACHE.put(
+                        key, (time.time() + CURRENT_RENDER_TTL, html))
+        return html
+
+    def _cacheKey(self, tid, can_link):
+        """Return the key for the rendered HTML in the render caches.
+
+        Returns None if the HTML can't be cached, e.g. because the object
+        isn't stored in a database or has unsaved changes.
+        """
         obj = self.context
+        jar = getattr(obj, '_p_jar', None)
+        if jar is None or obj._p_oid is None or obj._p_changed:
+            return None
+        storage = jar.db().storage
+        if tid is None:
+            # the current revision may change with every commit
+            tid = storage.lastTransaction()
+        return weakref.ref(storage), obj._p_oid, tid, can_link, self.__class__
+
+    def _render(self, tid, can_link):
+        """Render the object as it was in transaction tid.
+
+        Returns the HTML and a flag telling whether it can be cached, which
+        it can't if we had to fall back to the current state because the
+        old one couldn't be loaded.
+        """
+        obj = self.context
+        cacheable = True
         url = '%s?oid=0x%x' % (self.view_name, u64(self.context._p_oid))
         if tid is not None:
             url += "&tid=0x%x" % u64(tid)
@@ -268,12 +327,12 @@ class PersistentValue(object):
             except Exception:
                 log.debug('Could not load old state for %s 0x%x',
                           self.context.__class__, u64(self.context._p_oid))
+                cacheable = False
         value = self.delegate_to(obj).render(tid, can_link=False)
         if can_link:
-            return '<a class="objlink" href="%s">%s</a>' % (escape(url, True),
-                                                            value)
-        else:
-            return value
+            value = '<a class="objlink" href="%s">%s</a>' % (escape(url, True),
+                                                             value)
+        return value, cacheable
 
 
 @adapter(PersistentMapping)